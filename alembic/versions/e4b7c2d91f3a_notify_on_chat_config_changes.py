@@ -0,0 +1,69 @@
+"""Notify on chat config changes
+
+Revision ID: e4b7c2d91f3a
+Revises: cd31ec5c59fe
+Create Date: 2026-10-18 12:40:12.318904+00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7c2d91f3a'
+down_revision = 'cd31ec5c59fe'
+branch_labels = None
+depends_on = None
+
+# Tables with chat configs mapped to the column with the chat id
+CHAT_CONFIG_TABLES = {
+    'abit_chat_info': 'chat_id',
+    'programs': 'chat_id',
+    'useful_links': 'chat_id',
+    'admission_committe_info': 'chat_id',
+    'admission_committe_timetable': 'committe_chat_id',
+}
+
+
+def upgrade() -> None:
+    # LISTEN/NOTIFY is PostgreSQL-only. Notifications of a transaction
+    # are sent on commit, and duplicates are sent once, so a transaction
+    # announces every changed chat once
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("""
+        CREATE FUNCTION notify_chat_config_changed() RETURNS trigger AS $$
+        DECLARE
+            chat_id text;
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                chat_id := to_jsonb(OLD) ->> TG_ARGV[0];
+                IF chat_id IS NOT NULL THEN
+                    PERFORM pg_notify('chat_config_changed', chat_id);
+                END IF;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                chat_id := to_jsonb(NEW) ->> TG_ARGV[0];
+                IF chat_id IS NOT NULL THEN
+                    PERFORM pg_notify('chat_config_changed', chat_id);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table, column in CHAT_CONFIG_TABLES.items():
+        op.execute(f"""
+            CREATE TRIGGER {table}__notify_chat_config_changed
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW
+            EXECUTE FUNCTION notify_chat_config_changed('{column}')
+        """)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in CHAT_CONFIG_TABLES:
+        op.execute(f'DROP TRIGGER {table}__notify_chat_config_changed '
+                   f'ON {table}')
+    op.execute('DROP FUNCTION notify_chat_config_changed()')
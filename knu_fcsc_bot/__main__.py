@@ -1,17 +1,68 @@
+import asyncio
 import os
-from argparse import ArgumentParser
-from dataclasses import dataclass
+import time
+from argparse import ArgumentParser, BooleanOptionalAction, Namespace
+from dataclasses import dataclass, field, asdict
+from datetime import timedelta
+from functools import partial
+from typing import Callable, TypeVar, TYPE_CHECKING
 
 from loguru import logger
+from sqlalchemy import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from telegram.constants import ParseMode, UpdateType
-from telegram.ext import (ApplicationBuilder, Defaults, AIORateLimiter,
-                          Application, )
+from telegram import Update
+from telegram.ext import (ApplicationBuilder, Defaults, Application,
+                          TypeHandler, )
 
+from knu_fcsc_bot.bot.caches import InfoMenuCache
+from knu_fcsc_bot.bot.callbacks import (reconcile_penguin_leaderboard,
+                                        sweep_chat_member_cache,
+                                        flush_message_deletions,
+                                        capture_update,
+                                        flush_update_capture,
+                                        reload_allowed_chats,
+                                        sync_allowed_chat,
+                                        DELETE_INFO_MENU_AFTER, )
+from knu_fcsc_bot.bot.deletions import MessageDeletionScheduler
+from knu_fcsc_bot.bot.greetings import GreetingAggregator
 from knu_fcsc_bot.bot.handlers import setup_handlers
+from knu_fcsc_bot.bot.instrumentation import (
+    InstrumentedAIORateLimiter,
+    InstrumentedHTTPXRequest,
+    InstrumentedAsyncAdaptedQueuePool,
+    instrument_engine,
+    instrument_handlers,
+    register_app_metrics,
+    HANDLER_DURATION,
+)
+from knu_fcsc_bot.bot.leaderboard import PenguinLeaderboard
+from knu_fcsc_bot.bot.recorders import (ChatMemberRecorder, ChatMemberIndex,
+                                        PenguinGifRecorder, )
 from knu_fcsc_bot.logginig import (redirect_standard_logging_to_loguru,
-                                   disable_low_level_logs, set_logging_level, )
-from knu_fcsc_bot.usecases import list_allowed_chat_ids_usecase
+                                   disable_low_level_logs, set_logging_level,
+                                   DEFAULT_LOG_SAMPLING, )
+from knu_fcsc_bot.metrics import start_metrics_server
+from knu_fcsc_bot.usecases import count_sent_penguins_usecase
+
+# Modules needed only by some running modes or databases are imported
+# where they are used
+if TYPE_CHECKING:
+    from knu_fcsc_bot.workers import WorkerPartition
+
+RECONCILE_PENGUIN_LEADERBOARD_EVERY = timedelta(minutes=30)
+SWEEP_CHAT_MEMBER_CACHE_EVERY = timedelta(minutes=10)
+FLUSH_MESSAGE_DELETIONS_EVERY = timedelta(seconds=10)
+FLUSH_UPDATE_CAPTURE_EVERY = timedelta(seconds=30)
+
+T = TypeVar('T')
+
+ALLOWED_UPDATES = [
+    UpdateType.CHAT_MEMBER,
+    UpdateType.CALLBACK_QUERY,
+    UpdateType.MESSAGE,
+    UpdateType.MY_CHAT_MEMBER,
+]
 
 
 @dataclass
@@ -22,15 +73,134 @@ class WebhookOptions:
     port: int = 80
     url_path: str = ""
     webhook_url: str = None
+    # Telegram sends it in X-Telegram-Bot-Api-Secret-Token, and requests
+    # without it are rejected if it is set
+    secret_token: str | None = None
+    # Updates are dispatched to worker processes by chat if there are
+    # more than one
+    workers: int = 1
+
+
+@dataclass
+class DatabaseOptions:
+    """Sub-options for the database engine. Default values are taken from
+    QueuePool docs of SQLAlchemy"""
+    pool_size: int = 5
+    max_overflow: int = 10
+    # Seconds to wait for a connection from the pool
+    pool_timeout: float = 30
+    # Seconds after which connections are replaced. -1 disables it
+    pool_recycle: int = -1
+    pool_pre_ping: bool = False
+    # Seconds to wait for a new connection to the database
+    connect_timeout: int | None = None
+    # Disables server-side prepared statements of psycopg, which break
+    # behind pgbouncer in the transaction pooling mode
+    pgbouncer: bool = False
+
+
+@dataclass
+class RequestOptions:
+    """Sub-options for HTTP clients of Bot API requests. Default values
+    are taken from HTTPXRequest docs"""
+    http_version: str = '1.1'
+    connection_pool_size: int = 1
+    connect_timeout: float | None = 5.0
+    read_timeout: float | None = 5.0
+    write_timeout: float | None = 5.0
+    # Seconds to wait for a connection from the pool
+    pool_timeout: float | None = 1.0
+
+
+@dataclass
+class ReplayOptions:
+    """Sub-options for replaying captured updates"""
+    path: str
+    # Updates are fed one after another if the speed is None
+    speed: float | None = 1
+    api_latency: timedelta = timedelta(0)
+    rate_limit: bool = False
 
 
 @dataclass
 class StartupOptions:
     """A collection of startup options"""
     verbose_logging: bool = False
+    json_logs: bool = False
+    log_sampling: dict[str, int] = None
+
+    metrics_host: str = '127.0.0.1'
+    # Metrics are not served if the port is not set
+    metrics_port: int | None = None
+
+    # Incoming updates are captured if the path is set
+    capture_path: str | None = None
+    # Imports of the bot are profiled and reported on start if set
+    import_report: bool = False
+
+    database_options: DatabaseOptions = field(
+        default_factory=DatabaseOptions,
+    )
+    # Handlers make concurrent requests, so the pool size is the same as
+    # python-telegram-bot's ApplicationBuilder uses for them
+    request_options: RequestOptions = field(
+        default_factory=partial(RequestOptions, connection_pool_size=256),
+    )
+    get_updates_request_options: RequestOptions = field(
+        default_factory=RequestOptions,
+    )
 
     use_webhook: bool = False
     webhook_options: WebhookOptions = None
+    replay_options: ReplayOptions = None
+    # Set in worker processes of the multi-worker webhook mode
+    partition: 'WorkerPartition | None' = None
+
+
+def _get_env(name: str, default: T, parse: Callable[[str], T] = str) -> T:
+    """Returns the parsed environmental variable or the default if it
+    is not set"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return parse(value)
+
+
+def _parse_bool(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _add_request_arguments(parser: ArgumentParser, prefix: str,
+                           title: str, defaults: RequestOptions) -> None:
+    """Adds arguments of RequestOptions, which names start with
+    the prefix"""
+    group = parser.add_argument_group(title)
+    group.add_argument(f'--{prefix}-http-version', choices=['1.1', '2'],
+                       default=defaults.http_version,
+                       help=f'Defaults to {defaults.http_version}')
+    group.add_argument(f'--{prefix}-pool-size', type=int,
+                       default=defaults.connection_pool_size,
+                       help=f'The number of connections. Defaults to '
+                            f'{defaults.connection_pool_size}')
+    for timeout in ('connect', 'read', 'write', 'pool'):
+        default = getattr(defaults, f'{timeout}_timeout')
+        group.add_argument(f'--{prefix}-{timeout}-timeout', type=float,
+                           default=default,
+                           help=f'Seconds. Defaults to {default}')
+
+
+def _parse_request_options(args: Namespace, prefix: str) -> RequestOptions:
+    """Collects RequestOptions from arguments added with
+    _add_request_arguments()"""
+    prefix = prefix.replace('-', '_')
+    return RequestOptions(
+        http_version=getattr(args, f'{prefix}_http_version'),
+        connection_pool_size=getattr(args, f'{prefix}_pool_size'),
+        connect_timeout=getattr(args, f'{prefix}_connect_timeout'),
+        read_timeout=getattr(args, f'{prefix}_read_timeout'),
+        write_timeout=getattr(args, f'{prefix}_write_timeout'),
+        pool_timeout=getattr(args, f'{prefix}_pool_timeout'),
+    )
 
 
 def get_startup_options() -> StartupOptions:
@@ -38,7 +208,97 @@ def get_startup_options() -> StartupOptions:
     parser = ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='If present, enables DEBUG log-level', )
-    parser.set_defaults(use_webhook=None)
+    parser.add_argument('--json-logs', action='store_true',
+                        help='If present, logs are written as JSON lines', )
+    parser.add_argument('--sample-logs', action='append', default=[],
+                        metavar='CATEGORY=N',
+                        help='Log only 1 in N records of the category. '
+                             'Overrides the default sampling of the '
+                             'category. Can be repeated', )
+    parser.add_argument('--metrics-host',
+                        help='Host to serve metrics on',
+                        default=StartupOptions.metrics_host)
+    parser.add_argument('--metrics-port', type=int,
+                        help='If present, metrics are served in '
+                             'the Prometheus format at '
+                             'http://<metrics-host>:<metrics-port>/metrics', )
+    parser.add_argument('--capture', metavar='PATH',
+                        help='If present, incoming updates are appended '
+                             'to the gzip-compressed log at the path, '
+                             'which can be replayed later', )
+    parser.add_argument('--import-report', action='store_true',
+                        help='If present, imports of the bot are profiled '
+                             'in a fresh interpreter, and the slowest ones '
+                             'are logged on start', )
+
+    # Database options. Environmental variables override the defaults
+    database_group = parser.add_argument_group(
+        'database',
+        'Options of the database engine. Each option can be set with '
+        'the environmental variable in brackets',
+    )
+    database_group.add_argument(
+        '--db-pool-size', type=int,
+        default=_get_env('DATABASE_POOL_SIZE',
+                         DatabaseOptions.pool_size, int),
+        help='The number of connections kept open (DATABASE_POOL_SIZE)',
+    )
+    database_group.add_argument(
+        '--db-max-overflow', type=int,
+        default=_get_env('DATABASE_MAX_OVERFLOW',
+                         DatabaseOptions.max_overflow, int),
+        help='The number of connections allowed above the pool size '
+             '(DATABASE_MAX_OVERFLOW)',
+    )
+    database_group.add_argument(
+        '--db-pool-timeout', type=float,
+        default=_get_env('DATABASE_POOL_TIMEOUT',
+                         DatabaseOptions.pool_timeout, float),
+        help='Seconds to wait for a connection from the pool '
+             '(DATABASE_POOL_TIMEOUT)',
+    )
+    database_group.add_argument(
+        '--db-pool-recycle', type=int,
+        default=_get_env('DATABASE_POOL_RECYCLE',
+                         DatabaseOptions.pool_recycle, int),
+        help='Seconds after which connections are replaced. -1 disables '
+             'it (DATABASE_POOL_RECYCLE)',
+    )
+    database_group.add_argument(
+        '--db-pool-pre-ping', action=BooleanOptionalAction,
+        default=_get_env('DATABASE_POOL_PRE_PING',
+                         DatabaseOptions.pool_pre_ping, _parse_bool),
+        help='Test connections for liveness on checkout '
+             '(DATABASE_POOL_PRE_PING)',
+    )
+    database_group.add_argument(
+        '--db-connect-timeout', type=int,
+        default=_get_env('DATABASE_CONNECT_TIMEOUT',
+                         DatabaseOptions.connect_timeout, int),
+        help='Seconds to wait for a new connection to PostgreSQL '
+             '(DATABASE_CONNECT_TIMEOUT)',
+    )
+    database_group.add_argument(
+        '--pgbouncer', action=BooleanOptionalAction,
+        default=_get_env('DATABASE_PGBOUNCER',
+                         DatabaseOptions.pgbouncer, _parse_bool),
+        help='Disable prepared statements to work behind pgbouncer in '
+             'the transaction pooling mode (DATABASE_PGBOUNCER)',
+    )
+
+    # Bot API request options
+    default_options = StartupOptions()
+    _add_request_arguments(
+        parser, prefix='api',
+        title='Bot API requests',
+        defaults=default_options.request_options,
+    )
+    _add_request_arguments(
+        parser, prefix='get-updates',
+        title='getUpdates requests',
+        defaults=default_options.get_updates_request_options,
+    )
+    parser.set_defaults(use_webhook=None, replay=False)
     subparsers = parser.add_subparsers()
 
     # Polling options
@@ -60,10 +320,71 @@ def get_startup_options() -> StartupOptions:
     webhook_parser.add_argument('--webhook-url', '-w',
                                 help='A url that will be used by Telegram to'
                                      'reference the webhook')
+    webhook_parser.add_argument('--secret-token',
+                                help='A secret token, which Telegram sends '
+                                     'with every webhook request. Requests '
+                                     'without it are rejected. Can be set '
+                                     'with WEBHOOK_SECRET_TOKEN',
+                                default=_get_env('WEBHOOK_SECRET_TOKEN',
+                                                 WebhookOptions.secret_token))
+    webhook_parser.add_argument('--workers', '-n', type=int,
+                                help='The number of worker processes. '
+                                     'Updates of a chat are always handled '
+                                     'by the same worker. Defaults to 1, '
+                                     'which handles updates in-process',
+                                default=WebhookOptions.workers)
+
+    # Replay options
+    replay_parser = subparsers.add_parser(
+        'replay',
+        help='Replay captured updates against a fake Bot API and report '
+             'timings of handlers',
+    )
+    replay_parser.set_defaults(use_webhook=False, replay=True)
+    replay_parser.add_argument('path',
+                               help='A log written with --capture')
+    replay_parser.add_argument('--speed', type=float, default=1,
+                               help='How many times faster than captured '
+                                    'updates are replayed. Defaults to 1')
+    replay_parser.add_argument('--max-speed', action='store_true',
+                               help='If present, updates are replayed one '
+                                    'after another without gaps')
+    replay_parser.add_argument('--api-latency', type=float, default=0,
+                               help='Latency of the fake Bot API in '
+                                    'milliseconds')
+    replay_parser.add_argument('--rate-limit', action='store_true',
+                               help='If present, requests are throttled to '
+                                    'the Telegram flood limits')
 
     args = parser.parse_args()
+    log_sampling = dict(DEFAULT_LOG_SAMPLING)
+    for sampling in args.sample_logs:
+        category, _, every = sampling.partition('=')
+        try:
+            log_sampling[category] = int(every)
+        except ValueError:
+            parser.error(f'Invalid log sampling {sampling!r}')
+
     options = StartupOptions(
         verbose_logging=args.verbose,
+        json_logs=args.json_logs,
+        log_sampling=log_sampling,
+        metrics_host=args.metrics_host,
+        metrics_port=args.metrics_port,
+        capture_path=args.capture,
+        import_report=args.import_report,
+        database_options=DatabaseOptions(
+            pool_size=args.db_pool_size,
+            max_overflow=args.db_max_overflow,
+            pool_timeout=args.db_pool_timeout,
+            pool_recycle=args.db_pool_recycle,
+            pool_pre_ping=args.db_pool_pre_ping,
+            connect_timeout=args.db_connect_timeout,
+            pgbouncer=args.pgbouncer,
+        ),
+        request_options=_parse_request_options(args, 'api'),
+        get_updates_request_options=_parse_request_options(args,
+                                                           'get-updates'),
         use_webhook=args.use_webhook,
     )
     if options.use_webhook is None:
@@ -76,62 +397,407 @@ def get_startup_options() -> StartupOptions:
             port=args.port,
             url_path=args.url_path,
             webhook_url=args.webhook_url,
+            secret_token=args.secret_token,
+            workers=args.workers,
+        )
+        if args.workers < 1:
+            parser.error('The number of workers must be positive')
+    if args.replay:
+        if args.speed <= 0:
+            parser.error('The speed must be positive')
+        options.replay_options = ReplayOptions(
+            path=args.path,
+            speed=None if args.max_speed else args.speed,
+            api_latency=timedelta(milliseconds=args.api_latency),
+            rate_limit=args.rate_limit,
         )
     return options
 
 
 async def app_post_init(app: Application) -> None:
     """Called after Application was initialized to perform additional set up.
-    Currently, only loads allowed chats from the database"""
-    # Set allowed chats
+    Loads allowed chats, their members and info menus, the penguin
+    leaderboard and pending message deletions from the database and starts
+    background tasks. Runs before updates are fetched or accepted"""
+    # Warm up info menus, set allowed chats and warm up the index of their
+    # members
+    chat_member_index = app.bot_data['chat_member_index']
+    info_menu_cache = app.bot_data['info_menu_cache']
     session = app.bot_data['AsyncSession']()
     async with session:
-        allowed_chat_ids = await list_allowed_chat_ids_usecase(session)
+        # The first joiners after a start get their greetings from cache.
+        # Every allowed chat has an info menu, so they are loaded at once
+        allowed_chat_ids = await info_menu_cache.warm_up(session)
+        chat_member_index.add_chats(allowed_chat_ids)
+        await chat_member_index.warm_up(session)
     app.bot_data['allowed_chat_filter'].add_chat_ids(allowed_chat_ids)
     logger.info(f'Registered allowed chat ids {allowed_chat_ids}')
+    logger.info(f'Cached info menus of {len(allowed_chat_ids)} chats')
+    logger.info(f'Indexed {len(chat_member_index)} chat members')
 
+    # Load the penguin leaderboard and keep it in sync with the db
+    session = app.bot_data['AsyncSession']()
+    async with session:
+        penguin_counts = await count_sent_penguins_usecase(session)
+    app.bot_data['penguin_leaderboard'].load(penguin_counts)
+    app.job_queue.run_repeating(
+        callback=reconcile_penguin_leaderboard,
+        interval=RECONCILE_PENGUIN_LEADERBOARD_EVERY,
+        first=RECONCILE_PENGUIN_LEADERBOARD_EVERY,
+    )
+    logger.info(f'Loaded {len(penguin_counts)} penguin counts')
 
-def setup_sqlalchemy(app: Application) -> None:
-    """Setup sqlalchemy"""
+    app.job_queue.run_repeating(
+        callback=sweep_chat_member_cache,
+        interval=SWEEP_CHAT_MEMBER_CACHE_EVERY,
+        first=SWEEP_CHAT_MEMBER_CACHE_EVERY,
+    )
+
+    # Start write-behind recorders
+    app.bot_data['chat_member_recorder'].start()
+    app.bot_data['penguin_gif_recorder'].start()
+
+    startup_options = app.bot_data['startup_options']
+    if startup_options.metrics_port is not None:
+        app.bot_data['metrics_server'] = await start_metrics_server(
+            host=startup_options.metrics_host,
+            port=startup_options.metrics_port,
+        )
+
+    # Restore pending deletions; overdue ones are deleted right away
+    message_deletion_scheduler = app.bot_data['message_deletion_scheduler']
+    # Workers restore deletions of their own chats only
+    partition = startup_options.partition
+    await message_deletion_scheduler.restore(
+        owns_chat=partition.owns_chat if partition else None,
+    )
+    message_deletion_scheduler.start()
+    app.job_queue.run_repeating(
+        callback=flush_message_deletions,
+        interval=FLUSH_MESSAGE_DELETIONS_EVERY,
+        first=FLUSH_MESSAGE_DELETIONS_EVERY,
+    )
+
+    if 'update_capture' in app.bot_data:
+        app.job_queue.run_repeating(
+            callback=flush_update_capture,
+            interval=FLUSH_UPDATE_CAPTURE_EVERY,
+            first=FLUSH_UPDATE_CAPTURE_EVERY,
+        )
+
+    # Apply chat config changes made in the db as they happen
+    if 'chat_config_listener' in app.bot_data:
+        app.bot_data['chat_config_listener'].start()
+
+
+async def app_post_stop(app: Application) -> None:
+    """Called after Application was stopped, while the bot can still make
+    requests. Greets users, who joined right before the stop"""
+    await app.bot_data['greeting_aggregator'].stop()
+
+
+async def app_post_shutdown(app: Application) -> None:
+    """Called after Application was shut down. Flushes write-behind
+    recorders, persists pending message deletions, closes the update
+    capture and database connections"""
+    chat_config_listener = app.bot_data.get('chat_config_listener')
+    if chat_config_listener:
+        await chat_config_listener.stop()
+
+    message_deletion_scheduler = app.bot_data['message_deletion_scheduler']
+    await message_deletion_scheduler.stop()
+    await message_deletion_scheduler.flush()
+
+    metrics_server = app.bot_data.get('metrics_server')
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await app.bot_data['chat_member_recorder'].stop()
+    logger.info('Flushed chat member recorder')
+    penguin_gif_recorder = app.bot_data['penguin_gif_recorder']
+    await penguin_gif_recorder.stop()
+    logger.info(f'Flushed penguin gif recorder, '
+                f'{penguin_gif_recorder.stats.flushed_items} gifs recorded')
+
+    update_capture = app.bot_data.get('update_capture')
+    if update_capture:
+        update_capture.close()
+        logger.info(f'Captured {update_capture.captured_updates} updates '
+                    f'to {update_capture.path}')
+
+    await dispose_sqlalchemy(app)
+
+
+def get_database_url(startup_options: StartupOptions) -> str:
+    """Returns the url of the database from DATABASE_URL. Replays write
+    to the database and restore and delete its pending message deletions,
+    so they use REPLAY_DATABASE_URL, which must point to a disposable
+    copy, and never fall back to DATABASE_URL"""
+    name = 'DATABASE_URL'
+    if startup_options.replay_options:
+        name = 'REPLAY_DATABASE_URL'
     try:
-        db_url = os.environ['DATABASE_URL']
+        return os.environ[name]
     except KeyError:
-        raise RuntimeError('Environmental variable "DATABASE_URL" is not set.')
-    engine = create_async_engine(url=db_url)
+        raise RuntimeError(f'Environmental variable "{name}" is not set.')
+
+
+def setup_sqlalchemy(app: Application) -> None:
+    """Setup sqlalchemy"""
+    db_url = get_database_url(app.bot_data['startup_options'])
+    options = app.bot_data['startup_options'].database_options
+
+    connect_args = {}
+    if make_url(db_url).get_backend_name() == 'postgresql':
+        if options.connect_timeout is not None:
+            connect_args['connect_timeout'] = options.connect_timeout
+        if options.pgbouncer:
+            # pgbouncer may run the next statement on another server
+            # connection, where the prepared statement does not exist
+            connect_args['prepare_threshold'] = None
+
+    engine = create_async_engine(
+        url=db_url,
+        # Pooling connections of SQLite as well keeps the metrics of
+        # the pool comparable
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        pool_size=options.pool_size,
+        max_overflow=options.max_overflow,
+        pool_timeout=options.pool_timeout,
+        pool_recycle=options.pool_recycle,
+        pool_pre_ping=options.pool_pre_ping,
+        connect_args=connect_args,
+    )
+    instrument_engine(engine)
     sessionmaker = async_sessionmaker(bind=engine, expire_on_commit=False)
     app.bot_data['AsyncSession'] = sessionmaker
 
 
-def main():
-    startup_options = get_startup_options()
+async def dispose_sqlalchemy(app: Application) -> None:
+    """Closes pooled database connections. SQLite connections are pooled
+    as well, and aiosqlite runs each of them in a thread, which would
+    keep the process alive"""
+    await app.bot_data['AsyncSession'].kw['bind'].dispose()
 
-    redirect_standard_logging_to_loguru()
-    disable_low_level_logs()
-    log_lvl = 'INFO' if not startup_options.verbose_logging else 'DEBUG'
-    set_logging_level(log_lvl)
 
-    app = (ApplicationBuilder()
-           .token(os.environ['BOT_TOKEN'])
-           # .get_updates_http_version('2')
-           # .http_version('2')
-           .defaults(Defaults(parse_mode=ParseMode.HTML))
-           .rate_limiter(AIORateLimiter(max_retries=2))
-           .post_init(app_post_init)
-           .build())
+def setup_caches(app: Application) -> None:
+    """Setup caches. Requires sqlalchemy to be set up"""
+    app.bot_data['info_menu_cache'] = InfoMenuCache(
+        sessionmaker=app.bot_data['AsyncSession'],
+    )
+    app.bot_data['penguin_leaderboard'] = PenguinLeaderboard()
+
+
+def setup_recorders(app: Application) -> None:
+    """Setup write-behind recorders. Requires sqlalchemy to be set up"""
+    chat_member_index = ChatMemberIndex()
+    app.bot_data['chat_member_index'] = chat_member_index
+    app.bot_data['chat_member_recorder'] = ChatMemberRecorder(
+        sessionmaker=app.bot_data['AsyncSession'],
+        index=chat_member_index,
+    )
+    app.bot_data['penguin_gif_recorder'] = PenguinGifRecorder(
+        sessionmaker=app.bot_data['AsyncSession'],
+    )
+
+
+def setup_message_deletion(app: Application) -> None:
+    """Setup the message deletion scheduler. Requires sqlalchemy to be
+    set up"""
+    app.bot_data['message_deletion_scheduler'] = MessageDeletionScheduler(
+        bot=app.bot,
+        sessionmaker=app.bot_data['AsyncSession'],
+    )
+
+
+def setup_greetings(app: Application) -> None:
+    """Setup coalescing of greetings. Requires the message deletion
+    scheduler to be set up"""
+    app.bot_data['greeting_aggregator'] = GreetingAggregator(
+        bot=app.bot,
+        message_deletion_scheduler=app.bot_data['message_deletion_scheduler'],
+        delete_after=DELETE_INFO_MENU_AFTER,
+    )
+
+
+def setup_chat_config_listener(app: Application) -> None:
+    """Setup listening for chat config changes, if the database is
+    PostgreSQL. Requires handlers, caches and recorders to be set up"""
+    startup_options = app.bot_data['startup_options']
+    if startup_options.replay_options:
+        # DATABASE_LISTEN_URL may point to another database
+        logger.info('Chat config changes are not listened for in replays')
+        return
+    db_url = get_database_url(startup_options)
+    # LISTEN does not work through pgbouncer in the transaction pooling
+    # mode, so the listener may connect to PostgreSQL directly
+    listen_url = make_url(os.environ.get('DATABASE_LISTEN_URL', db_url))
+    if listen_url.get_backend_name() != 'postgresql':
+        logger.info('Chat config changes are not listened for, as the '
+                    'database is not PostgreSQL')
+        return
+    from knu_fcsc_bot.bot.notifications import ChatConfigListener
+
+    conninfo = listen_url.set(drivername='postgresql').render_as_string(
+        hide_password=False,
+    )
+    app.bot_data['chat_config_listener'] = ChatConfigListener(
+        conninfo=conninfo,
+        on_change=partial(sync_allowed_chat, app.bot_data),
+        on_resync=partial(reload_allowed_chats, app.bot_data),
+    )
+
+
+def setup_update_capture(app: Application) -> None:
+    """Setup capturing of incoming updates, if it is enabled"""
+    capture_path = app.bot_data['startup_options'].capture_path
+    if not capture_path:
+        return
+    from knu_fcsc_bot.capture import UpdateCapture
+
+    app.bot_data['update_capture'] = UpdateCapture(capture_path)
+    # Capture updates before any other handler sees them
+    app.add_handler(TypeHandler(
+        type=Update,
+        callback=capture_update,
+    ), group=-2)
+
+
+def setup_metrics(app: Application) -> None:
+    """Setup metrics of the application. Requires handlers, caches,
+    recorders, the message deletion scheduler and greetings to be set
+    up"""
+    instrument_handlers(app)
+    register_app_metrics(app)
+
+
+def build_application(startup_options: StartupOptions,
+                      token: str,
+                      base_url: str | None = None,
+                      rate_limit: bool = True) -> Application:
+    """Builds the application with all handlers and background services
+    set up. `base_url` overrides the Bot API url, e.g. for a fake Bot API
+    server. If `rate_limit` is False, requests are not throttled to
+    the Telegram flood limits"""
+    request = InstrumentedHTTPXRequest(
+        **asdict(startup_options.request_options),
+    )
+    get_updates_request = InstrumentedHTTPXRequest(
+        **asdict(startup_options.get_updates_request_options),
+    )
+    builder = (ApplicationBuilder()
+               .token(token)
+               .defaults(Defaults(parse_mode=ParseMode.HTML))
+               .request(request)
+               .get_updates_request(get_updates_request)
+               .post_init(app_post_init)
+               .post_stop(app_post_stop)
+               .post_shutdown(app_post_shutdown))
+    if rate_limit:
+        builder.rate_limiter(InstrumentedAIORateLimiter(max_retries=2))
+    if base_url:
+        builder.base_url(base_url)
+    app = builder.build()
 
     # Give the bot access to startup options
     app.bot_data['startup_options'] = startup_options
 
     setup_handlers(app)
     setup_sqlalchemy(app)
+    setup_caches(app)
+    setup_recorders(app)
+    setup_message_deletion(app)
+    setup_greetings(app)
+    setup_chat_config_listener(app)
+    setup_update_capture(app)
+    setup_metrics(app)
+    return app
+
+
+async def replay(startup_options: StartupOptions) -> None:
+    """Replays captured updates against a fake Bot API and prints
+    timings of handlers"""
+    from knu_fcsc_bot.capture import (read_captured_updates, replay_updates,
+                                      format_timing_report, )
+    from knu_fcsc_bot.fake_bot_api import FakeBotApi, FAKE_BOT_TOKEN
+
+    options = startup_options.replay_options
+    updates = list(read_captured_updates(options.path))
+    logger.info(f'Replaying {len(updates)} updates from {options.path}')
+
+    api = FakeBotApi(latency=options.api_latency)
+    await api.start()
+    app = build_application(startup_options,
+                            token=FAKE_BOT_TOKEN,
+                            base_url=api.base_url,
+                            rate_limit=options.rate_limit)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    started_at = time.perf_counter()
+    await replay_updates(app, updates, speed=options.speed)
+    # Waits for handlers running in the background
+    await app.stop()
+    duration = time.perf_counter() - started_at
+
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await api.stop()
+
+    print(f'Replayed {len(updates)} updates in {duration:.2f}s, '
+          f'{len(updates) / duration:.1f} updates/s')
+    print(f'Bot API calls: {dict(api.calls.most_common())}')
+    print(format_timing_report(HANDLER_DURATION))
+
+
+def setup_logging(startup_options: StartupOptions) -> None:
+    """Setup loguru and redirect standard logging to it"""
+    redirect_standard_logging_to_loguru()
+    disable_low_level_logs()
+    log_lvl = 'INFO' if not startup_options.verbose_logging else 'DEBUG'
+    set_logging_level(log_lvl,
+                      json_logs=startup_options.json_logs,
+                      sampling=startup_options.log_sampling)
+
+
+def report_imports() -> None:
+    """Logs the slowest imports of the bot"""
+    from knu_fcsc_bot.importtime import profile_imports, format_import_report
+
+    timings = profile_imports('knu_fcsc_bot.__main__')
+    logger.info(f'The slowest imports of the bot:\n'
+                f'{format_import_report(timings)}')
+
+
+def main():
+    startup_options = get_startup_options()
+    setup_logging(startup_options)
+    if startup_options.import_report:
+        report_imports()
+
+    if startup_options.replay_options:
+        asyncio.run(replay(startup_options))
+        return
+
+    token = os.environ['BOT_TOKEN']
+    if (startup_options.use_webhook
+            and startup_options.webhook_options.workers > 1):
+        from knu_fcsc_bot.workers import run_multi_worker_webhook
+
+        run_multi_worker_webhook(
+            startup_options,
+            token=token,
+            allowed_updates=ALLOWED_UPDATES,
+            build_app=partial(build_application, token=token),
+            setup_logging=setup_logging,
+        )
+        return
+
+    app = build_application(startup_options, token=token)
 
     # Run bot
-    allowed_updates = [
-        UpdateType.CHAT_MEMBER,
-        UpdateType.CALLBACK_QUERY,
-        UpdateType.MESSAGE,
-        UpdateType.MY_CHAT_MEMBER,
-    ]
     if startup_options.use_webhook:
         # using webhook
         app.run_webhook(
@@ -139,10 +805,11 @@ def main():
             port=startup_options.webhook_options.port,
             url_path=startup_options.webhook_options.url_path,
             webhook_url=startup_options.webhook_options.webhook_url,
-            allowed_updates=allowed_updates,
+            secret_token=startup_options.webhook_options.secret_token,
+            allowed_updates=ALLOWED_UPDATES,
         )
     else:
-        app.run_polling(allowed_updates=allowed_updates)
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+import asyncio
+import time
+from collections import OrderedDict, Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Generic, TypeVar, Any
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from knu_fcsc_bot import usecases
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+@dataclass
+class CacheStats:
+    """Hit/miss counters of a cache"""
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of hits among all lookups"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class TTLCache(Generic[K, V]):
+    """A size-bounded cache, which expires entries after `time_to_live`.
+    When full, the least recently used entry is evicted"""
+
+    def __init__(self, max_size: int, time_to_live: timedelta):
+        self.max_size = max_size
+        self.time_to_live = time_to_live
+        self.stats = CacheStats()
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V:
+        """Returns the cached value. Raises KeyError if there is no value
+        or it has expired"""
+        try:
+            expires_at, value = self._entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            raise
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats.misses += 1
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: K, value: V,
+            time_to_live: timedelta | None = None) -> None:
+        """Caches the value, evicting the least recently used entry if
+        the cache is full. `time_to_live` overrides the default one"""
+        time_to_live = time_to_live or self.time_to_live
+        expires_at = time.monotonic() + time_to_live.total_seconds()
+        self._entries[key] = expires_at, value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def remove_expired(self) -> int:
+        """Removes all expired entries. Returns the number of removed
+        entries"""
+        now = time.monotonic()
+        expired_keys = [
+            key
+            for key, (expires_at, _) in self._entries.items()
+            if expires_at < now
+        ]
+        for key in expired_keys:
+            del self._entries[key]
+        return len(expired_keys)
+
+    def remove(self, key: K) -> None:
+        """Removes the entry if it is cached"""
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes all entries"""
+        self._entries.clear()
+
+
+# Marks cached usecases.DoesNotExist results
+_DOES_NOT_EXIST = object()
+
+
+class InfoMenuCache:
+    """A read-through cache of info menu snapshots by chat_id.
+
+    A snapshot holds everything the info menu shows, so any page of
+    the menu is rendered from one cached value. Missing chats are cached
+    as well, so the updates from unsupported chats do not query
+    the database either.
+
+    Concurrent misses of a chat share a single load. A load, which was
+    started before the chat was invalidated, is not cached, since it may
+    have read the old state."""
+
+    DEFAULT_TIME_TO_LIVE = timedelta(minutes=10)
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self,
+                 sessionmaker: async_sessionmaker,
+                 time_to_live: timedelta = DEFAULT_TIME_TO_LIVE,
+                 max_size: int = DEFAULT_MAX_SIZE):
+        self.sessionmaker = sessionmaker
+        self._cache: TTLCache[int, Any] = TTLCache(
+            max_size=max_size,
+            time_to_live=time_to_live,
+        )
+        self._loads: dict[int, asyncio.Future[Any]] = {}
+        # chat_id -> the number of its invalidations
+        self._invalidations: Counter[int] = Counter()
+        self._clears = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._cache.stats
+
+    async def get_info_menu(self, chat_id: int) -> usecases.InfoMenuSnapshot:
+        """Cached usecases.get_info_menu_snapshot_usecase"""
+        try:
+            value = self._cache.get(chat_id)
+        except KeyError:
+            load = self._loads.get(chat_id)
+            if load is None:
+                load = asyncio.ensure_future(self._load(chat_id))
+                self._loads[chat_id] = load
+                load.add_done_callback(
+                    lambda _: self._forget_load(chat_id, load))
+            # Shielding, so that a cancelled caller does not cancel the load
+            # for the others
+            value = await asyncio.shield(load)
+
+        if value is _DOES_NOT_EXIST:
+            raise usecases.DoesNotExist
+        return value
+
+    def _get_generation(self, chat_id: int) -> tuple[int, int]:
+        """Returns a value, which changes whenever the chat is invalidated
+        or the cache is cleared"""
+        return self._clears, self._invalidations[chat_id]
+
+    async def _load(self, chat_id: int) -> Any:
+        generation = self._get_generation(chat_id)
+        async with self.sessionmaker() as session:
+            try:
+                value = await usecases.get_info_menu_snapshot_usecase(
+                    session, chat_id)
+            except usecases.DoesNotExist:
+                value = _DOES_NOT_EXIST
+        if self._get_generation(chat_id) == generation:
+            self._cache.set(chat_id, value)
+        return value
+
+    def _forget_load(self, chat_id: int, load: asyncio.Future) -> None:
+        # A newer load may have replaced it after an invalidation
+        if self._loads.get(chat_id) is load:
+            del self._loads[chat_id]
+
+    async def warm_up(self, session: AsyncSession) -> list[int]:
+        """Caches info menus of all allowed chats, which are loaded with
+        a single query on PostgreSQL, so the first requests after a start
+        do not query the database. Returns ids of the cached chats"""
+        snapshots = await usecases.list_info_menu_snapshots_usecase(session)
+        for snapshot in snapshots:
+            self._cache.set(snapshot.chat_id, snapshot)
+        return [snapshot.chat_id for snapshot in snapshots]
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        """Removes the cached info menu of the chat. Loads in progress
+        are not cached, and the next miss starts a new one"""
+        self._cache.remove(chat_id)
+        self._invalidations[chat_id] += 1
+        self._loads.pop(chat_id, None)
+
+    def clear(self) -> None:
+        """Removes all cached values"""
+        self._cache.clear()
+        self._clears += 1
+        self._invalidations.clear()
+        self._loads.clear()
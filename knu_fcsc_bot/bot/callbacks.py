@@ -1,5 +1,5 @@
 from contextlib import suppress
-from datetime import timedelta
+from datetime import timedelta, datetime, time, date, timezone
 
 from loguru import logger
 from telegram import Update
@@ -12,50 +12,50 @@ from knu_fcsc_bot.bot.utils import (did_new_user_join,
                                     schedule_message_deletion,
                                     reschedule_message_deletion_on_interaction,
                                     get_file_id, is_a_penguin_gif,
-                                    get_cached_chat_member, )
+                                    get_cached_chat_member_names,
+                                    get_cached_chat_member,
+                                    is_chat_administrator, )
+from knu_fcsc_bot.logginig import update_fields
 
 DELETE_INFO_MENU_AFTER = timedelta(minutes=5)
 DELETE_DEV_MESSAGES_AFTER = timedelta(minutes=1)
 DELETE_MISC_MESSAGE_AFTER = timedelta(minutes=3)
 
+TOP_PENGUINS_PERIODS = ('today', 'week', 'campaign')
+
 
 async def unhandled_exception(update: Update | object | None,
                               context: CallbackContext) -> None:
     """Logs unhandled exceptions"""
     message = 'Unhandled exception'
-    if update:
-        # Using of f-string resulted in a wierd exception. So
-        # here update kwarg is passed to the logger.
-        message += ' while processing {update}'
-    logger.exception(message, update=update, exception=context.error)
+    fields = {}
+    if isinstance(update, Update):
+        message += ' while processing update {update_id}'
+        fields = update_fields(update)
+    # The error handler is not called from an except block, so the
+    # exception is passed explicitly
+    logger.opt(exception=context.error).error(message, **fields)
 
 
 async def chat_member_updated(update: Update,
                               context: CallbackContext) -> None:
-    """Sends basic info to a new chat member"""
+    """Greets a new chat member with basic info. Greetings of members,
+    who join at about the same time, are coalesced"""
     user = update.effective_user
     chat = update.effective_chat
     if not did_new_user_join(update.chat_member) or user.is_bot:
         return
-    logger.info(f'{user} joined {chat}')
+    logger.info('User {user_id} joined chat {chat_id}',
+                **update_fields(update))
+
+    info_menu_cache = context.bot_data['info_menu_cache']
+    try:
+        info_menu = await info_menu_cache.get_info_menu(chat.id)
+    except usecases.DoesNotExist:
+        # Ignoring unsupported chat
+        return
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        try:
-            info = await usecases.get_main_abit_chat_info_usecase(session,
-                                                                  chat.id)
-        except usecases.DoesNotExist:
-            # Ignoring unsupported chat
-            return
-
-    markup = markups.get_new_user_greeting_markup(info, user)
-    message = await chat.send_photo(**markup.to_kwargs())
-
-    schedule_message_deletion(
-        job_queue=context.job_queue,
-        message=message,
-        after=DELETE_INFO_MENU_AFTER,
-    )
+    context.bot_data['greeting_aggregator'].add(chat.id, user, info_menu)
 
 
 @reschedule_message_deletion_on_interaction(DELETE_INFO_MENU_AFTER)
@@ -64,13 +64,13 @@ async def cd_programs(update: Update,
     """Lists all available programs for this chat"""
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested program list in {chat}')
+    logger.info('User {user_id} requested program list in chat {chat_id}',
+                **update_fields(update))
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        programs = await usecases.list_programs_usecase(session, chat.id)
+    info_menu_cache = context.bot_data['info_menu_cache']
+    info_menu = await info_menu_cache.get_info_menu(chat.id)
 
-    markup = markups.get_program_list_markup(programs, user)
+    markup = markups.get_program_list_markup(info_menu.programs, user)
     await update.effective_message.edit_caption(**markup.to_kwargs(
         caption_only=True,
     ))
@@ -83,18 +83,18 @@ async def cd_program_by_id(update: Update,
     program_id = int(context.match.group('id'))
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested program with id={program_id} in {chat}')
-
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        try:
-            program = await usecases.get_program_by_id_usecase(session,
-                                                               program_id)
-        except usecases.DoesNotExist:
-            markup = markups.get_program_not_found_alert_markup()
-            await update.callback_query.answer(**markup.to_kwargs(),
-                                               cache_time=60)
-            return
+    logger.info('User {user_id} requested program with id={program_id} in '
+                'chat {chat_id}', program_id=program_id,
+                **update_fields(update))
+
+    info_menu_cache = context.bot_data['info_menu_cache']
+    info_menu = await info_menu_cache.get_info_menu(chat.id)
+    program = info_menu.find_program(program_id)
+    if program is None:
+        markup = markups.get_program_not_found_alert_markup()
+        await update.callback_query.answer(**markup.to_kwargs(),
+                                           cache_time=60)
+        return
 
     markup = markups.get_program_detail_markup(program, user)
     await update.effective_message.edit_caption(**markup.to_kwargs(
@@ -107,16 +107,13 @@ async def cd_main_menu(update: Update, context: CallbackContext) -> None:
     """Displays main page of info menu"""
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested main page of info menu in {chat}')
+    logger.info('User {user_id} requested main page of info menu in chat '
+                '{chat_id}', **update_fields(update))
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        abit_chat_info = await usecases.get_main_abit_chat_info_usecase(
-            session=session,
-            chat_id=chat.id,
-        )
+    info_menu_cache = context.bot_data['info_menu_cache']
+    info_menu = await info_menu_cache.get_info_menu(chat.id)
 
-    markup = markups.get_main_page_of_info_menu_markup(abit_chat_info, user)
+    markup = markups.get_main_page_of_info_menu_markup(info_menu, user)
     await update.effective_message.edit_caption(**markup.to_kwargs(
         caption_only=True,
     ))
@@ -127,14 +124,14 @@ async def cd_useful_links(update: Update, context: CallbackContext) -> None:
     """Displays a list of useful links as an inline keyboard"""
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested useful links in {chat}')
+    logger.info('User {user_id} requested useful links in chat {chat_id}',
+                **update_fields(update))
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        useful_links = await usecases.list_useful_links_usecase(session,
-                                                                chat.id)
+    info_menu_cache = context.bot_data['info_menu_cache']
+    info_menu = await info_menu_cache.get_info_menu(chat.id)
 
-    markup = markups.get_useful_link_list_markup(useful_links, user)
+    markup = markups.get_useful_link_list_markup(info_menu.useful_links,
+                                                 user)
     await update.effective_message.edit_caption(**markup.to_kwargs(
         caption_only=True,
     ))
@@ -146,20 +143,17 @@ async def cd_admission_committe(update: Update,
     """Displays the info about the admission committe"""
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested the info about the admission '
-                f'committe {chat}')
+    logger.info('User {user_id} requested the info about the admission '
+                'committe in chat {chat_id}', **update_fields(update))
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        admission_committe_info = (
-            await usecases.get_admission_committe_info_usecase(
-                session=session,
-                chat_id=chat.id,
-            )
-        )
+    info_menu_cache = context.bot_data['info_menu_cache']
+    info_menu = await info_menu_cache.get_info_menu(chat.id)
+    if info_menu.admission_committe is None:
+        # The button is stale, the committee has been removed
+        return
 
     markup = markups.get_admission_committe_info_markup(
-        admission_committe_info=admission_committe_info,
+        info_menu=info_menu,
         requested_by=user,
     )
     await update.effective_message.edit_caption(
@@ -171,24 +165,21 @@ async def cmd_info(update: Update, context: CallbackContext) -> None:
     """Displays main page of info menu"""
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} requested main page of info menu via /info in {chat}')
+    logger.info('User {user_id} requested main page of info menu via /info '
+                'in chat {chat_id}', **update_fields(update))
+
+    info_menu_cache = context.bot_data['info_menu_cache']
+    try:
+        info_menu = await info_menu_cache.get_info_menu(chat.id)
+    except usecases.DoesNotExist:
+        # Ignoring unsupported chat
+        return
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        try:
-            abit_chat_info = await usecases.get_main_abit_chat_info_usecase(
-                session=session,
-                chat_id=chat.id,
-            )
-        except usecases.DoesNotExist:
-            # Ignoring unsupported chat
-            return
-
-    markup = markups.get_main_page_of_info_menu_markup(abit_chat_info, user)
+    markup = markups.get_main_page_of_info_menu_markup(info_menu, user)
     message = await update.effective_message.reply_photo(**markup.to_kwargs())
 
     schedule_message_deletion(
-        job_queue=context.job_queue,
+        scheduler=context.bot_data['message_deletion_scheduler'],
         message=message,
         after=DELETE_INFO_MENU_AFTER,
         with_reply_to=True,
@@ -197,10 +188,10 @@ async def cmd_info(update: Update, context: CallbackContext) -> None:
 
 async def cmd_file_id(update: Update, context: CallbackContext) -> None:
     """A utility command for displaying the file_id of an attachment"""
-    user = update.effective_user
-    chat = update.effective_chat
     message = update.effective_message
-    logger.info(f'{user} requested file_id of {message} in {chat}')
+    logger.info('User {user_id} requested file_id of message {message_id} '
+                'in chat {chat_id}', message_id=message.message_id,
+                **update_fields(update))
 
     file_id_tuple = get_file_id(message.reply_to_message)
     if file_id_tuple:
@@ -213,9 +204,10 @@ async def cmd_file_id(update: Update, context: CallbackContext) -> None:
 async def message_from_not_allowed_chat(update: Update,
                                         context: CallbackContext) -> None:
     """Logs update from not allowed chat"""
-    message = update.effective_message
-    chat = update.effective_chat
-    logger.info(f'{chat} is not allowed: {message}')
+    # Sampled, as unsupported chats may be flooding
+    logger.info('Chat {chat_id} is not allowed, skipping update '
+                '{update_id}', category='message_from_not_allowed_chat',
+                **update_fields(update))
 
 
 async def my_chat_member_updated(update: Update,
@@ -223,25 +215,81 @@ async def my_chat_member_updated(update: Update,
     """Logs when bot is added to a new chat"""
     if not did_new_user_join(update.my_chat_member):
         return
-    logger.info(f'Bot is added to {update.effective_chat}')
+    logger.info('Bot is added to chat {chat_id}', **update_fields(update))
 
 
-async def cmd_reload_filters(update: Update, context: CallbackContext) -> None:
-    """Reloads allowed chat filter by adding missing chats from the db"""
-    logger.debug('Reloading filters')
-
-    session = context.bot_data['AsyncSession']()
+async def reload_allowed_chats(bot_data: dict) -> list[int]:
+    """Syncs the allowed chat filter and the member index with allowed
+    chats in the db, adding new chats and removing the ones, which are
+    not allowed anymore. Returns ids of all allowed chats"""
+    session = bot_data['AsyncSession']()
     async with session:
         allowed_chat_ids = await usecases.list_allowed_chat_ids_usecase(
             session=session,
         )
 
-    # Adding allowed chat ids to the filter. Chat filter uses a set
-    # internally, so there is no need to check whether these chats
-    # were added before.
-    allowed_chat_filter = context.bot_data['allowed_chat_filter']
+    allowed_chat_filter = bot_data['allowed_chat_filter']
+    removed_chat_ids = allowed_chat_filter.chat_ids - set(allowed_chat_ids)
+    allowed_chat_filter.remove_chat_ids(removed_chat_ids)
+    bot_data['chat_member_index'].remove_chats(removed_chat_ids)
+    # Chat filter uses a set internally, so there is no need to check
+    # whether these chats were added before.
     allowed_chat_filter.add_chat_ids(allowed_chat_ids)
+    bot_data['chat_member_index'].add_chats(allowed_chat_ids)
+    # Newly allowed chats may have been cached as missing
+    for chat_id in (*allowed_chat_ids, *removed_chat_ids):
+        bot_data['info_menu_cache'].invalidate_chat(chat_id)
+    if removed_chat_ids:
+        logger.info(f'Removed chats, which are not allowed anymore: '
+                    f'{list(removed_chat_ids)}')
+    return allowed_chat_ids
+
+
+async def sync_allowed_chat(bot_data: dict, chat_id: int) -> None:
+    """Applies changes of the chat config in the db: adds the chat to or
+    removes it from the allowed chats and drops its cached info menu"""
+    session = bot_data['AsyncSession']()
+    async with session:
+        is_allowed = await usecases.is_allowed_chat_usecase(session, chat_id)
+
+    allowed_chat_filter = bot_data['allowed_chat_filter']
+    was_allowed = chat_id in allowed_chat_filter.chat_ids
+    if is_allowed and not was_allowed:
+        allowed_chat_filter.add_chat_ids(chat_id)
+        bot_data['chat_member_index'].add_chats([chat_id])
+        logger.info(f'Chat {chat_id} is allowed now')
+    elif was_allowed and not is_allowed:
+        allowed_chat_filter.remove_chat_ids(chat_id)
+        bot_data['chat_member_index'].remove_chats([chat_id])
+        logger.info(f'Chat {chat_id} is not allowed anymore')
+    bot_data['info_menu_cache'].invalidate_chat(chat_id)
+    logger.debug(f'Applied config changes of chat {chat_id}')
+
+
+async def purge_info_menu_cache(bot_data: dict) -> None:
+    """Purges the info menu cache"""
+    info_menu_cache = bot_data['info_menu_cache']
+    stats = info_menu_cache.stats
+    logger.info(f'Purging the info menu cache: {len(info_menu_cache)} '
+                f'entries, {stats.hits} hits, {stats.misses} misses')
+    info_menu_cache.clear()
+
+
+def _broadcast_to_workers(context: CallbackContext, command: str) -> None:
+    """Asks other worker processes, if there are any, to apply
+    the command to their state"""
+    worker_link = context.bot_data.get('worker_link')
+    if worker_link:
+        worker_link.broadcast(command)
 
+
+async def cmd_reload_filters(update: Update, context: CallbackContext) -> None:
+    """Syncs allowed chat filter with allowed chats in the db"""
+    logger.debug('Reloading filters')
+
+    await reload_allowed_chats(context.bot_data)
+    _broadcast_to_workers(context, 'reload_filters')
+    allowed_chat_filter = context.bot_data['allowed_chat_filter']
     logger.info(f'Updated allowed chats: {list(allowed_chat_filter.chat_ids)}')
 
     markup = markups.get_filters_reloaded_markup()
@@ -250,7 +298,33 @@ async def cmd_reload_filters(update: Update, context: CallbackContext) -> None:
     )
 
     schedule_message_deletion(
-        job_queue=context.job_queue,
+        scheduler=context.bot_data['message_deletion_scheduler'],
+        message=replied_message,
+        after=DELETE_DEV_MESSAGES_AFTER,
+        with_reply_to=True,
+    )
+
+
+async def cmd_purge_cache(update: Update, context: CallbackContext) -> None:
+    """Purges the info menu cache. Only chat administrators may do it"""
+    if not await is_chat_administrator(update.effective_chat,
+                                       update.effective_user.id):
+        logger.info('User {user_id} is not allowed to purge the cache in '
+                    'chat {chat_id}', **update_fields(update))
+        return
+
+    stats = context.bot_data['info_menu_cache'].stats
+    hits, misses = stats.hits, stats.misses
+    await purge_info_menu_cache(context.bot_data)
+    _broadcast_to_workers(context, 'purge_cache')
+
+    markup = markups.get_cache_purged_markup(hits, misses)
+    replied_message = await update.effective_message.reply_text(
+        **markup.to_kwargs()
+    )
+
+    schedule_message_deletion(
+        scheduler=context.bot_data['message_deletion_scheduler'],
         message=replied_message,
         after=DELETE_DEV_MESSAGES_AFTER,
         with_reply_to=True,
@@ -266,17 +340,21 @@ async def animation_message(update: Update,
 
     user = update.effective_user
     chat = update.effective_chat
-    logger.info(f'{user} sent the penguin gif in {chat}')
+    logger.info('User {user_id} sent the penguin gif in chat {chat_id}',
+                **update_fields(update))
+
+    # The gif is written to the db later by the recorder
+    await context.bot_data['penguin_gif_recorder'].record(
+        user_id=user.id,
+        chat_id=chat.id,
+        timestamp=update.effective_message.date,
+    )
 
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        await usecases.record_penguin_gif_usecase(session=session,
-                                                  user_id=user.id,
-                                                  chat_id=chat.id,
-                                                  timestamp=update.effective_message.date)
-        await session.commit()
+    context.bot_data['penguin_leaderboard'].increment(chat.id, user.id,
+                                                      user.full_name)
 
-    logger.debug(f'Recorded a penguin from {user} in {chat}')
+    logger.debug('Queued a penguin from user {user_id} in chat {chat_id}',
+                 **update_fields(update))
 
 
 async def chat_member_recorder(update: Update,
@@ -288,43 +366,147 @@ async def chat_member_recorder(update: Update,
         # Can not determine the member of the chat
         return
 
+    # The membership is written to the db later by the recorder, which
+    # skips members recorded with the same names
+    context.bot_data['chat_member_recorder'].record(
+        user_id=user.id,
+        chat_id=chat.id,
+        full_name=user.full_name,
+        username=user.username,
+    )
+
+    logger.debug('Buffered user {user_id} as a member of chat {chat_id}',
+                 **update_fields(update))
+
+
+async def reconcile_penguin_leaderboard(context: CallbackContext) -> None:
+    """Corrects the in-memory penguin leaderboard from the database"""
+    penguin_leaderboard = context.bot_data['penguin_leaderboard']
+    # Chats, which get new penguins until the counts are read, are
+    # reconciled next time, as the counts may miss them
+    versions = penguin_leaderboard.versions
+    # Writing queued penguins first, so they are counted in the db
+    await context.bot_data['penguin_gif_recorder'].flush()
+
     session = context.bot_data['AsyncSession']()
     async with session:
-        with suppress(usecases.DoesNotExist):
-            await usecases.record_chat_member(session, user.id, chat.id)
-        await session.commit()
+        counts = await usecases.count_sent_penguins_usecase(session)
 
-    logger.debug(f'Recorded {user} as a member of {chat}')
+    drifted = penguin_leaderboard.reconcile(counts, versions)
+    logger.info(f'Reconciled the penguin leaderboard, {drifted} counts '
+                f'have drifted')
+
+
+async def flush_message_deletions(context: CallbackContext) -> None:
+    """Persists changed message deletions to the database"""
+    await context.bot_data['message_deletion_scheduler'].flush()
+
+
+async def capture_update(update: Update, context: CallbackContext) -> None:
+    """Appends the incoming update to the capture log"""
+    context.bot_data['update_capture'].capture(update)
+
+
+async def flush_update_capture(context: CallbackContext) -> None:
+    """Writes captured updates to the capture log"""
+    context.bot_data['update_capture'].flush()
+
+
+async def _get_top_penguins_period_start(
+        period: str,
+        chat_id: int,
+        context: CallbackContext,
+) -> datetime | None:
+    """Returns the start of the period for /top_penguins in UTC or None
+    if the start of the period is not known. Days start in Kyiv"""
+    now = datetime.now(tz=timezone.utc)
+    if period == 'today':
+        today = now.astimezone(markups.KYIV_TZ).date()
+        return _get_kyiv_day_start(today)
+    if period == 'week':
+        return now - timedelta(weeks=1)
+
+    # The campaign starts on the first day of the admission committee
+    # timetable
+    info_menu_cache = context.bot_data['info_menu_cache']
+    try:
+        info_menu = await info_menu_cache.get_info_menu(chat_id)
+    except usecases.DoesNotExist:
+        return None
+    admission_committe = info_menu.admission_committe
+    if not admission_committe or not admission_committe.timetable:
+        return None
+    return _get_kyiv_day_start(admission_committe.timetable[0].date)
+
+
+def _get_kyiv_day_start(day: date) -> datetime:
+    """Returns the start of the day in Kyiv in UTC"""
+    day_start = datetime.combine(day, time(), tzinfo=markups.KYIV_TZ)
+    return day_start.astimezone(timezone.utc)
+
+
+async def sweep_chat_member_cache(context: CallbackContext) -> None:
+    """Removes expired chat members from the cache"""
+    removed = get_cached_chat_member.remove_expired()
+    stats = get_cached_chat_member.stats
+    logger.info(f'Removed {removed} expired chat members from the cache, '
+                f'{len(get_cached_chat_member)} left, hit rate is '
+                f'{stats.hit_rate:.2f}')
 
 
 async def cmd_top_penguins(update: Update, context: CallbackContext) -> None:
-    """Displays the Top 10 users with the most sent penguin gifs"""
-    user = update.effective_user
+    """Displays the Top 10 users with the most sent penguin gifs. Accepts
+    an optional period: today, week or campaign"""
     chat = update.effective_chat
-    logger.info(f'{user} requested top 10 penguins in {chat}')
-
-    session = context.bot_data['AsyncSession']()
-    async with session:
-        top10 = await usecases.top_users_with_most_sent_penguins_usecase(
-            session=session, chat_id=chat.id)
-    # Getting an actual chat member for each user_id
-    top10 = (
-        (await get_cached_chat_member(chat, user_id), penguin_count)
-        for user_id, penguin_count in top10
-    )
+    period = context.args[0].lower() if context.args else None
+    if period not in TOP_PENGUINS_PERIODS:
+        period = None
+    logger.info('User {user_id} requested top 10 penguins (period={period}) '
+                'in chat {chat_id}', period=period, **update_fields(update))
+
+    since = None
+    if period:
+        since = await _get_top_penguins_period_start(period, chat.id,
+                                                     context)
+        if since is None:
+            # The campaign has no timetable, so the leaderboard of all
+            # the time is shown under its own title
+            period = None
+    if since:
+        # Windowed counts are served from the hourly rollup
+        session = context.bot_data['AsyncSession']()
+        async with session:
+            top10 = await usecases.top_users_with_most_sent_penguins_usecase(
+                session=session, chat_id=chat.id, since=since)
+    else:
+        top10 = context.bot_data['penguin_leaderboard'].top(chat.id, 10)
+    # Asking Telegram only for the users without a recorded name
+    unnamed_user_ids = [
+        user_id
+        for user_id, _, full_name in top10
+        if full_name is None
+    ]
+    fetched_full_names = dict(zip(
+        unnamed_user_ids,
+        await get_cached_chat_member_names(chat=chat,
+                                           user_ids=unnamed_user_ids),
+    ))
     # Building a list of markups.UserPenguinCount
     top10 = [
-        markups.UserPenguinCount(chat_member.user, penguin_count)
-        async for chat_member, penguin_count in top10
+        markups.UserPenguinCount(
+            full_name=full_name or fetched_full_names[user_id],
+            penguin_count=penguin_count,
+        )
+        for user_id, penguin_count, full_name in top10
     ]
 
-    markup = markups.get_top10_users_by_sent_penguins_markup(top10)
+    markup = markups.get_top10_users_by_sent_penguins_markup(top10, period)
     sent_message = await update.effective_message.reply_text(
         **markup.to_kwargs()
     )
 
     schedule_message_deletion(
-        job_queue=context.job_queue,
+        scheduler=context.bot_data['message_deletion_scheduler'],
         message=sent_message,
         after=DELETE_MISC_MESSAGE_AFTER,
         with_reply_to=True,
@@ -335,8 +517,9 @@ async def message_via_forbidden_bot(update: Update,
                                     context: CallbackContext) -> None:
     """Trys to delete a message sent via a forbidden bot"""
     message = update.effective_message
-    logger.info(f'{message.from_user} sent a message via '
-                f'forbidden {message.via_bot}')
+    logger.info('User {user_id} sent a message via forbidden bot '
+                '{via_bot_id} in chat {chat_id}',
+                via_bot_id=message.via_bot.id, **update_fields(update))
 
     with suppress(TelegramError):
         await message.delete()
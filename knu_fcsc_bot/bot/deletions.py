@@ -0,0 +1,284 @@
+import asyncio
+import heapq
+import math
+import time
+from contextlib import suppress
+from datetime import timedelta, datetime, timezone
+from typing import Callable, NamedTuple
+
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from telegram import Bot, Message
+from telegram.error import TelegramError
+
+from knu_fcsc_bot import usecases
+from knu_fcsc_bot.bot.recorders import FlushStats
+
+
+class _PendingDeletion(NamedTuple):
+    """A message scheduled for deletion. reply_to_message_id is set if
+    the message, to which it is a reply, must be deleted as well"""
+    chat_id: int
+    message_id: int
+    reply_to_message_id: int | None = None
+
+
+class MessageDeletionScheduler:
+    """Deletes messages in bulk after a delay.
+
+    Deadlines are rounded up to whole seconds. Messages due in the same
+    second share a slot of a timing wheel, and a single background task
+    deletes every due slot with one deleteMessages call per chat. The bot
+    must support `do_api_request()` (python-telegram-bot 20.8+) for it;
+    otherwise, or if a bulk deletion fails, the messages are deleted one
+    by one. An index of
+    deadlines by message lets rescheduling move a deletion to another slot
+    in O(1).
+
+    Pending deletions survive restarts: scheduling only marks a message
+    dirty, and `flush()` writes the dirty messages to the database. Call
+    `restore()` on startup to load them back; overdue ones are deleted
+    right after `start()`."""
+
+    # The limit of deleteMessages
+    MAX_BATCH_SIZE = 100
+
+    def __init__(self, bot: Bot, sessionmaker: async_sessionmaker):
+        self.bot = bot
+        self.sessionmaker = sessionmaker
+        self.deleted_messages = 0
+        self.failed_bulk_deletions = 0
+        self.stats = FlushStats()
+        # deadline -> (chat_id, message_id) -> pending deletion
+        self._slots: dict[int, dict[tuple[int, int], _PendingDeletion]] = {}
+        # A heap of slot deadlines. It may contain deadlines of slots,
+        # which have been emptied by rescheduling
+        self._deadlines: list[int] = []
+        # (chat_id, message_id) -> deadline of its slot
+        self._deadlines_by_message: dict[tuple[int, int], int] = {}
+        self._schedule_changed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # (chat_id, message_id) of messages changed since the last flush
+        self._dirty: set[tuple[int, int]] = set()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._deadlines_by_message)
+
+    def schedule(self, message: Message, after: timedelta,
+                 with_reply_to: bool = False) -> None:
+        """Schedules message deletion at `now + after`. If `with_reply_to`
+        is True, the message, to which this message is a reply, is also
+        deleted"""
+        reply_to_message_id = None
+        if with_reply_to and message.reply_to_message:
+            reply_to_message_id = message.reply_to_message.message_id
+        pending_deletion = _PendingDeletion(message.chat_id,
+                                            message.message_id,
+                                            reply_to_message_id)
+        self._add(pending_deletion, self._get_deadline(after))
+        self._dirty.add((message.chat_id, message.message_id))
+        logger.debug('Scheduled message {message_id} in chat {chat_id} for '
+                     'deletion (with_reply_to={with_reply_to}) in {after}',
+                     message_id=message.message_id, chat_id=message.chat_id,
+                     with_reply_to=with_reply_to, after=after)
+
+    def reschedule(self, message: Message, after: timedelta) -> bool:
+        """Moves the deletion of an already scheduled message to
+        `now + after`, keeping its `with_reply_to`. Returns False if the
+        message is not scheduled for deletion"""
+        key = message.chat_id, message.message_id
+        old_deadline = self._deadlines_by_message.get(key)
+        if old_deadline is None:
+            return False
+
+        new_deadline = self._get_deadline(after)
+        if new_deadline != old_deadline:
+            self._add(self._slots[old_deadline][key], new_deadline)
+            self._dirty.add(key)
+        logger.debug('Rescheduled message {message_id} in chat {chat_id} for '
+                     'deletion in {after}', message_id=message.message_id,
+                     chat_id=message.chat_id, after=after)
+        return True
+
+    def start(self) -> None:
+        """Starts the background deleter"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background deleter. Messages, which are not due yet,
+        are not deleted"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        logger.info(f'Stopped message deletion scheduler, {len(self)} '
+                    f'messages were pending deletion')
+
+    async def restore(self,
+                      owns_chat: Callable[[int], bool] | None = None,
+                      ) -> None:
+        """Loads persisted deletions from the database with one query.
+        If `owns_chat` is passed, only deletions of the chats it accepts
+        are loaded"""
+        async with self.sessionmaker() as session:
+            deletions = (
+                await usecases.list_scheduled_message_deletions_usecase(
+                    session)
+            )
+        if owns_chat is not None:
+            deletions = [deletion for deletion in deletions
+                         if owns_chat(deletion.chat_id)]
+        now = time.time()
+        overdue = 0
+        for deletion in deletions:
+            deadline = math.ceil(deletion.delete_at.timestamp())
+            overdue += deadline <= now
+            self._add(_PendingDeletion(deletion.chat_id, deletion.message_id,
+                                       deletion.reply_to_message_id),
+                      deadline)
+        logger.info(f'Restored {len(deletions)} pending message deletions, '
+                    f'{overdue} of them are overdue')
+
+    async def flush(self) -> None:
+        """Writes deletions of the messages changed since the last flush
+        to the database. If writing fails, they are flushed next time"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+
+            # Messages, which are not pending anymore, have been deleted
+            deletions = []
+            for key in dirty:
+                deadline = self._deadlines_by_message.get(key)
+                if deadline is None:
+                    continue
+                pending_deletion = self._slots[deadline][key]
+                deletions.append(usecases.MessageDeletion(
+                    chat_id=pending_deletion.chat_id,
+                    message_id=pending_deletion.message_id,
+                    reply_to_message_id=pending_deletion.reply_to_message_id,
+                    delete_at=datetime.fromtimestamp(deadline, timezone.utc),
+                ))
+
+            started_at = time.perf_counter()
+            try:
+                async with self.sessionmaker() as session:
+                    await usecases.save_scheduled_message_deletions_usecase(
+                        session, dirty, deletions)
+                    await session.commit()
+            except SQLAlchemyError:
+                self._dirty |= dirty
+                self.stats.failed_flushes += 1
+                logger.exception(f'Failed to flush {len(dirty)} message '
+                                 f'deletions')
+                return
+            latency = time.perf_counter() - started_at
+            self.stats.observe_flush(len(dirty), latency)
+
+        logger.debug(f'Flushed {len(dirty)} message deletions in '
+                     f'{latency:.3f}s')
+
+    async def delete_due(self) -> None:
+        """Deletes all messages, which are due, in bulk"""
+        now = time.time()
+        message_ids_by_chat: dict[int, list[int]] = {}
+        while self._deadlines and self._deadlines[0] <= now:
+            deadline = heapq.heappop(self._deadlines)
+            for key, pending_deletion in self._slots.pop(deadline,
+                                                         {}).items():
+                del self._deadlines_by_message[key]
+                self._dirty.add(key)
+                message_ids = message_ids_by_chat.setdefault(
+                    pending_deletion.chat_id, [])
+                message_ids.append(pending_deletion.message_id)
+                if pending_deletion.reply_to_message_id is not None:
+                    message_ids.append(pending_deletion.reply_to_message_id)
+
+        await asyncio.gather(*(
+            self._delete_messages(chat_id, message_ids)
+            for chat_id, message_ids in message_ids_by_chat.items()
+        ))
+
+    def _add(self, pending_deletion: _PendingDeletion,
+             deadline: int) -> None:
+        """Puts the deletion into the slot of the deadline, removing it
+        from its previous slot"""
+        key = pending_deletion.chat_id, pending_deletion.message_id
+        old_deadline = self._deadlines_by_message.get(key)
+        if old_deadline is not None:
+            old_slot = self._slots[old_deadline]
+            del old_slot[key]
+            if not old_slot:
+                # Its deadline is skipped when popped from the heap
+                del self._slots[old_deadline]
+        self._deadlines_by_message[key] = deadline
+
+        slot = self._slots.get(deadline)
+        if slot is None:
+            slot = self._slots[deadline] = {}
+            heapq.heappush(self._deadlines, deadline)
+            if self._deadlines[0] == deadline:
+                # The background deleter must wake up earlier
+                self._schedule_changed.set()
+        slot[key] = pending_deletion
+
+    @staticmethod
+    def _get_deadline(after: timedelta) -> int:
+        return math.ceil(time.time() + after.total_seconds())
+
+    async def _run(self) -> None:
+        """Sleeps until the earliest deadline and deletes due messages"""
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(self._deadlines[0] - time.time(), 0)
+            self._schedule_changed.clear()
+            with suppress(TimeoutError):
+                await asyncio.wait_for(self._schedule_changed.wait(),
+                                       timeout=timeout)
+            try:
+                await self.delete_due()
+            except Exception:
+                logger.exception('Failed to delete due messages')
+
+    async def _delete_messages(self, chat_id: int,
+                               message_ids: list[int]) -> None:
+        """Deletes messages with deleteMessages in batches, falling back to
+        deleting them one by one"""
+        if not hasattr(self.bot, 'do_api_request'):
+            # deleteMessages has no wrapper, and Bot can not make arbitrary
+            # requests before python-telegram-bot 20.8
+            await self._delete_one_by_one(chat_id, message_ids)
+            return
+
+        for start in range(0, len(message_ids), self.MAX_BATCH_SIZE):
+            batch = message_ids[start:start + self.MAX_BATCH_SIZE]
+            try:
+                await self.bot.do_api_request('deleteMessages', api_kwargs={
+                    'chat_id': chat_id,
+                    'message_ids': batch,
+                })
+            except TelegramError as e:
+                self.failed_bulk_deletions += 1
+                logger.warning(f'Failed to delete {len(batch)} messages in '
+                               f'chat {chat_id} at once: {e}')
+                await self._delete_one_by_one(chat_id, batch)
+            else:
+                self.deleted_messages += len(batch)
+                logger.info(f'Deleted {len(batch)} messages in chat '
+                            f'{chat_id}')
+
+    async def _delete_one_by_one(self, chat_id: int,
+                                 message_ids: list[int]) -> None:
+        for message_id in message_ids:
+            try:
+                await self.bot.delete_message(chat_id, message_id)
+            except TelegramError as e:
+                logger.warning(f'Failed to delete message {message_id} in '
+                               f'chat {chat_id}: {e}')
+            else:
+                self.deleted_messages += 1
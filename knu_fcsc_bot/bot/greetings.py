@@ -0,0 +1,221 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from loguru import logger
+from telegram import Bot, Message, User
+from telegram.error import TelegramError
+
+from knu_fcsc_bot.bot import markups
+from knu_fcsc_bot.bot.deletions import MessageDeletionScheduler
+from knu_fcsc_bot.bot.utils import schedule_message_deletion
+from knu_fcsc_bot.usecases import InfoMenuSnapshot
+
+
+@dataclass
+class GreetingStats:
+    """Counters of coalesced greetings"""
+    joins: int = 0
+    sent_greetings: int = 0
+    edited_greetings: int = 0
+    failed_greetings: int = 0
+    # Greetings delayed by the per-chat rate limit
+    rate_limited_greetings: int = 0
+
+
+@dataclass
+class _ChatGreetings:
+    """Greeting state of a chat"""
+    # user_id -> user, who joined and is not greeted yet
+    pending: dict[int, User] = field(default_factory=dict)
+    # The latest info menu, from which greetings are built
+    info_menu: InfoMenuSnapshot | None = None
+    task: asyncio.Task | None = None
+    last_greeting: Message | None = None
+    # All users of the last greeting, mentioned or only counted
+    last_greeted: list[User] = field(default_factory=list)
+    last_greeting_sent_at: float = 0.0
+    # Monotonic times of greetings sent or edited in the last minute
+    greeted_at: deque[float] = field(default_factory=deque)
+
+
+class GreetingAggregator:
+    """Coalesces greetings of users, who join a chat in bursts.
+
+    Joins are collected per chat for `join_window`, and then one greeting
+    mentions up to `max_mentions` of them; the rest are only counted. If
+    more users join within `edit_window` after a greeting, which has
+    mentions to spare, it is edited in place instead of sending another
+    one. At most `max_greetings_per_minute` greetings are sent or edited
+    in a chat; joins after that wait for the limit and are greeted
+    together. Greetings are deleted `delete_after` the last change.
+    Call `stop()` before the bot shuts down to greet pending users."""
+
+    DEFAULT_JOIN_WINDOW = timedelta(seconds=3)
+    DEFAULT_EDIT_WINDOW = timedelta(minutes=1)
+    DEFAULT_MAX_MENTIONS = 10
+    DEFAULT_MAX_GREETINGS_PER_MINUTE = 6
+
+    def __init__(self,
+                 bot: Bot,
+                 message_deletion_scheduler: MessageDeletionScheduler,
+                 delete_after: timedelta,
+                 join_window: timedelta = DEFAULT_JOIN_WINDOW,
+                 edit_window: timedelta = DEFAULT_EDIT_WINDOW,
+                 max_mentions: int = DEFAULT_MAX_MENTIONS,
+                 max_greetings_per_minute: int = (
+                         DEFAULT_MAX_GREETINGS_PER_MINUTE)):
+        self.bot = bot
+        self.message_deletion_scheduler = message_deletion_scheduler
+        self.delete_after = delete_after
+        self.join_window = join_window
+        self.edit_window = edit_window
+        self.max_mentions = max_mentions
+        self.max_greetings_per_minute = max_greetings_per_minute
+        self.stats = GreetingStats()
+        self._chats: dict[int, _ChatGreetings] = {}
+        # Pending users are greeted without waiting once it is set
+        self._stopping = asyncio.Event()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of users waiting to be greeted"""
+        return sum(len(chat.pending) for chat in self._chats.values())
+
+    def add(self, chat_id: int, user: User,
+            info_menu: InfoMenuSnapshot) -> None:
+        """Adds the user, who has joined the chat, to its next greeting"""
+        chat = self._chats.setdefault(chat_id, _ChatGreetings())
+        chat.pending[user.id] = user
+        chat.info_menu = info_menu
+        self.stats.joins += 1
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._run(chat_id, chat))
+
+    async def stop(self) -> None:
+        """Greets pending users right away, skipping the join window and
+        the rate limit, and waits until they are greeted"""
+        self._stopping.set()
+        tasks = [chat.task for chat in self._chats.values() if chat.task]
+        await asyncio.gather(*tasks)
+        logger.info(f'Stopped greeting aggregator, '
+                    f'{self.stats.sent_greetings} greetings were sent for '
+                    f'{self.stats.joins} joins')
+
+    async def _run(self, chat_id: int, chat: _ChatGreetings) -> None:
+        """Greets pending users of the chat after the join window, until
+        nobody is pending"""
+        try:
+            while chat.pending:
+                await self._sleep(self.join_window)
+                delay = self._get_rate_limit_delay(chat)
+                if delay > 0 and not self._stopping.is_set():
+                    self.stats.rate_limited_greetings += 1
+                    logger.debug(f'Delaying greeting in chat {chat_id} by '
+                                 f'{delay:.1f}s due to the rate limit')
+                    await self._sleep(timedelta(seconds=delay))
+                users = list(chat.pending.values())
+                chat.pending.clear()
+                try:
+                    await self._greet(chat_id, chat, users)
+                except Exception:
+                    logger.exception(f'Failed to greet {len(users)} users '
+                                     f'in chat {chat_id}')
+        finally:
+            chat.task = None
+
+    async def _sleep(self, duration: timedelta) -> None:
+        """Sleeps for the duration or until the aggregator is stopped"""
+        with suppress(TimeoutError):
+            await asyncio.wait_for(self._stopping.wait(),
+                                   timeout=duration.total_seconds())
+
+    def _get_rate_limit_delay(self, chat: _ChatGreetings) -> float:
+        """Returns seconds until the chat may be greeted again"""
+        now = time.monotonic()
+        while chat.greeted_at and chat.greeted_at[0] <= now - 60:
+            chat.greeted_at.popleft()
+        if len(chat.greeted_at) < self.max_greetings_per_minute:
+            return 0
+        return chat.greeted_at[0] + 60 - now
+
+    async def _greet(self, chat_id: int, chat: _ChatGreetings,
+                     users: list[User]) -> None:
+        """Edits the last greeting of the chat to add the users, if it is
+        recent and has mentions to spare, or sends a new one"""
+        since_last_greeting = time.monotonic() - chat.last_greeting_sent_at
+        if (chat.last_greeting is not None
+                and since_last_greeting < self.edit_window.total_seconds()
+                and len(chat.last_greeted) < self.max_mentions):
+            # Users may rejoin within the edit window
+            greeted_ids = {user.id for user in chat.last_greeted}
+            users = [user for user in users if user.id not in greeted_ids]
+            if not users:
+                return
+            if await self._edit_last_greeting(chat, users):
+                return
+        await self._send_greeting(chat_id, chat, users)
+
+    def _build_markup(self, chat: _ChatGreetings,
+                      users: list[User]) -> markups.PhotoMarkup:
+        return markups.get_new_users_greeting_markup(
+            info_menu=chat.info_menu,
+            users=users[:self.max_mentions],
+            not_mentioned=max(len(users) - self.max_mentions, 0),
+        )
+
+    async def _send_greeting(self, chat_id: int, chat: _ChatGreetings,
+                             users: list[User]) -> None:
+        markup = self._build_markup(chat, users)
+        chat.greeted_at.append(time.monotonic())
+        try:
+            message = await self.bot.send_photo(chat_id=chat_id,
+                                                **markup.to_kwargs())
+        except TelegramError as e:
+            self.stats.failed_greetings += 1
+            logger.warning(f'Failed to greet {len(users)} users in chat '
+                           f'{chat_id}: {e}')
+            return
+        self.stats.sent_greetings += 1
+        chat.last_greeting = message
+        chat.last_greeted = users
+        chat.last_greeting_sent_at = time.monotonic()
+        logger.info(f'Greeted {len(users)} users in chat {chat_id}')
+
+        schedule_message_deletion(
+            scheduler=self.message_deletion_scheduler,
+            message=message,
+            after=self.delete_after,
+        )
+
+    async def _edit_last_greeting(self, chat: _ChatGreetings,
+                                  users: list[User]) -> bool:
+        """Adds the users to the last greeting. Returns False if it could
+        not be edited, e.g. because it has been deleted"""
+        message = chat.last_greeting
+        greeted = chat.last_greeted + users
+        markup = self._build_markup(chat, greeted)
+        chat.greeted_at.append(time.monotonic())
+        try:
+            await self.bot.edit_message_caption(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                **markup.to_kwargs(caption_only=True),
+            )
+        except TelegramError as e:
+            self.stats.failed_greetings += 1
+            logger.warning(f'Failed to edit greeting {message.message_id} '
+                           f'in chat {message.chat_id}: {e}')
+            chat.last_greeting = None
+            return False
+        self.stats.edited_greetings += 1
+        chat.last_greeted = greeted
+        logger.info(f'Added {len(users)} users to greeting '
+                    f'{message.message_id} in chat {message.chat_id}')
+
+        # The greeting is kept as long as a new one would be
+        self.message_deletion_scheduler.reschedule(message, self.delete_after)
+        return True
@@ -99,6 +99,12 @@ def setup_handlers(app: Application) -> None:
             callback=callbacks.cmd_reload_filters,
             block=False,
         ),
+        CommandHandler(
+            command='purge_cache',
+            callback=callbacks.cmd_purge_cache,
+            filters=filters.ChatType.GROUPS,
+            block=False,
+        ),
         CommandHandler(
             command='top_penguins',
             callback=callbacks.cmd_top_penguins,
@@ -0,0 +1,375 @@
+import time
+from functools import wraps
+from typing import Any, Callable
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import (QueuePool, AsyncAdaptedQueuePool,
+                             PoolProxiedConnection, )
+from telegram import Update
+from telegram.ext import (Application, AIORateLimiter, ApplicationHandlerStop,
+                          CallbackContext, )
+from telegram.request import HTTPXRequest
+
+from knu_fcsc_bot.bot.utils import get_cached_chat_member
+from knu_fcsc_bot.metrics import (REGISTRY, Counter, Histogram,
+                                  CollectedMetric, )
+
+HANDLER_DURATION = REGISTRY.register(Histogram(
+    'bot_handler_duration_seconds',
+    'Time spent in update handler callbacks',
+    labelnames=('handler',),
+))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'bot_handler_errors_total',
+    'Exceptions raised by update handler callbacks',
+    labelnames=('handler',),
+))
+DB_QUERY_DURATION = REGISTRY.register(Histogram(
+    'bot_db_query_duration_seconds',
+    'Time spent executing SQL statements',
+    labelnames=('statement',),
+))
+DB_CONNECTION_CHECKOUT_DURATION = REGISTRY.register(Histogram(
+    'bot_db_connection_checkout_duration_seconds',
+    'Time pooled database connections stay checked out',
+))
+DB_POOL_CHECKOUT_WAIT_DURATION = REGISTRY.register(Histogram(
+    'bot_db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the database pool',
+))
+DB_POOL_CHECKOUT_TIMEOUTS = REGISTRY.register(Counter(
+    'bot_db_pool_checkout_timeouts_total',
+    'Checkouts, which timed out waiting for a connection from the pool',
+))
+TELEGRAM_API_REQUEST_DURATION = REGISTRY.register(Histogram(
+    'bot_telegram_api_request_duration_seconds',
+    'Latency of Bot API requests',
+    labelnames=('method',),
+))
+TELEGRAM_API_REQUEST_ERRORS = REGISTRY.register(Counter(
+    'bot_telegram_api_request_errors_total',
+    'Bot API requests, which failed without a response',
+    labelnames=('method',),
+))
+TELEGRAM_API_POOL_WAIT_DURATION = REGISTRY.register(Histogram(
+    'bot_telegram_api_pool_wait_seconds',
+    'Time Bot API requests wait for a connection from the HTTP pool',
+    labelnames=('method',),
+))
+TELEGRAM_API_CONNECTIONS_OPENED = REGISTRY.register(Counter(
+    'bot_telegram_api_connections_opened_total',
+    'Connections opened to the Bot API',
+))
+RATE_LIMITER_WAIT_DURATION = REGISTRY.register(Histogram(
+    'bot_rate_limiter_wait_seconds',
+    'Time Bot API requests wait in the rate limiter',
+    labelnames=('method',),
+))
+
+_Callback = Callable[[Update, CallbackContext], Any]
+
+
+def _instrument_callback(callback: _Callback) -> _Callback:
+    """Wraps a handler callback to observe its duration and errors"""
+    handler_name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext) -> Any:
+        started_at = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(handler_name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started_at,
+                                     handler_name)
+
+    return wrapper
+
+
+def instrument_handlers(app: Application) -> None:
+    """Instruments callbacks of all handlers added to the application"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = _instrument_callback(handler.callback)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Observes statement durations and connection checkouts of the
+    engine and exposes the state of its pool"""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        # Kept on the execution context, so a failed statement does not
+        # leave its start behind
+        context.query_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        started_at = context.query_started_at
+        # Labelling by the statement kind keeps the label set small
+        statement_kind = statement.lstrip().split(None, 1)[0].upper()
+        DB_QUERY_DURATION.observe(time.perf_counter() - started_at,
+                                  statement_kind)
+
+    @event.listens_for(sync_engine.pool, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out_at'] = time.perf_counter()
+
+    @event.listens_for(sync_engine.pool, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is not None:
+            DB_CONNECTION_CHECKOUT_DURATION.observe(
+                time.perf_counter() - checked_out_at)
+
+    def collect_pool_state():
+        pool = sync_engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        yield ('size',), pool.size()
+        yield ('checked_out',), pool.checkedout()
+        yield ('checked_in',), pool.checkedin()
+        yield ('overflow',), pool.overflow()
+
+    REGISTRY.register(CollectedMetric(
+        'bot_db_pool_connections',
+        'Connections of the database pool',
+        type='gauge',
+        collect=collect_pool_state,
+        labelnames=('state',),
+    ))
+
+
+class InstrumentedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool, which observes how long checkouts wait for
+    a connection. Opening a new connection is counted as waiting"""
+
+    def connect(self) -> PoolProxiedConnection:
+        started_at = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            DB_POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_WAIT_DURATION.observe(
+                time.perf_counter() - started_at)
+
+
+# httpcore trace events, one of which happens first once a request got
+# a connection from the pool: a new connection is opened or the request
+# is sent over an existing one
+_CONNECTION_ACQUIRED_EVENTS = ('connection.connect_tcp.started',
+                               'http11.send_request_headers.started',
+                               'http2.send_request_headers.started', )
+
+
+async def _trace_pool_wait(request: httpx.Request) -> None:
+    """An httpx request hook, which observes how long the request waits
+    for a connection through the trace extension of httpcore"""
+    api_method = request.url.path.rsplit('/', 1)[-1]
+    requested_at = time.perf_counter()
+    acquired = False
+
+    async def trace(event_name: str, info: dict[str, Any]) -> None:
+        nonlocal acquired
+        if not acquired and event_name in _CONNECTION_ACQUIRED_EVENTS:
+            acquired = True
+            TELEGRAM_API_POOL_WAIT_DURATION.observe(
+                time.perf_counter() - requested_at, api_method)
+        if event_name == 'connection.connect_tcp.complete':
+            TELEGRAM_API_CONNECTIONS_OPENED.inc()
+
+    request.extensions['trace'] = trace
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, which observes the latency of Bot API requests and
+    how long they wait for a connection"""
+
+    def _build_client(self) -> httpx.AsyncClient:
+        client = super()._build_client()
+        client.event_hooks = {'request': [_trace_pool_wait]}
+        return client
+
+    async def do_request(self, url: str, method: str, *args,
+                         **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started_at = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            TELEGRAM_API_REQUEST_ERRORS.inc(api_method)
+            raise
+        finally:
+            TELEGRAM_API_REQUEST_DURATION.observe(
+                time.perf_counter() - started_at, api_method)
+
+
+class InstrumentedAIORateLimiter(AIORateLimiter):
+    """AIORateLimiter, which observes how long requests wait for it"""
+
+    async def process_request(self, callback, args, kwargs, endpoint, data,
+                              rate_limit_args):
+        requested_at = time.perf_counter()
+        waited = False
+
+        async def timed_callback(*callback_args, **callback_kwargs):
+            nonlocal waited
+            if not waited:
+                # Retries are not counted as waiting
+                waited = True
+                RATE_LIMITER_WAIT_DURATION.observe(
+                    time.perf_counter() - requested_at, endpoint)
+            return await callback(*callback_args, **callback_kwargs)
+
+        return await super().process_request(timed_callback, args, kwargs,
+                                             endpoint, data, rate_limit_args)
+
+
+def register_app_metrics(app: Application) -> None:
+    """Exposes queue depths, caches and write-behind buffers of the
+    application. Values are read from bot_data on every scrape"""
+    bot_data = app.bot_data
+
+    def collect_queue_depths():
+        yield ('job_queue',), len(app.job_queue.jobs())
+        yield ('update_queue',), app.update_queue.qsize()
+        yield ('chat_member_recorder',), (
+            bot_data['chat_member_recorder'].queue_depth)
+        yield ('penguin_gif_recorder',), (
+            bot_data['penguin_gif_recorder'].queue_depth)
+        yield ('message_deletion_scheduler',), (
+            len(bot_data['message_deletion_scheduler']))
+        yield ('greeting_aggregator',), (
+            bot_data['greeting_aggregator'].queue_depth)
+
+    def iter_flush_stats():
+        yield 'chat_member_recorder', bot_data['chat_member_recorder'].stats
+        yield 'penguin_gif_recorder', bot_data['penguin_gif_recorder'].stats
+        yield 'message_deletion_scheduler', (
+            bot_data['message_deletion_scheduler'].stats)
+
+    def collect_greetings():
+        stats = bot_data['greeting_aggregator'].stats
+        yield ('sent',), stats.sent_greetings
+        yield ('edited',), stats.edited_greetings
+        yield ('failed',), stats.failed_greetings
+
+    def iter_cache_stats():
+        yield 'chat_member', get_cached_chat_member.stats
+        yield 'info_menu', bot_data['info_menu_cache'].stats
+
+    def collect_cache_hits():
+        for cache, stats in iter_cache_stats():
+            yield (cache,), stats.hits
+        yield ('chat_member_index',), bot_data['chat_member_index'].hits
+
+    def collect_cache_misses():
+        for cache, stats in iter_cache_stats():
+            yield (cache,), stats.misses
+        yield ('chat_member_index',), bot_data['chat_member_index'].misses
+
+    def collect_cache_sizes():
+        yield ('chat_member',), len(get_cached_chat_member)
+        yield ('info_menu',), len(bot_data['info_menu_cache'])
+        yield ('chat_member_index',), len(bot_data['chat_member_index'])
+
+    metrics = [
+        CollectedMetric(
+            'bot_queue_depth',
+            'Items waiting in queues and write-behind buffers',
+            type='gauge',
+            collect=collect_queue_depths,
+            labelnames=('queue',),
+        ),
+        CollectedMetric(
+            'bot_flushes_total',
+            'Flushes of write-behind buffers',
+            type='counter',
+            collect=lambda: (((name,), stats.flushes)
+                             for name, stats in iter_flush_stats()),
+            labelnames=('buffer',),
+        ),
+        CollectedMetric(
+            'bot_failed_flushes_total',
+            'Failed flushes of write-behind buffers',
+            type='counter',
+            collect=lambda: (((name,), stats.failed_flushes)
+                             for name, stats in iter_flush_stats()),
+            labelnames=('buffer',),
+        ),
+        CollectedMetric(
+            'bot_flushed_items_total',
+            'Items written by write-behind buffers',
+            type='counter',
+            collect=lambda: (((name,), stats.flushed_items)
+                             for name, stats in iter_flush_stats()),
+            labelnames=('buffer',),
+        ),
+        CollectedMetric(
+            'bot_deleted_messages_total',
+            'Messages deleted by the message deletion scheduler',
+            type='counter',
+            collect=lambda: [(
+                (), bot_data['message_deletion_scheduler'].deleted_messages,
+            )],
+        ),
+        CollectedMetric(
+            'bot_greeting_joins_total',
+            'Joins of users to be greeted',
+            type='counter',
+            collect=lambda: [(
+                (), bot_data['greeting_aggregator'].stats.joins,
+            )],
+        ),
+        CollectedMetric(
+            'bot_greetings_total',
+            'Greetings sent or edited to add users, who joined later',
+            type='counter',
+            collect=collect_greetings,
+            labelnames=('result',),
+        ),
+        CollectedMetric(
+            'bot_rate_limited_greetings_total',
+            'Greetings delayed by the per-chat rate limit',
+            type='counter',
+            collect=lambda: [(
+                (),
+                bot_data['greeting_aggregator'].stats.rate_limited_greetings,
+            )],
+        ),
+        CollectedMetric(
+            'bot_cache_hits_total',
+            'Cache lookups, which were answered from the cache',
+            type='counter',
+            collect=collect_cache_hits,
+            labelnames=('cache',),
+        ),
+        CollectedMetric(
+            'bot_cache_misses_total',
+            'Cache lookups, which were not answered from the cache',
+            type='counter',
+            collect=collect_cache_misses,
+            labelnames=('cache',),
+        ),
+        CollectedMetric(
+            'bot_cache_entries',
+            'Entries in caches',
+            type='gauge',
+            collect=collect_cache_sizes,
+            labelnames=('cache',),
+        ),
+    ]
+    for metric in metrics:
+        REGISTRY.register(metric)
@@ -0,0 +1,165 @@
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator
+
+from knu_fcsc_bot import usecases
+
+
+class _ChatLeaderboard:
+    """Penguin counts of a single chat, ordered by the count.
+
+    Users are grouped into buckets by their count, and the distinct counts
+    are kept sorted, so incrementing a count touches only two buckets and
+    the top N is read without sorting. Users with equal counts are ordered
+    by the time they reached the count."""
+
+    def __init__(self):
+        self._counts: dict[int, int] = {}
+        self._full_names: dict[int, str] = {}
+        # dicts are used as insertion-ordered sets
+        self._buckets: dict[int, dict[int, None]] = {}
+        self._distinct_counts: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._counts)
+
+    def get(self, user_id: int) -> int:
+        """Returns the number of penguins sent by the user"""
+        return self._counts.get(user_id, 0)
+
+    def increment(self, user_id: int, by: int = 1,
+                  full_name: str | None = None) -> None:
+        """Increments the number of penguins sent by the user and
+        remembers the name of the user if it is given"""
+        if full_name is not None:
+            self._full_names[user_id] = full_name
+        old_count = self._counts.get(user_id, 0)
+        if old_count:
+            self._remove_from_bucket(user_id, old_count)
+        new_count = old_count + by
+        self._counts[user_id] = new_count
+        self._add_to_bucket(user_id, new_count)
+
+    def top(self, number: int) -> list[usecases.UserPenguinCount]:
+        """Returns `number` users with the most sent penguins in
+        descending order"""
+        top = []
+        for count in reversed(self._distinct_counts):
+            for user_id in self._buckets[count]:
+                if len(top) == number:
+                    return top
+                top.append(usecases.UserPenguinCount(
+                    user_id, count, self._full_names.get(user_id)))
+        return top
+
+    def _add_to_bucket(self, user_id: int, count: int) -> None:
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = {}
+            insort(self._distinct_counts, count)
+        bucket[user_id] = None
+
+    def _remove_from_bucket(self, user_id: int, count: int) -> None:
+        bucket = self._buckets[count]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[count]
+            del self._distinct_counts[bisect_left(self._distinct_counts,
+                                                  count)]
+
+
+class PenguinLeaderboard:
+    """An in-memory leaderboard of penguin senders in every chat.
+
+    It is loaded from the database once and then incremented for every
+    new penguin, so the top users are returned without any I/O. Call
+    `reconcile()` periodically to correct a drift from the database."""
+
+    def __init__(self):
+        self._chats: dict[int, _ChatLeaderboard] = {}
+        # chat_id -> the number of increments in the chat
+        self._versions: dict[int, int] = {}
+
+    @property
+    def versions(self) -> dict[int, int]:
+        """A snapshot of the number of increments in every chat. Take it
+        before counting penguins in the database and pass it to
+        `reconcile()`"""
+        return dict(self._versions)
+
+    def increment(self, chat_id: int, user_id: int,
+                  full_name: str | None = None) -> None:
+        """Records a new penguin sent by the user in the chat"""
+        chat_leaderboard = self._chats.get(chat_id)
+        if chat_leaderboard is None:
+            chat_leaderboard = self._chats[chat_id] = _ChatLeaderboard()
+        chat_leaderboard.increment(user_id, full_name=full_name)
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def top(self, chat_id: int,
+            number: int = 10) -> list[usecases.UserPenguinCount]:
+        """Returns top users with the most sent penguins in the chat"""
+        chat_leaderboard = self._chats.get(chat_id)
+        if chat_leaderboard is None:
+            return []
+        return chat_leaderboard.top(number)
+
+    def load(self,
+             counts: Iterable[usecases.ChatMemberPenguinCount]) -> None:
+        """Replaces all counts with the given ones"""
+        self._chats = {
+            chat_id: self._build_chat_leaderboard(chat_counts)
+            for chat_id, chat_counts in self._group_by_chat(counts).items()
+        }
+
+    def reconcile(self,
+                  counts: Iterable[usecases.ChatMemberPenguinCount],
+                  versions: dict[int, int]) -> int:
+        """Replaces counts of every chat with the given ones like `load()`.
+        Chats, which have been incremented since `versions` were taken,
+        are skipped, as the given counts may miss their new penguins.
+        Returns the number of (chat_id, user_id) counts that have
+        drifted"""
+        counts_by_chat = self._group_by_chat(counts)
+        drifted = 0
+        for chat_id in self._chats.keys() | counts_by_chat.keys():
+            if self._versions.get(chat_id, 0) != versions.get(chat_id, 0):
+                continue
+            chat_counts = counts_by_chat.get(chat_id, [])
+            chat_leaderboard = self._chats.get(chat_id, _ChatLeaderboard())
+            drifted += sum(
+                1
+                for _, user_id, penguin_count, _ in chat_counts
+                if chat_leaderboard.get(user_id) != penguin_count
+            )
+            # Counts missing in the database have drifted as well
+            counted_users = {user_id for _, user_id, _, _ in chat_counts}
+            drifted += sum(1 for user_id in chat_leaderboard
+                           if user_id not in counted_users)
+            if chat_counts:
+                self._chats[chat_id] = self._build_chat_leaderboard(
+                    chat_counts)
+            else:
+                self._chats.pop(chat_id, None)
+        return drifted
+
+    @staticmethod
+    def _group_by_chat(
+            counts: Iterable[usecases.ChatMemberPenguinCount],
+    ) -> dict[int, list[usecases.ChatMemberPenguinCount]]:
+        counts_by_chat = {}
+        for count in counts:
+            counts_by_chat.setdefault(count.chat_id, []).append(count)
+        return counts_by_chat
+
+    @staticmethod
+    def _build_chat_leaderboard(
+            counts: list[usecases.ChatMemberPenguinCount],
+    ) -> _ChatLeaderboard:
+        chat_leaderboard = _ChatLeaderboard()
+        for _, user_id, penguin_count, full_name in counts:
+            chat_leaderboard.increment(user_id, by=penguin_count,
+                                       full_name=full_name)
+        return chat_leaderboard
@@ -1,15 +1,16 @@
 import datetime
 import html
-from dataclasses import dataclass, asdict
-from typing import Any, NamedTuple, Protocol
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from typing import Any, NamedTuple, Protocol, Callable, TypeVar, Sequence
 from zoneinfo import ZoneInfo
 
 from telegram import (User, InlineKeyboardMarkup, InlineKeyboardButton,
                       PhotoSize, )
 from telegram._utils.types import ReplyMarkup, FileInput
 
-from knu_fcsc_bot.models import (AbitChatInfo, Program, UsefulLink,
-                                 AdmissionCommitteInfo, )
+from knu_fcsc_bot.usecases import (InfoMenuSnapshot, ProgramSnapshot,
+                                   UsefulLinkSnapshot, )
 
 KYIV_TZ = ZoneInfo('Europe/Kyiv')
 
@@ -18,10 +19,11 @@ KYIV_TZ = ZoneInfo('Europe/Kyiv')
 class BaseMarkup:
     def to_kwargs(self) -> dict[str, Any]:
         """Converts this markup into keyword arguments for ptb bot methods"""
+        # Not using dataclasses.asdict(), as it deep copies reply markups
         return {
-            name: value
-            for name, value in asdict(self).items()
-            if value is not None
+            field.name: getattr(self, field.name)
+            for field in fields(self)
+            if getattr(self, field.name) is not None
         }
 
 
@@ -56,8 +58,92 @@ class AlertMarkup(BaseMarkup):
     show_alert: bool = None
 
 
+@dataclass(frozen=True)
+class _CaptionTemplate:
+    """A pre-rendered caption split around the mention of a user"""
+    before_mention: str
+    after_mention: str = ''
+
+    def render(self, user: User) -> str:
+        return self.render_mentions(user.mention_html())
+
+    def render_mentions(self, mentions: str) -> str:
+        return self.before_mention + mentions + self.after_mention
+
+
+@dataclass(frozen=True)
+class _PhotoMenuTemplate:
+    """A pre-rendered photo menu. Only the mention of the user, who
+    requested it, has to be spliced in"""
+    caption: _CaptionTemplate
+    reply_markup: InlineKeyboardMarkup
+    photo: str = None
+
+    def render(self, requested_by: User) -> PhotoMarkup:
+        return self.render_mentions(requested_by.mention_html())
+
+    def render_mentions(self, mentions: str) -> PhotoMarkup:
+        return PhotoMarkup(
+            photo=self.photo,
+            caption=self.caption.render_mentions(mentions),
+            reply_markup=self.reply_markup,
+        )
+
+
+_Template = TypeVar('_Template')
+
+
+class _TemplateCache:
+    """Keeps templates built from chat data. A template is rebuilt only
+    when the object it was built from is replaced, e.g. when the data
+    is reloaded from the database"""
+
+    MAX_SIZE = 256
+
+    def __init__(self):
+        self._templates: OrderedDict[tuple[str, int],
+                                     tuple[object, Any]] = OrderedDict()
+
+    def get(self, kind: str, source: object,
+            build: Callable[[], _Template]) -> _Template:
+        """Returns the template of the given kind for the source object,
+        building it if needed"""
+        # The cached source is referenced, so its id can not be reused
+        key = kind, id(source)
+        try:
+            cached_source, template = self._templates[key]
+        except KeyError:
+            pass
+        else:
+            if cached_source is source:
+                self._templates.move_to_end(key)
+                return template
+
+        template = build()
+        self._templates[key] = source, template
+        while len(self._templates) > self.MAX_SIZE:
+            self._templates.popitem(last=False)
+        return template
+
+
+_templates = _TemplateCache()
+
+_INFO_MENU_HEADER = _CaptionTemplate(
+    before_mention='<b>[📖Інформаційна довідка</b> для ',
+    after_mention='<b>]</b>',
+)
+
+
+def _info_menu_caption(after_header: str = '') -> _CaptionTemplate:
+    """Builds a caption template that starts with the info menu header"""
+    return _CaptionTemplate(
+        before_mention=_INFO_MENU_HEADER.before_mention,
+        after_mention=_INFO_MENU_HEADER.after_mention + after_header,
+    )
+
+
 def _build_main_page_of_info_menu_reply_markup(
-        abit_chat_info: AbitChatInfo
+        info_menu: InfoMenuSnapshot
 ) -> ReplyMarkup:
     button_column = [
         InlineKeyboardButton(
@@ -65,7 +151,7 @@ def _build_main_page_of_info_menu_reply_markup(
             callback_data='programs',
         ),
     ]
-    if abit_chat_info.admission_committe_info:
+    if info_menu.admission_committe:
         button_column += [
             InlineKeyboardButton(
                 text='🏫 Приймальна комісія',
@@ -79,47 +165,61 @@ def _build_main_page_of_info_menu_reply_markup(
         ),
         InlineKeyboardButton(
             text='🗑 Флудилка',
-            url=abit_chat_info.flood_chat_link,
+            url=info_menu.flood_chat_link,
         ),
     ]
     return InlineKeyboardMarkup.from_column(button_column)
 
 
-def get_new_user_greeting_markup(abit_chat_info: AbitChatInfo,
-                                 user: User) -> PhotoMarkup:
-    """Builds a greeting text message for a new chat user with all the info"""
-    markup = PhotoMarkup()
-    markup.photo = abit_chat_info.greeting_photo_file_id
-    markup.caption = (f'👋 {user.mention_html()}, вітаю в чаті '
-                      f'абітурієнтів ФКНК!')
-    markup.reply_markup = _build_main_page_of_info_menu_reply_markup(
-        abit_chat_info=abit_chat_info
-    )
-    return markup
+def get_new_users_greeting_markup(info_menu: InfoMenuSnapshot,
+                                  users: Sequence[User],
+                                  not_mentioned: int = 0) -> PhotoMarkup:
+    """Builds a greeting text message for new chat users with all the info.
+    `not_mentioned` users, who joined along with them, are only counted"""
 
+    def build() -> _PhotoMenuTemplate:
+        return _PhotoMenuTemplate(
+            photo=info_menu.greeting_photo_file_id,
+            caption=_CaptionTemplate(
+                before_mention='👋 ',
+                after_mention=', вітаю в чаті абітурієнтів ФКНК!',
+            ),
+            reply_markup=_build_main_page_of_info_menu_reply_markup(
+                info_menu=info_menu
+            ),
+        )
 
-def get_program_list_markup(programs: list[Program],
+    mentions = ', '.join(user.mention_html() for user in users)
+    if not_mentioned:
+        mentions += f' та ще {not_mentioned}'
+    template = _templates.get('greeting', info_menu, build)
+    return template.render_mentions(mentions)
+
+
+def get_program_list_markup(programs: tuple[ProgramSnapshot, ...],
                             requested_by: User) -> PhotoMarkup:
     """Builds a text message with program list as inline buttons"""
-    markup = PhotoMarkup()
-    markup.caption = (f'<b>[📖Інформаційна довідка</b> для '
-                      f'{requested_by.mention_html()}<b>]</b>\n\n'
-                      f'🎓Освітні програми:')
-    program_buttons = [
-        InlineKeyboardButton(
-            text=program.title,
-            callback_data=f'program_by_id:{program.id}'
+
+    def build() -> _PhotoMenuTemplate:
+        program_buttons = [
+            InlineKeyboardButton(
+                text=program.title,
+                callback_data=f'program_by_id:{program.id}'
+            )
+            for program in
+            programs
+        ]
+        return _PhotoMenuTemplate(
+            caption=_info_menu_caption('\n\n🎓Освітні програми:'),
+            reply_markup=InlineKeyboardMarkup.from_column(program_buttons + [
+                InlineKeyboardButton(
+                    text='🔙 Назад',
+                    callback_data='main_menu'
+                ),
+            ]),
         )
-        for program in
-        programs
-    ]
-    markup.reply_markup = InlineKeyboardMarkup.from_column(program_buttons + [
-        InlineKeyboardButton(
-            text='🔙 Назад',
-            callback_data='main_menu'
-        ),
-    ])
-    return markup
+
+    return _templates.get('programs', programs, build).render(requested_by)
 
 
 def get_program_not_found_alert_markup() -> AlertMarkup:
@@ -130,59 +230,70 @@ def get_program_not_found_alert_markup() -> AlertMarkup:
     )
 
 
-def get_program_detail_markup(program: Program,
+def get_program_detail_markup(program: ProgramSnapshot,
                               requested_by: User) -> PhotoMarkup:
     """Builds program detail markup"""
-    markup = PhotoMarkup()
-    guide_url = html.escape(program.guide_url)
-    markup.caption = (f'<b>[📖Інформаційна довідка</b> для '
-                      f'{requested_by.mention_html()}<b>]</b>\n\n'
-                      f'<b>💻 Освітня програма:</b> {program.title}\n\n'
-                      f'<a href="{guide_url}">⚙️ Гайд по спеціальності ⚙️</a>')
-    markup.reply_markup = InlineKeyboardMarkup.from_button(
-        button=InlineKeyboardButton(
-            text='🔙 Назад',
-            callback_data='programs',
+
+    def build() -> _PhotoMenuTemplate:
+        guide_url = html.escape(program.guide_url)
+        return _PhotoMenuTemplate(
+            caption=_info_menu_caption(
+                f'\n\n<b>💻 Освітня програма:</b> {program.title}\n\n'
+                f'<a href="{guide_url}">⚙️ Гайд по спеціальності ⚙️</a>'
+            ),
+            reply_markup=InlineKeyboardMarkup.from_button(
+                button=InlineKeyboardButton(
+                    text='🔙 Назад',
+                    callback_data='programs',
+                )
+            ),
         )
-    )
-    return markup
+
+    return _templates.get('program', program, build).render(requested_by)
 
 
-def get_main_page_of_info_menu_markup(abit_chat_info: AbitChatInfo,
+def get_main_page_of_info_menu_markup(info_menu: InfoMenuSnapshot,
                                       requested_by: User) -> PhotoMarkup:
     """Builds main menu page without greetings"""
-    markup = PhotoMarkup()
-    markup.photo = abit_chat_info.greeting_photo_file_id
-    markup.caption = (f'<b>[📖Інформаційна довідка</b> для '
-                      f'{requested_by.mention_html()}<b>]</b>')
-    markup.reply_markup = _build_main_page_of_info_menu_reply_markup(
-        abit_chat_info=abit_chat_info
-    )
-    return markup
+
+    def build() -> _PhotoMenuTemplate:
+        return _PhotoMenuTemplate(
+            photo=info_menu.greeting_photo_file_id,
+            caption=_INFO_MENU_HEADER,
+            reply_markup=_build_main_page_of_info_menu_reply_markup(
+                info_menu=info_menu
+            ),
+        )
+
+    template = _templates.get('main_menu', info_menu, build)
+    return template.render(requested_by)
 
 
-def get_useful_link_list_markup(useful_links: list[UsefulLink],
+def get_useful_link_list_markup(useful_links: tuple[UsefulLinkSnapshot, ...],
                                 requested_by: User) -> PhotoMarkup:
     """Builds a text message with useful links as inline buttons"""
-    markup = PhotoMarkup()
-    markup.caption = (f'<b>[📖Інформаційна довідка</b> для '
-                      f'{requested_by.mention_html()}<b>]</b>\n\n'
-                      f'📎 Корисні посилання:')
-    buttons = [
-        InlineKeyboardButton(
-            text=link.title,
-            url=link.url,
+
+    def build() -> _PhotoMenuTemplate:
+        buttons = [
+            InlineKeyboardButton(
+                text=link.title,
+                url=link.url,
+            )
+            for link in useful_links
+        ]
+        buttons += [
+            InlineKeyboardButton(
+                text='🔙 Назад',
+                callback_data='main_menu'
+            ),
+        ]
+        return _PhotoMenuTemplate(
+            caption=_info_menu_caption('\n\n📎 Корисні посилання:'),
+            reply_markup=InlineKeyboardMarkup.from_column(buttons),
         )
-        for link in useful_links
-    ]
-    buttons += [
-        InlineKeyboardButton(
-            text='🔙 Назад',
-            callback_data='main_menu'
-        ),
-    ]
-    markup.reply_markup = InlineKeyboardMarkup.from_column(buttons)
-    return markup
+
+    template = _templates.get('useful_links', useful_links, build)
+    return template.render(requested_by)
 
 
 def get_message_has_no_file_id_markup() -> TextMarkup:
@@ -206,29 +317,48 @@ def get_filters_reloaded_markup() -> TextMarkup:
     )
 
 
+def get_cache_purged_markup(hits: int, misses: int) -> TextMarkup:
+    """A text message that notifies about successful cache purging"""
+    return TextMarkup(
+        text=f'✅ Done\n\nhits={hits}, misses={misses}'
+    )
+
+
 class UserPenguinCount(NamedTuple):
-    user: User
+    full_name: str
     penguin_count: int
 
 
+_TOP_PENGUINS_PERIOD_TITLES = {
+    'today': ' за сьогодні',
+    'week': ' за тиждень',
+    'campaign': ' за вступну кампанію',
+}
+
+
 def get_top10_users_by_sent_penguins_markup(
         top10: list[UserPenguinCount],
+        period: str | None = None,
 ) -> TextMarkup:
     """A text message with a list of the top 10 users by their sent
-    penguins count. `top10` is assumed to be in descending order."""
+    penguins count. `top10` is assumed to be in descending order.
+    `period` is one of 'today', 'week', 'campaign' or None for all
+    the time."""
     markup = TextMarkup()
 
     top3_emoji = '🥇🥈🥉'
     top3_lines = [
-        f'{medal_emoji} {user.full_name} — {penguin_count}'
-        for medal_emoji, (user, penguin_count) in zip(top3_emoji, top10[:3])
+        f'{medal_emoji} {html.escape(full_name)} — {penguin_count}'
+        for medal_emoji, (full_name, penguin_count)
+        in zip(top3_emoji, top10[:3])
     ]
     rest_lines = [
-        f'{i}. {user.full_name} — {penguin_count}'
-        for i, (user, penguin_count) in enumerate(top10[3:], start=4)
+        f'{i}. {html.escape(full_name)} — {penguin_count}'
+        for i, (full_name, penguin_count) in enumerate(top10[3:], start=4)
     ]
     top10_lines = top3_lines + rest_lines
-    markup.text = ('🏆🐧 Топ 10 відправників пінгвінчиків:\n\n'
+    period_title = _TOP_PENGUINS_PERIOD_TITLES.get(period, '')
+    markup.text = (f'🏆🐧 Топ 10 відправників пінгвінчиків{period_title}:\n\n'
                    + '\n'.join(top10_lines))
     return markup
 
@@ -282,42 +412,49 @@ def _build_timetable_text(
 
 
 def get_admission_committe_info_markup(
-        admission_committe_info: AdmissionCommitteInfo,
+        info_menu: InfoMenuSnapshot,
         requested_by: User,
 ) -> PhotoMarkup:
     """A photo message with the committe timetable in its caption
     and online queue, required documents and "how to find?" links as
-    inline buttons"""
-    markup = PhotoMarkup()
-    markup.photo = admission_committe_info.chat.greeting_photo_file_id
-    markup.caption = (f'<b>[📖Інформаційна довідка</b> для '
-                      f'{requested_by.mention_html()}<b>]</b>\n\n'
-                      f'🏫 Приймальна комісія\n\n'
-                      f'Розклад:\n')
+    inline buttons. The info menu must have the admission committee"""
+    admission_committe = info_menu.admission_committe
+
+    def build() -> _PhotoMenuTemplate:
+        buttons = []
+        if admission_committe.queue_url:
+            buttons.append(InlineKeyboardButton(
+                text='🕒 ЕЛЕКТРОННА ЧЕРГА',
+                url=admission_committe.queue_url,
+            ))
+        if admission_committe.required_documents_url:
+            buttons.append(InlineKeyboardButton(
+                text='📂 НЕОБХІДНІ ДОКУМЕНТИ',
+                url=admission_committe.required_documents_url,
+            ))
+        buttons += [
+            InlineKeyboardButton(
+                text='🗺️📌 Як нас знайти?',
+                url='https://goo.gl/maps/yH3CN9Quy7DEruvg7',
+            ),
+            InlineKeyboardButton(
+                text='🔙 Назад',
+                callback_data='main_menu'
+            ),
+        ]
+        return _PhotoMenuTemplate(
+            photo=info_menu.greeting_photo_file_id,
+            caption=_info_menu_caption('\n\n🏫 Приймальна комісія\n\n'
+                                       'Розклад:\n'),
+            reply_markup=InlineKeyboardMarkup.from_column(
+                button_column=buttons,
+            ),
+        )
+
+    template = _templates.get('admission_committe', info_menu, build)
+    markup = template.render(requested_by)
+    # The timetable emojis depend on the current time, so the timetable
+    # is not pre-rendered
     markup.caption += _build_timetable_text(
-        timetable=admission_committe_info.timetable)
-    buttons = []
-    if admission_committe_info.queue_url:
-        buttons.append(InlineKeyboardButton(
-            text='🕒 ЕЛЕКТРОННА ЧЕРГА',
-            url=admission_committe_info.queue_url,
-        ))
-    if admission_committe_info.required_documents_url:
-        buttons.append(InlineKeyboardButton(
-            text='📂 НЕОБХІДНІ ДОКУМЕНТИ',
-            url=admission_committe_info.required_documents_url,
-        ))
-    buttons += [
-        InlineKeyboardButton(
-            text='🗺️📌 Як нас знайти?',
-            url='https://goo.gl/maps/yH3CN9Quy7DEruvg7',
-        ),
-        InlineKeyboardButton(
-            text='🔙 Назад',
-            callback_data='main_menu'
-        ),
-    ]
-    markup.reply_markup = InlineKeyboardMarkup.from_column(
-        button_column=buttons,
-    )
+        timetable=admission_committe.timetable)
     return markup
@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import suppress
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+import psycopg
+from loguru import logger
+
+# The channel, which the database triggers notify with ids of chats,
+# which configs have changed
+CHAT_CONFIG_CHANNEL = 'chat_config_changed'
+
+
+class ChatConfigListener:
+    """Listens on a dedicated PostgreSQL connection for the chat config
+    changes, which are announced by database triggers.
+
+    `on_change` is called with the id of every changed chat right after
+    the change is committed. Notifications sent while the listener is
+    disconnected are lost, so `on_resync` is called to reload configs
+    of all chats every time the listener (re)connects."""
+
+    RECONNECT_DELAY = timedelta(seconds=5)
+
+    def __init__(self, conninfo: str,
+                 on_change: Callable[[int], Awaitable],
+                 on_resync: Callable[[], Awaitable]):
+        self.conninfo = conninfo
+        self.on_change = on_change
+        self.on_resync = on_resync
+        self.notifications = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts listening in the background"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops listening and closes the connection"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        logger.info(f'Stopped chat config listener, '
+                    f'{self.notifications} changes received')
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except psycopg.Error as e:
+                logger.warning(f'Chat config listener disconnected: {e!r}. '
+                               f'Reconnecting in {self.RECONNECT_DELAY}')
+            await asyncio.sleep(self.RECONNECT_DELAY.total_seconds())
+
+    async def _listen(self) -> None:
+        connection = await psycopg.AsyncConnection.connect(self.conninfo,
+                                                           autocommit=True)
+        async with connection:
+            await connection.execute(f'LISTEN {CHAT_CONFIG_CHANNEL}')
+            logger.info(f'Listening for chat config changes on '
+                        f'{CHAT_CONFIG_CHANNEL}')
+            # Changes may have been missed while disconnected
+            await self._call(self.on_resync)
+            async for notify in connection.notifies():
+                self.notifications += 1
+                try:
+                    chat_id = int(notify.payload)
+                except ValueError:
+                    logger.warning(f'Unexpected notification payload '
+                                   f'{notify.payload!r}')
+                    continue
+                await self._call(self.on_change, chat_id)
+
+    @staticmethod
+    async def _call(callback: Callable[..., Awaitable], *args) -> None:
+        """Calls the callback, logging its errors. A failing callback must
+        not stop the listener"""
+        try:
+            await callback(*args)
+        except Exception:
+            logger.exception(f'Failed to apply chat config changes {args}')
@@ -0,0 +1,339 @@
+import asyncio
+import time
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import timedelta, datetime
+from typing import Iterable
+
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from knu_fcsc_bot import usecases
+
+
+@dataclass
+class FlushStats:
+    """Counters describing how a write-behind buffer is flushed"""
+    flushes: int = 0
+    failed_flushes: int = 0
+    flushed_items: int = 0
+    last_flush_latency: float = 0.0
+    total_flush_latency: float = 0.0
+    max_queue_depth: int = 0
+
+    def observe_flush(self, items: int, latency: float) -> None:
+        """Updates the counters after a successful flush"""
+        self.flushes += 1
+        self.flushed_items += items
+        self.last_flush_latency = latency
+        self.total_flush_latency += latency
+
+    def observe_queue_depth(self, queue_depth: int) -> None:
+        """Updates the maximal observed queue depth"""
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+
+class ChatMemberIndex:
+    """An in-process index of the recorded chat members of allowed chats
+    along with the names they were recorded with.
+
+    Only chats added with `add_chats()` are indexed, so members of other
+    chats are never considered worth recording."""
+
+    def __init__(self):
+        # chat_id -> user_id -> hash of (full_name, username)
+        self._members: dict[int, dict[int, int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return sum(len(user_ids) for user_ids in self._members.values())
+
+    def __contains__(self, member: tuple[int, int]) -> bool:
+        user_id, chat_id = member
+        return user_id in self._members.get(chat_id, ())
+
+    @property
+    def chat_ids(self) -> frozenset[int]:
+        """Ids of the indexed chats"""
+        return frozenset(self._members)
+
+    def add_chats(self, chat_ids: Iterable[int]) -> None:
+        """Starts indexing the given chats"""
+        for chat_id in chat_ids:
+            self._members.setdefault(chat_id, {})
+
+    def remove_chats(self, chat_ids: Iterable[int]) -> None:
+        """Stops indexing the given chats"""
+        for chat_id in chat_ids:
+            self._members.pop(chat_id, None)
+
+    def add(self, members: Iterable[usecases.ChatMemberName]) -> None:
+        """Adds recorded members of the indexed chats"""
+        for user_id, chat_id, full_name, username in members:
+            with suppress(KeyError):
+                self._members[chat_id][user_id] = hash((full_name,
+                                                        username))
+
+    def should_record(self, user_id: int, chat_id: int,
+                      full_name: str | None = None,
+                      username: str | None = None) -> bool:
+        """Checks whether the member is in an indexed chat, but has not
+        been recorded yet or has been recorded with other names"""
+        user_ids = self._members.get(chat_id)
+        if (user_ids is None
+                or user_ids.get(user_id) == hash((full_name, username))):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    async def warm_up(self, session: AsyncSession) -> None:
+        """Loads all recorded members of the indexed chats with
+        a single streaming query"""
+        async for member in usecases.iter_chat_members_usecase(session):
+            self.add([member])
+
+
+class ChatMemberRecorder:
+    """A write-behind recorder of chat members.
+
+    Updates only add members with their names to an in-process buffer.
+    A background task writes the buffer to the database in one
+    multi-row statement every `flush_interval` or as soon as the buffer
+    reaches `max_buffer_size`. Call `stop()` on shutdown to flush the
+    rest of the buffer.
+
+    Members already present in `index` with the same names or from chats
+    outside of it are dropped without any I/O."""
+
+    DEFAULT_FLUSH_INTERVAL = timedelta(seconds=5)
+    DEFAULT_MAX_BUFFER_SIZE = 500
+
+    def __init__(self,
+                 sessionmaker: async_sessionmaker,
+                 index: ChatMemberIndex,
+                 flush_interval: timedelta = DEFAULT_FLUSH_INTERVAL,
+                 max_buffer_size: int = DEFAULT_MAX_BUFFER_SIZE):
+        self.sessionmaker = sessionmaker
+        self.index = index
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.stats = FlushStats()
+        # The last names of a member win
+        self._buffer: dict[tuple[int, int], usecases.ChatMemberName] = {}
+        self._buffer_is_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of memberships waiting to be flushed"""
+        return len(self._buffer)
+
+    def record(self, user_id: int, chat_id: int,
+               full_name: str | None = None,
+               username: str | None = None) -> None:
+        """Adds the membership to the buffer, unless it is already
+        recorded with the same names or the chat is not indexed"""
+        if not self.index.should_record(user_id, chat_id,
+                                        full_name, username):
+            return
+        self._buffer[user_id, chat_id] = usecases.ChatMemberName(
+            user_id, chat_id, full_name, username)
+        self.stats.observe_queue_depth(self.queue_depth)
+        if self.queue_depth >= self.max_buffer_size:
+            self._buffer_is_full.set()
+
+    async def flush(self) -> None:
+        """Writes all buffered memberships to the database. If writing
+        fails, the memberships are returned to the buffer"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            members, self._buffer = self._buffer, {}
+
+            started_at = time.perf_counter()
+            try:
+                async with self.sessionmaker() as session:
+                    await usecases.record_chat_member_names_usecase(
+                        session, members.values())
+                    await session.commit()
+            except SQLAlchemyError:
+                # Names recorded in the meantime are newer
+                self._buffer = members | self._buffer
+                self.stats.failed_flushes += 1
+                logger.exception(f'Failed to flush {len(members)} chat '
+                                 f'members')
+                return
+            latency = time.perf_counter() - started_at
+            self.stats.observe_flush(len(members), latency)
+            self.index.add(members.values())
+
+        logger.debug(f'Flushed {len(members)} chat members in '
+                     f'{latency:.3f}s')
+
+    def start(self) -> None:
+        """Starts the background flusher"""
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background flusher and flushes the rest of the
+        buffer"""
+        if self._task:
+            # Not cancelling the task, so that a flush in progress is
+            # not interrupted
+            self._stopping = True
+            self._buffer_is_full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        """Flushes the buffer every `flush_interval` or when it is full"""
+        while not self._stopping:
+            with suppress(TimeoutError):
+                await asyncio.wait_for(
+                    self._buffer_is_full.wait(),
+                    timeout=self.flush_interval.total_seconds(),
+                )
+            self._buffer_is_full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush chat members')
+
+
+class PenguinGifRecorder:
+    """An asynchronous batched recorder of penguin gifs.
+
+    Handlers put gifs into a bounded queue and return immediately. When
+    the queue is full, `record()` waits until there is free space. A
+    background task writes the gifs in batches of up to `batch_size`,
+    waiting at most `flush_interval` for a batch to fill up. Call `stop()`
+    on shutdown to write everything that is still queued."""
+
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_FLUSH_INTERVAL = timedelta(milliseconds=500)
+    DEFAULT_MAX_QUEUE_SIZE = 1000
+
+    def __init__(self,
+                 sessionmaker: async_sessionmaker,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: timedelta = DEFAULT_FLUSH_INTERVAL,
+                 max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE):
+        self.sessionmaker = sessionmaker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = FlushStats()
+        # None is used as a stop signal
+        self._queue: asyncio.Queue[usecases.PenguinGif | None] = (
+            asyncio.Queue(maxsize=max_queue_size)
+        )
+        self._batch: list[usecases.PenguinGif] = []
+        self._task: asyncio.Task | None = None
+        # Gifs are written in the order they were queued, so counting
+        # them is enough to tell if a gif has been written
+        self._queued = 0
+        self._written = 0
+        self._written_changed = asyncio.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of gifs waiting to be written"""
+        return self._queue.qsize() + len(self._batch)
+
+    async def record(self, user_id: int, chat_id: int,
+                     timestamp: datetime) -> None:
+        """Puts the gif into the queue, waiting for free space if
+        the queue is full"""
+        await self._queue.put(usecases.PenguinGif(user_id, chat_id,
+                                                  timestamp))
+        self._queued += 1
+        self.stats.observe_queue_depth(self.queue_depth)
+
+    async def flush(self) -> None:
+        """Waits until every gif queued before this call is written or
+        dropped by a failed write. Gifs queued after the call are not
+        waited for, so it returns under sustained load as well"""
+        if not self._task:
+            return
+        queued = self._queued
+        async with self._written_changed:
+            await self._written_changed.wait_for(
+                lambda: self._written >= queued)
+
+    def start(self) -> None:
+        """Starts the background writer"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the background writer after it has written everything
+        queued before this call"""
+        if self._task:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        """Writes queued gifs in batches until the stop signal"""
+        stopping = False
+        while not stopping:
+            stopping = await self._collect_batch()
+            try:
+                await self._write_batch()
+            except Exception:
+                logger.exception('Failed to record penguin gifs')
+
+    async def _collect_batch(self) -> bool:
+        """Collects up to `batch_size` gifs, waiting at most
+        `flush_interval` after the first one. Returns True if the stop
+        signal was received"""
+        penguin_gif = await self._queue.get()
+        if penguin_gif is None:
+            return True
+        self._batch.append(penguin_gif)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval.total_seconds()
+        while len(self._batch) < self.batch_size:
+            try:
+                penguin_gif = await asyncio.wait_for(
+                    self._queue.get(),
+                    timeout=deadline - loop.time(),
+                )
+            except TimeoutError:
+                break
+            if penguin_gif is None:
+                return True
+            self._batch.append(penguin_gif)
+        return False
+
+    async def _write_batch(self) -> None:
+        """Writes the collected batch to the database. Failed batches are
+        logged and dropped"""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+
+        started_at = time.perf_counter()
+        try:
+            async with self.sessionmaker() as session:
+                await usecases.record_penguin_gifs_usecase(session, batch)
+                await session.commit()
+        except SQLAlchemyError:
+            self.stats.failed_flushes += 1
+            logger.exception(f'Failed to record {len(batch)} penguin gifs')
+            return
+        finally:
+            self._written += len(batch)
+            async with self._written_changed:
+                self._written_changed.notify_all()
+        latency = time.perf_counter() - started_at
+        self.stats.observe_flush(len(batch), latency)
+
+        logger.debug(f'Recorded {len(batch)} penguin gifs in '
+                     f'{latency:.3f}s')
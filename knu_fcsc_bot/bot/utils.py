@@ -1,5 +1,6 @@
+import asyncio
 from contextlib import suppress
-from datetime import timedelta, datetime
+from datetime import timedelta
 from functools import wraps
 from typing import Callable, Any, TypeAlias
 
@@ -7,7 +8,11 @@ from loguru import logger
 from telegram import (ChatMemberUpdated, ChatMember, Message, Update,
                       Animation,
                       Chat, )
-from telegram.ext import JobQueue, CallbackContext
+from telegram.error import TelegramError, BadRequest
+from telegram.ext import CallbackContext
+
+from knu_fcsc_bot.bot.caches import TTLCache, CacheStats
+from knu_fcsc_bot.bot.deletions import MessageDeletionScheduler
 
 
 def did_new_user_join(chat_member_update: ChatMemberUpdated) -> bool:
@@ -36,8 +41,19 @@ def did_new_user_join(chat_member_update: ChatMemberUpdated) -> bool:
     return not was_member and is_member
 
 
+async def is_chat_administrator(chat: Chat, user_id: int) -> bool:
+    """Checks if the user is an administrator or the owner of the chat.
+    The membership is not cached, so demoted administrators lose access
+    right away"""
+    chat_member = await chat.get_member(user_id)
+    return chat_member.status in [
+        ChatMember.OWNER,
+        ChatMember.ADMINISTRATOR,
+    ]
+
+
 def schedule_message_deletion(
-        job_queue: JobQueue,
+        scheduler: MessageDeletionScheduler,
         message: Message,
         after: timedelta,
         with_reply_to: bool = False,
@@ -45,29 +61,7 @@ def schedule_message_deletion(
     """Schedules message deletion at `datetime.now() + after`. If
     `with_reply_to` is True, this also will delete the message, to which
     this message was a reply."""
-
-    async def delete_message(context: CallbackContext) -> None:
-        await message.delete()
-        logger.info(f'Deleted {message}')
-        if context.job:
-            await message.reply_to_message.delete()
-            logger.info(f'Deleted {message.reply_to_message}')
-
-    user_id = None
-    with suppress(AttributeError):
-        # Trying to get user_id form message, if it exists.
-        user_id = message.from_user.id
-
-    job = job_queue.run_once(
-        callback=delete_message,
-        when=after,
-        name=f'delete_message:{message.message_id}',
-        chat_id=message.chat_id,
-        user_id=user_id,
-        data={'with_reply_to': with_reply_to},
-    )
-    logger.debug(f'Scheduled {message} for deletion ({with_reply_to=}) at'
-                 f' {job.next_t}')
+    scheduler.schedule(message, after, with_reply_to=with_reply_to)
 
 
 _Callback: TypeAlias = Callable[[Update, CallbackContext], Any]
@@ -84,19 +78,14 @@ def reschedule_message_deletion_on_interaction(
         @wraps(wrapped)
         async def wrapper(update: Update, context: CallbackContext) -> Any:
             message = update.effective_message
-            logger.debug(f'Rescheduling {message}')
-            job_name = f'delete_message:{message.message_id}'
-            job_queue = context.job_queue
-
-            # Removing old jobs
-            old_jobs = job_queue.get_jobs_by_name(job_name)
-            for job in old_jobs:
-                job.schedule_removal()
+            logger.debug('Rescheduling message {message_id} in chat '
+                         '{chat_id}', message_id=message.message_id,
+                         chat_id=message.chat_id)
+            scheduler = context.bot_data['message_deletion_scheduler']
 
-            # Scheduling new job
-            with_reply_to = any(job.data['with_reply_to'] for job in old_jobs)
-            schedule_message_deletion(job_queue, message, delete_after,
-                                      with_reply_to=with_reply_to)
+            # Moving the old deletion keeps its with_reply_to
+            if not scheduler.reschedule(message, delete_after):
+                schedule_message_deletion(scheduler, message, delete_after)
 
             return await wrapped(update, context)
 
@@ -131,31 +120,123 @@ def is_a_penguin_gif(animation: Animation) -> bool:
     return animation.file_unique_id in penguin_gif_file_unique_ids
 
 
+UNKNOWN_USER_FULL_NAME = '👻 Невідомий користувач'
+
+
+class CachedChatMember:
+    """A compact chat member with only the fields, which are rendered"""
+
+    __slots__ = ('user_id', 'full_name', 'is_member')
+
+    def __init__(self, user_id: int, full_name: str, is_member: bool):
+        self.user_id = user_id
+        self.full_name = full_name
+        self.is_member = is_member
+
+
 class _GetCachedChatMember:
     """A wrapper around bot.get_chat_members that caches chat members
-        for an hour"""
+        for an hour.
 
-    DEFAULT_TIME_TO_LEAVE = timedelta(hours=1)
+    The cache holds at most `max_size` members, evicting the least
+    recently used ones. Users, who can not be found in the chat, are
+    cached for `negative_time_to_live`. Call `remove_expired()`
+    periodically to free the memory taken by expired members.
 
-    def __init__(self, time_to_live: timedelta = DEFAULT_TIME_TO_LEAVE):
-        self.time_to_live = time_to_live
-        self.cache: dict[tuple[int, int], tuple[datetime, ChatMember]] = {}
+    Concurrent calls for the same chat member share a single request,
+    and at most `max_concurrent_requests` requests are sent at once."""
 
-    async def __call__(self, chat: Chat, user_id: int) -> ChatMember:
+    DEFAULT_TIME_TO_LEAVE = timedelta(hours=1)
+    DEFAULT_NEGATIVE_TIME_TO_LIVE = timedelta(minutes=10)
+    DEFAULT_MAX_SIZE = 10_000
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 5
+
+    def __init__(
+            self,
+            time_to_live: timedelta = DEFAULT_TIME_TO_LEAVE,
+            negative_time_to_live: timedelta = DEFAULT_NEGATIVE_TIME_TO_LIVE,
+            max_size: int = DEFAULT_MAX_SIZE,
+            max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    ):
+        self.negative_time_to_live = negative_time_to_live
+        self.cache: TTLCache[tuple[int, int], CachedChatMember] = TTLCache(
+            max_size=max_size,
+            time_to_live=time_to_live,
+        )
+        self._requests: dict[tuple[int, int],
+                             asyncio.Future[CachedChatMember]] = {}
+        self._request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    async def __call__(self, chat: Chat, user_id: int) -> CachedChatMember:
+        key = chat.id, user_id
+        with suppress(KeyError):
+            return self.cache.get(key)
+
+        request = self._requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(self._get_member(chat, user_id))
+            self._requests[key] = request
+            request.add_done_callback(lambda _: self._requests.pop(key))
+        # Shielding, so that a cancelled caller does not cancel the request
+        # for the others
+        return await asyncio.shield(request)
+
+    def remove_expired(self) -> int:
+        """Removes expired members from the cache. Returns the number of
+        removed members"""
+        return self.cache.remove_expired()
+
+    async def _get_member(self, chat: Chat,
+                          user_id: int) -> CachedChatMember:
         try:
-            self._remove_from_cache_if_expired(chat.id, user_id)
-            return self.cache[chat.id, user_id][1]
-        except KeyError:  # Not in cache
-            chat_member = await chat.get_member(user_id)
-            self.cache[chat.id, user_id] = datetime.now(), chat_member
-            return chat_member
-
-    def _remove_from_cache_if_expired(self, chat_id: int,
-                                      user_id: int) -> None:
-        """Removes from cache if the cached value has expired"""
-        timestamp, _ = self.cache[chat_id, user_id]
-        if timestamp + self.time_to_live < datetime.now():
-            del self.cache[chat_id, user_id]
+            async with self._request_semaphore:
+                chat_member = await chat.get_member(user_id)
+        except BadRequest as e:
+            # The user is unknown to the chat, caching it as well
+            logger.warning(f'Failed to get user {user_id} in chat '
+                           f'{chat.id}: {e}')
+            cached_chat_member = CachedChatMember(
+                user_id=user_id,
+                full_name=UNKNOWN_USER_FULL_NAME,
+                is_member=False,
+            )
+            self.cache.set((chat.id, user_id), cached_chat_member,
+                           time_to_live=self.negative_time_to_live)
+            return cached_chat_member
+
+        cached_chat_member = CachedChatMember(
+            user_id=user_id,
+            full_name=chat_member.user.full_name,
+            is_member=chat_member.status not in [ChatMember.LEFT,
+                                                 ChatMember.BANNED],
+        )
+        self.cache.set((chat.id, user_id), cached_chat_member)
+        return cached_chat_member
 
 
 get_cached_chat_member = _GetCachedChatMember()
+
+
+async def get_cached_chat_member_names(chat: Chat,
+                                       user_ids: list[int]) -> list[str]:
+    """Concurrently gets full names of users by their ids using
+    get_cached_chat_member. Users, which can not be got, are replaced with
+    a placeholder name"""
+
+    async def get_full_name(user_id: int) -> str:
+        try:
+            chat_member = await get_cached_chat_member(chat, user_id)
+        except TelegramError as e:
+            logger.warning(f'Failed to get user {user_id} in chat '
+                           f'{chat.id}: {e}')
+            return UNKNOWN_USER_FULL_NAME
+        return chat_member.full_name
+
+    return list(await asyncio.gather(*map(get_full_name, user_ids)))
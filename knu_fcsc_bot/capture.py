@@ -0,0 +1,112 @@
+import asyncio
+import gzip
+import json
+import time
+import zlib
+from typing import Iterator, NamedTuple
+
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+
+from knu_fcsc_bot.metrics import Histogram
+
+
+class CapturedUpdate(NamedTuple):
+    """An update with the unix time it was received at"""
+    received_at: float
+    update: dict
+
+
+class UpdateCapture:
+    """Appends incoming updates to a gzip-compressed log of JSON lines.
+
+    Every run appends a new gzip member, so the log stays readable as
+    a whole. Records are compressed in memory and reach the file as the
+    compressor fills up or on `flush()`"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.captured_updates = 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def capture(self, update: Update) -> None:
+        """Appends the update to the log"""
+        self.capture_data(update.to_dict())
+
+    def capture_data(self, data: dict) -> None:
+        """Appends the update in its JSON form to the log"""
+        record = {'received_at': time.time(), 'update': data}
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.captured_updates += 1
+
+    def flush(self) -> None:
+        """Writes compressed records to the file"""
+        self._file.flush()
+
+    def close(self) -> None:
+        """Flushes and closes the log"""
+        self._file.close()
+
+
+def read_captured_updates(path: str) -> Iterator[CapturedUpdate]:
+    """Reads updates from a log written by UpdateCapture. A record
+    truncated by a crash ends the log"""
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Skipped a truncated record of {path}')
+                    return
+                yield CapturedUpdate(record['received_at'], record['update'])
+        except (EOFError, zlib.error):
+            logger.warning(f'The capture {path} ends abruptly')
+
+
+async def replay_updates(app: Application,
+                         updates: list[CapturedUpdate],
+                         speed: float | None = 1) -> None:
+    """Feeds captured updates to the application in the captured order.
+    Gaps between updates are kept and divided by `speed`, and updates
+    are fed one after another, if `speed` is None.
+
+    The application must be initialized. Handlers running in the
+    background are not awaited"""
+    if not updates:
+        return
+    first_received_at = updates[0].received_at
+    started_at = time.perf_counter()
+    for received_at, data in updates:
+        if speed:
+            due = started_at + (received_at - first_received_at) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await app.process_update(Update.de_json(data, app.bot))
+
+
+def format_timing_report(histogram: Histogram) -> str:
+    """Formats a table of observations of a histogram labelled by
+    handler, the slowest handlers first"""
+    rows = []
+    for labelvalues in histogram.labelsets():
+        count, total = histogram.count_and_sum(*labelvalues)
+        rows.append((
+            labelvalues[0],
+            count,
+            total,
+            total / count * 1000,
+            histogram.quantile(0.5, *labelvalues) * 1000,
+            histogram.quantile(0.99, *labelvalues) * 1000,
+        ))
+    rows.sort(key=lambda row: row[2], reverse=True)
+
+    width = max([len('handler')] + [len(row[0]) for row in rows])
+    lines = [f'{"handler":<{width}} {"calls":>7} {"total, s":>9} '
+             f'{"mean, ms":>9} {"p50, ms":>9} {"p99, ms":>9}']
+    for name, count, total, mean, p50, p99 in rows:
+        lines.append(f'{name:<{width}} {count:>7} {total:>9.3f} '
+                     f'{mean:>9.2f} {p50:>9.2f} {p99:>9.2f}')
+    return '\n'.join(lines)
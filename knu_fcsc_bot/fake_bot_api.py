@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, deque
+from datetime import timedelta
+from typing import Any
+from urllib.parse import parse_qsl
+
+from loguru import logger
+
+FAKE_BOT_TOKEN = '123456:fake-bot-api-token'
+FAKE_BOT_USER = {
+    'id': 123456,
+    'is_bot': True,
+    'first_name': 'Fake Bot',
+    'username': 'fake_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': True,
+    'supports_inline_queries': False,
+}
+
+# Methods answered with a sent or edited message
+_MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendAnimation',
+                    'editMessageText', 'editMessageCaption',
+                    'editMessageMedia', 'editMessageReplyMarkup', }
+
+
+def _parse_value(value: str) -> Any:
+    """Parameters are form-encoded, and non-string ones are JSON"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class _BadRequest(Exception):
+    """Answers the request with 400 Bad Request"""
+
+
+class FakeBotApi:
+    """A local stand-in for the Bot API, which is used to benchmark and
+    replay updates without hitting Telegram.
+
+    Updates put with `put_update()` are served by getUpdates. Messages
+    are "sent" and "edited" by answering with a plausible Message, and
+    other methods just succeed. Methods in `failing_methods` fail with
+    400 Bad Request instead. Every answer, except getUpdates, is delayed
+    by `latency`."""
+
+    # The number of the latest requests kept in `requests`
+    MAX_KEPT_REQUESTS = 10_000
+
+    def __init__(self, latency: timedelta = timedelta(0)):
+        self.latency = latency
+        self.failing_methods: set[str] = set()
+        self.calls: Counter[str] = Counter()
+        # (method, parameters) of the latest requests
+        self.requests: deque[tuple[str, dict[str, Any]]] = deque(
+            maxlen=self.MAX_KEPT_REQUESTS)
+        # update_id -> time.perf_counter() when it was served
+        self.delivered_at: dict[int, float] = {}
+        self._updates: asyncio.Queue[dict] = asyncio.Queue()
+        self._message_ids = itertools.count(1_000_000)
+        self._server: asyncio.Server | None = None
+
+    @property
+    def base_url(self) -> str:
+        """The base url to pass to ApplicationBuilder.base_url()"""
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}/bot'
+
+    @property
+    def pending_updates(self) -> int:
+        """The number of updates, which have not been served yet"""
+        return self._updates.qsize()
+
+    def put_update(self, update: dict) -> None:
+        """Queues the update for getUpdates"""
+        self._updates.put_nowait(update)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Starts serving. The default port is chosen by the OS"""
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  host=host, port=port)
+        logger.info(f'Serving the fake Bot API at {self.base_url}')
+
+    async def stop(self) -> None:
+        """Stops serving"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> None:
+        """Answers keep-alive HTTP/1.1 requests on the connection"""
+        try:
+            while request_line := await reader.readline():
+                content_length = 0
+                while header := (await reader.readline()).strip():
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.lower() == 'content-length':
+                        content_length = int(value)
+                body = await reader.readexactly(content_length)
+
+                _, path, *_ = request_line.decode('latin-1').split()
+                method = path.rsplit('/', 1)[-1]
+                try:
+                    result = await self._call(method, self._parse_body(body))
+                except _BadRequest as e:
+                    status = b'400 Bad Request'
+                    answer = {'ok': False, 'error_code': 400,
+                              'description': f'Bad Request: {e}'}
+                else:
+                    status = b'200 OK'
+                    answer = {'ok': True, 'result': result}
+                response = json.dumps(answer).encode()
+                writer.write(
+                    b'HTTP/1.1 ' + status + b'\r\n'
+                    b'Content-Type: application/json\r\n'
+                    + f'Content-Length: {len(response)}\r\n\r\n'.encode()
+                    + response
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Pending long polls are cancelled when the loop is closed.
+            # asyncio would report the cancellation as an unhandled
+            # exception of the connection callback
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_body(body: bytes) -> dict[str, Any]:
+        if body.startswith(b'{'):
+            return json.loads(body)
+        return {
+            key: _parse_value(value)
+            for key, value in parse_qsl(body.decode())
+        }
+
+    async def _call(self, method: str, params: dict[str, Any]) -> Any:
+        """Returns the result of the Bot API method"""
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+
+        self.requests.append((method, params))
+        if self.latency:
+            await asyncio.sleep(self.latency.total_seconds())
+        if method in self.failing_methods:
+            raise _BadRequest(f'{method} failed')
+        if method == 'getMe':
+            return FAKE_BOT_USER
+        if method == 'getChatMember':
+            return self._get_chat_member(params)
+        if method in _MESSAGE_METHODS:
+            return self._make_message(method, params)
+        return True
+
+    async def _get_updates(self, params: dict[str, Any]) -> list[dict]:
+        """Waits for updates up to the polling timeout and returns up to
+        `limit` of them"""
+        limit = int(params.get('limit', 100))
+        timeout = float(params.get('timeout', 0))
+        try:
+            update = await asyncio.wait_for(self._updates.get(),
+                                            timeout=timeout)
+        except TimeoutError:
+            return []
+        updates = [update]
+        while len(updates) < limit and not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+
+        now = time.perf_counter()
+        for update in updates:
+            self.delivered_at[update['update_id']] = now
+        return updates
+
+    @staticmethod
+    def _get_chat_member(params: dict[str, Any]) -> dict:
+        user_id = int(params['user_id'])
+        return {
+            'status': 'member',
+            'user': {
+                'id': user_id,
+                'is_bot': False,
+                'first_name': 'User',
+                'last_name': str(user_id),
+            },
+        }
+
+    def _make_message(self, method: str, params: dict[str, Any]) -> dict:
+        chat = {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'}
+        message_id = (int(params['message_id']) if 'message_id' in params
+                      else next(self._message_ids))
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': FAKE_BOT_USER,
+        }
+        if method == 'sendPhoto' or 'caption' in params:
+            message['photo'] = [{
+                'file_id': str(params.get('photo', 'photo')),
+                'file_unique_id': 'photo',
+                'width': 1,
+                'height': 1,
+            }]
+            message['caption'] = params.get('caption', '')
+        else:
+            message['text'] = params.get('text', '')
+        reply_to_message_id = params.get('reply_to_message_id')
+        if reply_to_message_id:
+            message['reply_to_message'] = {
+                'message_id': int(reply_to_message_id),
+                'date': int(time.time()),
+                'chat': chat,
+            }
+        return message
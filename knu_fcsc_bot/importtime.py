@@ -0,0 +1,43 @@
+import subprocess
+import sys
+from typing import NamedTuple
+
+
+class ImportTime(NamedTuple):
+    """Microseconds spent importing the module, without and with
+    the modules it imported first"""
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def profile_imports(module: str) -> list[ImportTime]:
+    """Imports the module in a fresh interpreter with `-X importtime` and
+    returns timings of every module it imported, the slowest first"""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True,
+    )
+    timings = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            # The header
+            continue
+        timings.append(ImportTime(name.strip(), int(self_us),
+                                  int(cumulative_us)))
+    timings.sort(key=lambda timing: timing.cumulative_us, reverse=True)
+    return timings
+
+
+def format_import_report(timings: list[ImportTime], limit: int = 25) -> str:
+    """Formats a table of the slowest imports"""
+    width = max([len('module')] + [len(t.module) for t in timings[:limit]])
+    lines = [f'{"module":<{width}} {"self, ms":>9} {"cumulative, ms":>15}']
+    for module, self_us, cumulative_us in timings[:limit]:
+        lines.append(f'{module:<{width}} {self_us / 1000:>9.1f} '
+                     f'{cumulative_us / 1000:>15.1f}')
+    return '\n'.join(lines)
@@ -1,10 +1,42 @@
+import json
 import logging
 import sys
+import traceback
+from collections import defaultdict
+from typing import Any
 
 from loguru import logger
+from telegram import Update
 
+# Noisy log categories mapped to N, where only 1 in N records is logged.
+# The category of a record is set with the `category` kwarg
+DEFAULT_LOG_SAMPLING = {
+    'message_from_not_allowed_chat': 100,
+}
 
-# Using InterceptionHandler from loguru docs to redirect logs
+# Low-level libraries, which log through the standard logging module
+_LOW_LEVEL_LOGGERS = ('asyncio', 'httpx', 'httpcore', 'hpack', 'psycopg',
+                      'apscheduler', )
+
+
+def _patch_origin(record: dict) -> None:
+    """Sets the origin of a loguru record from the standard logging one
+    passed in its extra"""
+    log_record: logging.LogRecord = record['extra'].pop('logging_record')
+    record.update(
+        name=log_record.name,
+        function=log_record.funcName,
+        line=log_record.lineno,
+    )
+
+
+# The record already knows where it originated, so there is no need to
+# walk the stack to find the caller. The logger is patched once, and
+# every record passes its origin to the patcher
+_intercepted_logger = logger.patch(_patch_origin)
+
+
+# Based on InterceptHandler from loguru docs, which redirects logs
 # from standard logging module into loguru's logger.
 # Source: https://loguru.readthedocs.io/en/stable/overview.html#entirely-compatible-with-standard-logging
 class InterceptHandler(logging.Handler):
@@ -15,16 +47,64 @@ class InterceptHandler(logging.Handler):
         except ValueError:
             level = record.levelno
 
-        # Find caller from where originated the logged message.
-        frame, depth = sys._getframe(6), 6
-        while frame and frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
+        log = _intercepted_logger
+        if record.exc_info:
+            log = log.opt(exception=record.exc_info)
+        # The message is passed as an argument, so that braces in it are
+        # not formatted
+        log.log(level, '{}', record.getMessage(), logging_record=record)
+
+
+def update_fields(update: Update) -> dict[str, int | None]:
+    """Returns compact fields identifying the update. Pass them to the
+    logger as kwargs, so they are rendered only if the record is logged,
+    and become structured fields of JSON logs"""
+    chat = update.effective_chat
+    user = update.effective_user
+    return {
+        'update_id': update.update_id,
+        'chat_id': chat.id if chat else None,
+        'user_id': user.id if user else None,
+    }
+
+
+class _LogSampler:
+    """A loguru filter, which passes only 1 in N records of a category"""
+
+    def __init__(self, sampling: dict[str, int]):
+        self.sampling = sampling
+        self._counters: defaultdict[str, int] = defaultdict(int)
+
+    def __call__(self, record: dict) -> bool:
+        category = record['extra'].get('category')
+        every = self.sampling.get(category)
+        if not every:
+            return True
+        counter = self._counters[category]
+        self._counters[category] = counter + 1
+        return counter % every == 0
+
 
-        logger.opt(
-            depth=depth,
-            exception=record.exc_info,
-        ).log(level, record.getMessage())
+def _format_json(record: dict) -> str:
+    """A loguru format function, which renders the record as a JSON line
+    with the extra fields on the top level"""
+    fields: dict[str, Any] = {
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'logger': record['name'],
+        'message': record['message'],
+    }
+    fields.update(
+        (key, value)
+        for key, value in record['extra'].items()
+        if key != 'json'
+    )
+    if record['exception']:
+        fields['exception'] = ''.join(
+            traceback.format_exception(*record['exception']))
+    record['extra']['json'] = json.dumps(fields, ensure_ascii=False,
+                                         default=str)
+    return '{extra[json]}\n'
 
 
 def redirect_standard_logging_to_loguru() -> None:
@@ -34,15 +114,26 @@ def redirect_standard_logging_to_loguru() -> None:
 
 def disable_low_level_logs() -> None:
     """Disable logs from low-level libraries"""
-    logger.disable('asyncio')
-    logger.disable('httpx')
-    logger.disable('httpcore')
-    logger.disable('hpack')
-    logger.disable('psycopg')
-    logger.disable('apscheduler')
+    for name in _LOW_LEVEL_LOGGERS:
+        # Records are not even created above CRITICAL
+        logging.getLogger(name).setLevel(logging.CRITICAL + 1)
 
 
-def set_logging_level(level: int | str) -> None:
-    """Set logging level for loguru"""
+def set_logging_level(level: int | str,
+                      json_logs: bool = False,
+                      sampling: dict[str, int] | None = None) -> None:
+    """Set logging level for loguru. Logs are written to stderr by
+    a background thread, as JSON lines if `json_logs` is True. `sampling`
+    overrides DEFAULT_LOG_SAMPLING"""
+    if sampling is None:
+        sampling = DEFAULT_LOG_SAMPLING
     logger.remove()
-    logger.add(sys.stderr, level=level)
+    # The default format is kept for plain logs
+    format_options = {'format': _format_json} if json_logs else {}
+    logger.add(
+        sys.stderr,
+        level=level,
+        filter=_LogSampler(sampling),
+        enqueue=True,
+        **format_options,
+    )
@@ -0,0 +1,240 @@
+import asyncio
+import math
+from abc import ABC, abstractmethod
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from loguru import logger
+
+# Labels of a sample mapped to its value
+Samples = Iterable[tuple[tuple[str, ...], float]]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, )
+
+
+def _format_labels(labelnames: tuple[str, ...],
+                   labelvalues: tuple[str, ...]) -> str:
+    if not labelnames:
+        return ''
+    labels = ','.join(
+        f'{name}="{_escape_label_value(str(value))}"'
+        for name, value in zip(labelnames, labelvalues)
+    )
+    return f'{{{labels}}}'
+
+
+def _escape_label_value(value: str) -> str:
+    return (value.replace('\\', r'\\')
+            .replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric(ABC):
+    """A base class of metrics rendered in the Prometheus text format"""
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def render(self) -> str:
+        """Renders the metric in the Prometheus text format"""
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        lines.extend(self._render_samples())
+        return '\n'.join(lines)
+
+    @abstractmethod
+    def _render_samples(self) -> Iterator[str]:
+        """Yields lines of the samples of the metric"""
+
+
+class Counter(Metric):
+    """A monotonically increasing counter"""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        """Increments the counter with the given label values"""
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _render_samples(self) -> Iterator[str]:
+        for labelvalues, value in self._values.items():
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets"""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (bucket counts, sum)
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """Records an observation with the given label values"""
+        counts, total = self._values.get(labelvalues, (None, 0.0))
+        if counts is None:
+            counts = [0] * len(self.buckets)
+        # Counts are kept per bucket and accumulated on render
+        counts[bisect_left(self.buckets, value)] += 1
+        self._values[labelvalues] = counts, total + value
+
+    def labelsets(self) -> list[tuple[str, ...]]:
+        """Returns label values, which have observations"""
+        return list(self._values)
+
+    def count_and_sum(self, *labelvalues: str) -> tuple[int, float]:
+        """Returns the number and the sum of observations"""
+        counts, total = self._values.get(labelvalues, ((), 0.0))
+        return sum(counts), total
+
+    def quantile(self, q: float, *labelvalues: str) -> float:
+        """Estimates the q-quantile of observations by interpolating
+        within the bucket it falls into, as histogram_quantile() of
+        Prometheus does. Observations above the last finite bucket are
+        estimated by its bound"""
+        counts, _ = self._values.get(labelvalues, ((), 0.0))
+        rank = q * sum(counts)
+        cumulative_count = 0
+        lower_bound = 0.0
+        for bucket, count in zip(self.buckets, counts):
+            if count and cumulative_count + count >= rank:
+                if math.isinf(bucket):
+                    return lower_bound
+                share = (rank - cumulative_count) / count
+                return lower_bound + (bucket - lower_bound) * share
+            cumulative_count += count
+            lower_bound = bucket
+        return math.nan
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        """Observes the duration of the block in seconds"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *labelvalues)
+
+    def _render_samples(self) -> Iterator[str]:
+        labelnames = self.labelnames + ('le',)
+        for labelvalues, (counts, total) in self._values.items():
+            cumulative_count = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative_count += count
+                labels = _format_labels(
+                    labelnames, labelvalues + (_format_value(bucket),))
+                yield f'{self.name}_bucket{labels} {cumulative_count}'
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative_count}'
+
+
+class CollectedMetric(Metric):
+    """A metric, which values are collected by a callback on every scrape.
+    Used to expose counters and gauges kept elsewhere"""
+
+    def __init__(self, name: str, documentation: str, type: str,
+                 collect: Callable[[], Samples],
+                 labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+
+    def _render_samples(self) -> Iterator[str]:
+        for labelvalues, value in self.collect():
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Registry:
+    """A collection of metrics to be exposed together"""
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Adds the metric, replacing a metric with the same name"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text format"""
+        rendered = []
+        for metric in self._metrics.values():
+            try:
+                rendered.append(metric.render())
+            except Exception:
+                logger.exception(f'Failed to render metric {metric.name}')
+        return '\n'.join(rendered) + '\n'
+
+
+REGISTRY = Registry()
+
+_NOT_FOUND_RESPONSE = (b'HTTP/1.1 404 Not Found\r\n'
+                       b'Content-Length: 0\r\n'
+                       b'Connection: close\r\n\r\n')
+
+
+async def _handle_scrape(registry: Registry, reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+    """Answers a single HTTP request with the rendered metrics"""
+    try:
+        request_line = await reader.readline()
+        # Skipping the headers
+        while (await reader.readline()).strip():
+            pass
+        method, path, *_ = request_line.decode('latin-1').split()
+        if method != 'GET' or path.split('?')[0] != '/metrics':
+            writer.write(_NOT_FOUND_RESPONSE)
+        else:
+            body = registry.render().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                + f'Content-Length: {len(body)}\r\n'.encode()
+                + b'Connection: close\r\n\r\n'
+                + body
+            )
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int,
+                               registry: Registry = REGISTRY,
+                               ) -> asyncio.Server:
+    """Serves metrics of the registry at http://host:port/metrics"""
+
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        await _handle_scrape(registry, reader, writer)
+
+    server = await asyncio.start_server(handle, host=host, port=port)
+    logger.info(f'Serving metrics at http://{host}:{port}/metrics')
+    return server
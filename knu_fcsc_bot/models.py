@@ -68,11 +68,15 @@ class AbitChatInfo(Base):
         back_populates='chat',
         uselist=False,
         default=None,
+        lazy='raise',
     )
 
 
 class ChatMember(Base):
     """A member of abit chat"""
+    # first_name and last_name are up to 64 characters each
+    MAX_FULL_NAME_LENGTH = 129
+    MAX_USERNAME_LENGTH = 32
 
     __tablename__ = 'chat_members'
 
@@ -83,6 +87,14 @@ class ChatMember(Base):
                                          ForeignKey('abit_chat_info.chat_id'),
                                          autoincrement=False,
                                          default=None)
+    full_name: Mapped[str | None] = mapped_column(
+        String(MAX_FULL_NAME_LENGTH),
+        default=None,
+    )
+    username: Mapped[str | None] = mapped_column(
+        String(MAX_USERNAME_LENGTH),
+        default=None,
+    )
 
     penguins: Mapped[list['SentPenguinRecord']] = relationship(
         lazy=True,
@@ -111,6 +123,23 @@ class SentPenguinRecord(Base):
     chat_member_id: Mapped[int] = mapped_column(ForeignKey('chat_members.id'),
                                                 default=None)
 
+    __table_args__ = (
+        Index('ix_sent_penguin_records__chat_member_id__timestamp',
+              'chat_member_id', 'timestamp'),
+    )
+
+
+class PenguinCountBucket(Base):
+    """The number of penguin gifs sent by a chat member during an hour.
+    Kept in sync with SentPenguinRecord on write"""
+
+    __tablename__ = 'penguin_count_buckets'
+
+    chat_member_id: Mapped[int] = mapped_column(ForeignKey('chat_members.id'),
+                                                primary_key=True)
+    hour: Mapped[datetime.datetime] = mapped_column(primary_key=True)
+    penguin_count: Mapped[int]
+
 
 class AdmissionCommitteTimetableRecord(Base):
     """Stores info about the admission committee timetable"""
@@ -144,7 +173,7 @@ class AdmissionCommitteInfo(Base):
                                          ForeignKey('abit_chat_info.chat_id'),
                                          autoincrement=False, default=None,
                                          primary_key=True)
-    chat: Mapped[AbitChatInfo] = relationship(default=None)
+    chat: Mapped[AbitChatInfo] = relationship(default=None, lazy='raise')
     queue_url: Mapped[str] = mapped_column(String(MAX_URL_LENGTH),
                                            nullable=True, default=None)
     timetable: Mapped[list[AdmissionCommitteTimetableRecord]] = relationship(
@@ -157,3 +186,17 @@ class AdmissionCommitteInfo(Base):
                                                         nullable=True,
                                                         default=None)
 
+
+class ScheduledMessageDeletion(Base):
+    """A message, which the bot must delete at delete_at (UTC). If
+    reply_to_message_id is set, the message it replies to is deleted too"""
+
+    __tablename__ = 'scheduled_message_deletions'
+
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True,
+                                         autoincrement=False)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True,
+                                            autoincrement=False)
+    delete_at: Mapped[datetime.datetime]
+    reply_to_message_id: Mapped[int | None] = mapped_column(BigInteger,
+                                                            default=None)
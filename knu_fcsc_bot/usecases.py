@@ -1,12 +1,21 @@
-from datetime import datetime
-from typing import cast, NamedTuple
+from collections import Counter
+from datetime import datetime, timezone, date, time
+from typing import NamedTuple, Iterable, AsyncIterator, Collection
 
-from sqlalchemy import select, func, desc
+from sqlalchemy import (select, func, desc, insert, delete, tuple_, values,
+                        column, BigInteger, String, DateTime, and_, )
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+# sqlalchemy.dialects.postgresql is imported by the PostgreSQL-only
+# statements, where the engine has loaded it already. Other databases
+# do not pay tens of milliseconds for importing it
+
 from knu_fcsc_bot.models import (AbitChatInfo, UsefulLink, Program, ChatMember,
-                                 SentPenguinRecord, AdmissionCommitteInfo, )
+                                 SentPenguinRecord, AdmissionCommitteInfo,
+                                 AdmissionCommitteTimetableRecord,
+                                 PenguinCountBucket,
+                                 ScheduledMessageDeletion, )
 
 
 class Error(Exception):
@@ -18,90 +27,590 @@ class DoesNotExist(Error):
     """Requested object does not exist"""
 
 
-async def get_main_abit_chat_info_usecase(session: AsyncSession,
-                                          chat_id: int) -> AbitChatInfo:
-    """Returns main info for given chat_id (useful_links and programs
-    are not guarantied)"""
-    abit_chat_info = cast(AbitChatInfo,
-                          await session.get(
-                              entity=AbitChatInfo,
-                              ident=chat_id,
-                              options=[
-                                  selectinload(
-                                      AbitChatInfo.admission_committe_info
-                                  ),
-                              ],
-                          ))
-    if not abit_chat_info:
-        raise DoesNotExist
-    return abit_chat_info
+async def list_allowed_chat_ids_usecase(session: AsyncSession) -> list[int]:
+    """Lists all allowed chat ids"""
+    stmt = select(AbitChatInfo.chat_id)
+    scalar_results = await session.scalars(stmt)
+    return list(scalar_results)
+
+
+async def is_allowed_chat_usecase(session: AsyncSession,
+                                 chat_id: int) -> bool:
+    """Checks whether the chat is allowed"""
+    stmt = select(AbitChatInfo.chat_id).where(AbitChatInfo.chat_id == chat_id)
+    return (await session.scalar(stmt)) is not None
+
+
+class ProgramSnapshot(NamedTuple):
+    """A program shown in the info menu"""
+    id: int
+    title: str
+    guide_url: str
+
+
+class UsefulLinkSnapshot(NamedTuple):
+    """A useful link shown in the info menu"""
+    title: str
+    url: str
+
+
+class TimetableRecordSnapshot(NamedTuple):
+    """A working day of the admission committee"""
+    date: date
+    work_start: time
+    work_end: time
+
+
+class AdmissionCommitteSnapshot(NamedTuple):
+    """The admission committee info shown in the info menu"""
+    queue_url: str | None
+    required_documents_url: str | None
+    timetable: tuple[TimetableRecordSnapshot, ...]
+
 
+class InfoMenuSnapshot(NamedTuple):
+    """The whole state of the info menu of a chat. It is immutable, so
+    it can be cached and shared by handlers"""
+    chat_id: int
+    greeting_photo_file_id: str
+    flood_chat_link: str
+    programs: tuple[ProgramSnapshot, ...]
+    useful_links: tuple[UsefulLinkSnapshot, ...]
+    admission_committe: AdmissionCommitteSnapshot | None
 
-async def list_programs_usecase(session: AsyncSession,
-                                chat_id: int) -> list[Program]:
-    """Lists all available programs for the chat"""
-    stmt = select(Program).where(Program.chat_id == chat_id)
-    return list((await session.scalars(stmt)).all())
+    def find_program(self, program_id: int) -> ProgramSnapshot | None:
+        """Returns the program of the chat with the id, if there is one"""
+        for program in self.programs:
+            if program.id == program_id:
+                return program
+        return None
 
 
-async def get_program_by_id_usecase(session: AsyncSession,
-                                    program_id: int) -> Program:
-    """Gets program by its id"""
-    program = cast(Program,
-                   await session.get(Program, program_id))
-    if not program:
+def _json_agg(*columns, where, order_by):
+    """A scalar subquery aggregating rows of the columns into a JSON
+    array of arrays. It is NULL if there are no rows"""
+    from sqlalchemy.dialects import postgresql
+
+    return select(
+        func.json_agg(postgresql.aggregate_order_by(
+            func.json_build_array(*columns), *order_by,
+        )),
+    ).where(where).scalar_subquery()
+
+
+async def _select_info_menu_snapshots(
+        session: AsyncSession,
+        chat_id: int | None,
+) -> list[InfoMenuSnapshot]:
+    """Selects info menus of all chats or of the chat with a single
+    query, which aggregates programs, links and the timetable of each
+    chat into JSON"""
+    stmt = (
+        select(
+            AbitChatInfo.chat_id,
+            AbitChatInfo.greeting_photo_file_id,
+            AbitChatInfo.flood_chat_link,
+            _json_agg(Program.id, Program.title, Program.guide_url,
+                      where=Program.chat_id == AbitChatInfo.chat_id,
+                      order_by=[Program.id]),
+            _json_agg(UsefulLink.title, UsefulLink.url,
+                      where=UsefulLink.chat_id == AbitChatInfo.chat_id,
+                      order_by=[UsefulLink.id]),
+            AdmissionCommitteInfo.chat_id.is_not(None),
+            AdmissionCommitteInfo.queue_url,
+            AdmissionCommitteInfo.required_documents_url,
+            _json_agg(
+                AdmissionCommitteTimetableRecord.date,
+                AdmissionCommitteTimetableRecord.work_start,
+                AdmissionCommitteTimetableRecord.work_end,
+                where=(AdmissionCommitteTimetableRecord.committe_chat_id
+                       == AbitChatInfo.chat_id),
+                order_by=[AdmissionCommitteTimetableRecord.date],
+            ),
+        )
+        .outerjoin(AdmissionCommitteInfo,
+                   AdmissionCommitteInfo.chat_id == AbitChatInfo.chat_id)
+    )
+    if chat_id is not None:
+        stmt = stmt.where(AbitChatInfo.chat_id == chat_id)
+
+    snapshots = []
+    for (abit_chat_id, greeting_photo_file_id, flood_chat_link, programs,
+         useful_links, has_admission_committe, queue_url,
+         required_documents_url, timetable) in await session.execute(stmt):
+        admission_committe = None
+        if has_admission_committe:
+            admission_committe = AdmissionCommitteSnapshot(
+                queue_url=queue_url,
+                required_documents_url=required_documents_url,
+                timetable=tuple(
+                    TimetableRecordSnapshot(
+                        date=date.fromisoformat(record_date),
+                        work_start=time.fromisoformat(work_start),
+                        work_end=time.fromisoformat(work_end),
+                    )
+                    for record_date, work_start, work_end in timetable or ()
+                ),
+            )
+        snapshots.append(InfoMenuSnapshot(
+            chat_id=abit_chat_id,
+            greeting_photo_file_id=greeting_photo_file_id,
+            flood_chat_link=flood_chat_link,
+            programs=tuple(ProgramSnapshot(*program)
+                           for program in programs or ()),
+            useful_links=tuple(UsefulLinkSnapshot(*link)
+                               for link in useful_links or ()),
+            admission_committe=admission_committe,
+        ))
+    return snapshots
+
+
+async def _load_info_menu_snapshots(
+        session: AsyncSession,
+        chat_id: int | None,
+) -> list[InfoMenuSnapshot]:
+    """Loads info menus of all chats or of the chat for databases without
+    JSON aggregation. Every relationship is loaded for all chats at once,
+    so there are as many queries as tables"""
+    stmt = select(AbitChatInfo).options(
+        selectinload(AbitChatInfo.useful_links),
+        selectinload(AbitChatInfo.programs),
+        selectinload(AbitChatInfo.admission_committe_info).selectinload(
+            AdmissionCommitteInfo.timetable),
+    )
+    if chat_id is not None:
+        stmt = stmt.where(AbitChatInfo.chat_id == chat_id)
+
+    snapshots = []
+    for abit_chat_info in await session.scalars(stmt):
+        admission_committe_info = abit_chat_info.admission_committe_info
+        admission_committe = None
+        if admission_committe_info:
+            admission_committe = AdmissionCommitteSnapshot(
+                queue_url=admission_committe_info.queue_url,
+                required_documents_url=(
+                    admission_committe_info.required_documents_url),
+                timetable=tuple(
+                    TimetableRecordSnapshot(record.date, record.work_start,
+                                            record.work_end)
+                    for record in admission_committe_info.timetable
+                ),
+            )
+        programs = sorted(abit_chat_info.programs, key=lambda p: p.id)
+        useful_links = sorted(abit_chat_info.useful_links,
+                              key=lambda link: link.id)
+        snapshots.append(InfoMenuSnapshot(
+            chat_id=abit_chat_info.chat_id,
+            greeting_photo_file_id=abit_chat_info.greeting_photo_file_id,
+            flood_chat_link=abit_chat_info.flood_chat_link,
+            programs=tuple(
+                ProgramSnapshot(program.id, program.title, program.guide_url)
+                for program in programs
+            ),
+            useful_links=tuple(
+                UsefulLinkSnapshot(link.title, link.url)
+                for link in useful_links
+            ),
+            admission_committe=admission_committe,
+        ))
+    return snapshots
+
+
+def _supports_json_agg(session: AsyncSession) -> bool:
+    """Checks whether the database supports json_agg()"""
+    return session.bind.dialect.name == 'postgresql'
+
+
+async def get_info_menu_snapshot_usecase(session: AsyncSession,
+                                         chat_id: int) -> InfoMenuSnapshot:
+    """Returns the info menu of the chat with its programs, useful links
+    and the admission committee in a single round trip on PostgreSQL"""
+    if _supports_json_agg(session):
+        snapshots = await _select_info_menu_snapshots(session, chat_id)
+    else:
+        snapshots = await _load_info_menu_snapshots(session, chat_id)
+    if not snapshots:
         raise DoesNotExist
-    return program
+    return snapshots[0]
 
 
-async def list_useful_links_usecase(session: AsyncSession,
-                                    chat_id: int) -> list[UsefulLink]:
-    """Lists the useful links for the given chat"""
-    stmt = select(UsefulLink).where(UsefulLink.chat_id == chat_id)
-    return list((await session.scalars(stmt)).all())
+async def list_info_menu_snapshots_usecase(
+        session: AsyncSession,
+) -> list[InfoMenuSnapshot]:
+    """Lists info menus of all allowed chats in a single round trip on
+    PostgreSQL"""
+    if _supports_json_agg(session):
+        return await _select_info_menu_snapshots(session, None)
+    return await _load_info_menu_snapshots(session, None)
 
 
-async def list_allowed_chat_ids_usecase(session: AsyncSession) -> list[int]:
-    """Lists all allowed chat ids"""
-    stmt = select(AbitChatInfo.chat_id)
-    scalar_results = await session.scalars(stmt)
-    return list(scalar_results)
+class ChatMemberName(NamedTuple):
+    """The names of a user with user_id in chat_id"""
+    user_id: int
+    chat_id: int
+    full_name: str | None
+    username: str | None
+
+
+async def iter_chat_members_usecase(
+        session: AsyncSession,
+) -> AsyncIterator[ChatMemberName]:
+    """Streams all recorded memberships with the names of the members"""
+    stmt = (
+        select(ChatMember.user_id, ChatMember.chat_id,
+               ChatMember.full_name, ChatMember.username)
+        .execution_options(yield_per=1000)
+    )
+    results = await session.stream(stmt)
+    async for user_id, chat_id, full_name, username in results.tuples():
+        yield ChatMemberName(user_id, chat_id, full_name, username)
+
+
+def _supports_on_conflict(session: AsyncSession) -> bool:
+    """Checks whether the database supports INSERT ... ON CONFLICT"""
+    return session.bind.dialect.name == 'postgresql'
+
+
+class PenguinGif(NamedTuple):
+    """A penguin gif sent by the user in the chat"""
+    user_id: int
+    chat_id: int
+    timestamp: datetime
 
 
 async def record_penguin_gif_usecase(session: AsyncSession, user_id: int,
                                      chat_id: int,
                                      timestamp: datetime) -> None:
     """Records that user has sent the penguin gif in chat"""
-    chat_member_stmt = select(ChatMember).where(ChatMember.user_id == user_id,
-                                                ChatMember.chat_id == chat_id)
-    chat_member = await session.scalar(chat_member_stmt)
-    penguin_record = SentPenguinRecord(
-        chat_member=chat_member,
-        timestamp=timestamp,
+    await record_penguin_gifs_usecase(
+        session=session,
+        penguin_gifs=[PenguinGif(user_id, chat_id, timestamp)],
+    )
+
+
+def _to_naive_utc(timestamp: datetime) -> datetime:
+    """Converts an aware timestamp to a naive one in UTC, as timestamps
+    are stored without a timezone"""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _truncate_to_hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+async def record_penguin_gifs_usecase(
+        session: AsyncSession,
+        penguin_gifs: Iterable[PenguinGif],
+) -> None:
+    """Records many penguin gifs at once and adds them to the hourly
+    penguin counts. Their senders are recorded as chat members if needed,
+    gifs from unknown chats are skipped"""
+    penguin_gifs = list(penguin_gifs)
+    if not penguin_gifs:
+        return
+
+    members = {(gif.user_id, gif.chat_id) for gif in penguin_gifs}
+    await record_chat_members_usecase(session, members)
+
+    if _supports_on_conflict(session):
+        await _insert_penguin_gifs_with_buckets(session, penguin_gifs)
+    else:
+        await _insert_penguin_gifs(session, penguin_gifs, members)
+
+
+async def _insert_penguin_gifs_with_buckets(
+        session: AsyncSession,
+        penguin_gifs: list[PenguinGif],
+) -> None:
+    """Records penguin gifs and adds them to the hourly penguin counts
+    with a single statement. The gifs are inserted by a CTE, which looks
+    up their chat members, and its rows are upserted into the buckets
+    with INSERT ... ON CONFLICT DO UPDATE"""
+    from sqlalchemy.dialects import postgresql
+
+    gif_values = values(
+        column('user_id', BigInteger),
+        column('chat_id', BigInteger),
+        column('timestamp', DateTime),
+        name='gifs',
+    ).data([
+        (gif.user_id, gif.chat_id, _to_naive_utc(gif.timestamp))
+        for gif in penguin_gifs
+    ])
+    # Gifs of members, who are not recorded, are from unknown chats
+    records_stmt = (
+        select(ChatMember.id, gif_values.c.timestamp)
+        .join(gif_values, and_(ChatMember.user_id == gif_values.c.user_id,
+                               ChatMember.chat_id == gif_values.c.chat_id))
+    )
+    inserted_records = (
+        insert(SentPenguinRecord)
+        .from_select(['chat_member_id', 'timestamp'], records_stmt)
+        .returning(SentPenguinRecord.chat_member_id,
+                   SentPenguinRecord.timestamp)
+        .cte('inserted_records')
+    )
+
+    hour = func.date_trunc('hour', inserted_records.c.timestamp)
+    buckets_stmt = (
+        select(inserted_records.c.chat_member_id, hour, func.count())
+        .group_by(inserted_records.c.chat_member_id, hour)
+    )
+    stmt = (
+        postgresql.insert(PenguinCountBucket)
+        .from_select(['chat_member_id', 'hour', 'penguin_count'],
+                     buckets_stmt)
+        # Data-modifying CTEs are only allowed at the top level
+        .add_cte(inserted_records)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['chat_member_id', 'hour'],
+        set_={
+            'penguin_count': (PenguinCountBucket.penguin_count
+                              + stmt.excluded.penguin_count),
+        },
     )
-    session.add(penguin_record)
+    await session.execute(stmt)
+
+
+async def _insert_penguin_gifs(session: AsyncSession,
+                               penguin_gifs: list[PenguinGif],
+                               members: set[tuple[int, int]]) -> None:
+    """Records penguin gifs and adds them to the hourly penguin counts
+    for databases without ON CONFLICT support"""
+    chat_member_ids_stmt = (
+        select(ChatMember.user_id, ChatMember.chat_id, ChatMember.id)
+        .where(tuple_(ChatMember.user_id, ChatMember.chat_id).in_(members))
+    )
+    chat_member_ids = {
+        (user_id, chat_id): chat_member_id
+        for user_id, chat_id, chat_member_id
+        in (await session.execute(chat_member_ids_stmt)).tuples()
+    }
+
+    penguin_records = [
+        {
+            'chat_member_id': chat_member_ids[gif.user_id, gif.chat_id],
+            'timestamp': _to_naive_utc(gif.timestamp),
+        }
+        for gif in penguin_gifs
+        if (gif.user_id, gif.chat_id) in chat_member_ids
+    ]
+    if not penguin_records:
+        return
+    stmt = insert(SentPenguinRecord).values(penguin_records)
+    await session.execute(stmt)
+
+    bucket_increments = Counter(
+        (record['chat_member_id'], _truncate_to_hour(record['timestamp']))
+        for record in penguin_records
+    )
+    await _increment_penguin_count_buckets(session, bucket_increments)
+
+
+async def _increment_penguin_count_buckets(
+        session: AsyncSession,
+        bucket_increments: Counter[tuple[int, datetime]],
+) -> None:
+    """Adds to the hourly penguin counts for databases without
+    ON CONFLICT support through the ORM"""
+    buckets_stmt = (
+        select(PenguinCountBucket)
+        .where(tuple_(PenguinCountBucket.chat_member_id,
+                      PenguinCountBucket.hour).in_(bucket_increments))
+    )
+    buckets = {
+        (bucket.chat_member_id, bucket.hour): bucket
+        for bucket in await session.scalars(buckets_stmt)
+    }
+    for (chat_member_id, hour), increment in bucket_increments.items():
+        bucket = buckets.get((chat_member_id, hour))
+        if bucket:
+            bucket.penguin_count += increment
+        else:
+            session.add(PenguinCountBucket(chat_member_id=chat_member_id,
+                                           hour=hour,
+                                           penguin_count=increment))
+    await session.flush()
 
 
 async def record_chat_member(session: AsyncSession, user_id: int,
                              chat_id: int) -> None:
-    """Records that the user is a member of the chat"""
-    chat = await session.get(AbitChatInfo, chat_id)
-    if not chat:
-        raise DoesNotExist('No chat with the given id')
-    chat_member_stmt = select(ChatMember).where(ChatMember.user_id == user_id,
-                                                ChatMember.abit_chat == chat)
-    chat_member = await session.scalar(chat_member_stmt)
-    if chat_member:
-        # The user has been already recorded as the chat member
+    """Records that the user is a member of the chat. Members of unknown
+    chats are skipped"""
+    await record_chat_members_usecase(session, [(user_id, chat_id)])
+
+
+async def record_chat_members_usecase(
+        session: AsyncSession,
+        members: Iterable[tuple[int, int]],
+) -> None:
+    """Records many (user_id, chat_id) memberships at once. Memberships
+    in unknown chats and already recorded ones are skipped"""
+    members = set(members)
+    if not members:
+        return
+
+    if _supports_on_conflict(session):
+        await _upsert_chat_members(session, members)
+    else:
+        await _insert_missing_chat_members(session, members)
+
+
+async def _upsert_chat_members(session: AsyncSession,
+                               members: set[tuple[int, int]]) -> None:
+    """Records memberships with a single INSERT ... ON CONFLICT DO NOTHING,
+    relying on the unique index on (user_id, chat_id)"""
+    from sqlalchemy.dialects import postgresql
+
+    member_values = values(
+        column('user_id', BigInteger),
+        column('chat_id', BigInteger),
+        name='members',
+    ).data(list(members))
+    # Joining abit_chat_info skips memberships in unknown chats
+    known_members_stmt = (
+        select(member_values.c.user_id, member_values.c.chat_id)
+        .join(AbitChatInfo, AbitChatInfo.chat_id == member_values.c.chat_id)
+    )
+    stmt = (
+        postgresql.insert(ChatMember)
+        .from_select(['user_id', 'chat_id'], known_members_stmt)
+        .on_conflict_do_nothing(index_elements=['user_id', 'chat_id'])
+    )
+    await session.execute(stmt)
+
+
+async def _insert_missing_chat_members(session: AsyncSession,
+                                       members: set[tuple[int, int]]) -> None:
+    """Records memberships for databases without ON CONFLICT support by
+    checking which of them are missing first"""
+    chat_ids = {chat_id for _, chat_id in members}
+    known_chat_ids_stmt = (
+        select(AbitChatInfo.chat_id)
+        .where(AbitChatInfo.chat_id.in_(chat_ids))
+    )
+    known_chat_ids = set(await session.scalars(known_chat_ids_stmt))
+
+    recorded_members_stmt = (
+        select(ChatMember.user_id, ChatMember.chat_id)
+        .where(tuple_(ChatMember.user_id, ChatMember.chat_id).in_(members))
+    )
+    recorded_members = set(
+        (await session.execute(recorded_members_stmt)).tuples()
+    )
+
+    new_members = [
+        {'user_id': user_id, 'chat_id': chat_id}
+        for user_id, chat_id in members - recorded_members
+        if chat_id in known_chat_ids
+    ]
+    if new_members:
+        # A single multi-row INSERT for the whole batch
+        await session.execute(insert(ChatMember).values(new_members))
+
+
+async def record_chat_member_names_usecase(
+        session: AsyncSession,
+        members: Iterable[ChatMemberName],
+) -> None:
+    """Records many memberships at once along with the names of the
+    members. The names of already recorded members are updated only if
+    they have changed. Memberships in unknown chats are skipped"""
+    # The last name of a member wins
+    members = {
+        (member.user_id, member.chat_id): member
+        for member in members
+    }
+    if not members:
         return
-    chat_member = ChatMember(user_id=user_id, abit_chat=chat)
-    session.add(chat_member)
+
+    if _supports_on_conflict(session):
+        await _upsert_chat_member_names(session, list(members.values()))
+    else:
+        await _update_chat_member_names(session, members)
+
+
+async def _upsert_chat_member_names(session: AsyncSession,
+                                    members: list[ChatMemberName]) -> None:
+    """Records memberships with their names with a single
+    INSERT ... ON CONFLICT DO UPDATE, which only updates changed names"""
+    from sqlalchemy.dialects import postgresql
+
+    member_values = values(
+        column('user_id', BigInteger),
+        column('chat_id', BigInteger),
+        column('full_name', String),
+        column('username', String),
+        name='members',
+    ).data(members)
+    # Joining abit_chat_info skips memberships in unknown chats
+    known_members_stmt = (
+        select(member_values)
+        .join(AbitChatInfo, AbitChatInfo.chat_id == member_values.c.chat_id)
+    )
+    stmt = postgresql.insert(ChatMember).from_select(
+        ['user_id', 'chat_id', 'full_name', 'username'],
+        known_members_stmt,
+    )
+    names = tuple_(ChatMember.full_name, ChatMember.username)
+    new_names = tuple_(stmt.excluded.full_name, stmt.excluded.username)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'chat_id'],
+        set_={
+            'full_name': stmt.excluded.full_name,
+            'username': stmt.excluded.username,
+        },
+        where=names.is_distinct_from(new_names),
+    )
+    await session.execute(stmt)
+
+
+async def _update_chat_member_names(
+        session: AsyncSession,
+        members: dict[tuple[int, int], ChatMemberName],
+) -> None:
+    """Records memberships with their names for databases without
+    ON CONFLICT support through the ORM"""
+    chat_ids = {chat_id for _, chat_id in members}
+    known_chat_ids_stmt = (
+        select(AbitChatInfo.chat_id)
+        .where(AbitChatInfo.chat_id.in_(chat_ids))
+    )
+    known_chat_ids = set(await session.scalars(known_chat_ids_stmt))
+
+    recorded_members_stmt = (
+        select(ChatMember)
+        .where(tuple_(ChatMember.user_id, ChatMember.chat_id).in_(members))
+    )
+    recorded_members = {
+        (chat_member.user_id, chat_member.chat_id): chat_member
+        for chat_member in await session.scalars(recorded_members_stmt)
+    }
+
+    new_members = []
+    for (user_id, chat_id), member in members.items():
+        chat_member = recorded_members.get((user_id, chat_id))
+        if chat_member:
+            if ((chat_member.full_name, chat_member.username)
+                    != (member.full_name, member.username)):
+                chat_member.full_name = member.full_name
+                chat_member.username = member.username
+        elif chat_id in known_chat_ids:
+            new_members.append(member._asdict())
+    if new_members:
+        await session.execute(insert(ChatMember).values(new_members))
+    await session.flush()
 
 
 class UserPenguinCount(NamedTuple):
-    """The number of penguins sent by a user with user_id"""
+    """The number of penguins sent by a user with user_id. full_name is
+    None if the name of the user has not been recorded yet"""
     user_id: int
     penguin_count: int
+    full_name: str | None = None
 
 
 async def top_users_with_most_sent_penguins_usecase(
@@ -119,45 +628,114 @@ async def top_users_with_most_sent_penguins_usecase(
     If since is not specified, counts from the beginning of the time.
 
     If until is not specified, counts till now.
+
+    Penguins are counted by hours in UTC from PenguinCountBucket, so since
+    is rounded down to its hour and until is rounded up to the end of its
+    hour. Naive bounds are taken as UTC.
     """
-    # Joining ChatMember.penguins, so to count penguins its enough
-    # to count user_id entries, as there will be an entry for every
-    # SentPenguinRecord.
-    penguin_count = func.count(ChatMember.user_id).label('penguin_count')
+    penguin_count = func.sum(PenguinCountBucket.penguin_count)
     stmt = (
-        select(ChatMember.user_id, penguin_count)
+        select(ChatMember.user_id, ChatMember.full_name, penguin_count)
+        .join(PenguinCountBucket,
+              PenguinCountBucket.chat_member_id == ChatMember.id)
         .where(ChatMember.chat_id == chat_id)
-        .join(ChatMember.penguins)
-        .group_by(ChatMember.user_id)
+        .group_by(ChatMember.user_id, ChatMember.full_name)
         .order_by(desc(penguin_count))
         .limit(number)
     )
     if since:
-        stmt = stmt.where(SentPenguinRecord.timestamp >= since)
+        first_hour = _truncate_to_hour(_to_naive_utc(since))
+        stmt = stmt.where(PenguinCountBucket.hour >= first_hour)
     if until:
-        stmt = stmt.where(SentPenguinRecord.timestamp <= until)
+        last_hour = _truncate_to_hour(_to_naive_utc(until))
+        stmt = stmt.where(PenguinCountBucket.hour <= last_hour)
 
     results = await session.execute(stmt)
 
     return [
-        UserPenguinCount(user_id, penguin_count)
-        for user_id, penguin_count in results.tuples()
+        UserPenguinCount(user_id, int(penguin_count), full_name)
+        for user_id, full_name, penguin_count in results.tuples()
     ]
 
 
-async def get_admission_committe_info_usecase(
+class ChatMemberPenguinCount(NamedTuple):
+    """The number of penguins sent by a user with user_id in chat_id"""
+    chat_id: int
+    user_id: int
+    penguin_count: int
+    full_name: str | None = None
+
+
+async def count_sent_penguins_usecase(
         session: AsyncSession,
-        chat_id: int,
-) -> AdmissionCommitteInfo:
-    """Returns the info about the admission for te given chat_id"""
-    admission_committe_info = await session.get(
-        entity=AdmissionCommitteInfo,
-        ident=chat_id,
-        options=[
-            selectinload(AdmissionCommitteInfo.timetable),
-            selectinload(AdmissionCommitteInfo.chat),
-        ],
-    )
-    if not admission_committe_info:
-        raise DoesNotExist
-    return cast(AdmissionCommitteInfo, admission_committe_info)
+) -> list[ChatMemberPenguinCount]:
+    """Counts penguins sent by every chat member in every chat"""
+    penguin_count = func.sum(PenguinCountBucket.penguin_count)
+    stmt = (
+        select(ChatMember.chat_id, ChatMember.user_id, penguin_count,
+               ChatMember.full_name)
+        .join(PenguinCountBucket,
+              PenguinCountBucket.chat_member_id == ChatMember.id)
+        .group_by(ChatMember.chat_id, ChatMember.user_id,
+                  ChatMember.full_name)
+    )
+    results = await session.execute(stmt)
+    return [
+        ChatMemberPenguinCount(chat_id, user_id, int(penguin_count),
+                               full_name)
+        for chat_id, user_id, penguin_count, full_name in results.tuples()
+    ]
+
+
+class MessageDeletion(NamedTuple):
+    """A message scheduled for deletion at delete_at"""
+    chat_id: int
+    message_id: int
+    reply_to_message_id: int | None
+    delete_at: datetime
+
+
+async def list_scheduled_message_deletions_usecase(
+        session: AsyncSession,
+) -> list[MessageDeletion]:
+    """Returns all persisted message deletions with aware delete_at"""
+    stmt = select(ScheduledMessageDeletion.chat_id,
+                  ScheduledMessageDeletion.message_id,
+                  ScheduledMessageDeletion.reply_to_message_id,
+                  ScheduledMessageDeletion.delete_at)
+    results = await session.execute(stmt)
+    return [
+        MessageDeletion(chat_id, message_id, reply_to_message_id,
+                        delete_at.replace(tzinfo=timezone.utc))
+        for chat_id, message_id, reply_to_message_id, delete_at
+        in results.tuples()
+    ]
+
+
+async def save_scheduled_message_deletions_usecase(
+        session: AsyncSession,
+        messages: Collection[tuple[int, int]],
+        deletions: Iterable[MessageDeletion],
+) -> None:
+    """Replaces the persisted deletions of (chat_id, message_id) messages
+    with the given ones. Messages without a new deletion are no longer
+    scheduled for deletion"""
+    if messages:
+        await session.execute(
+            delete(ScheduledMessageDeletion)
+            .where(tuple_(ScheduledMessageDeletion.chat_id,
+                          ScheduledMessageDeletion.message_id).in_(messages))
+        )
+    new_deletions = [
+        {
+            'chat_id': deletion.chat_id,
+            'message_id': deletion.message_id,
+            'reply_to_message_id': deletion.reply_to_message_id,
+            'delete_at': _to_naive_utc(deletion.delete_at),
+        }
+        for deletion in deletions
+    ]
+    if new_deletions:
+        # A single multi-row INSERT for all deletions
+        await session.execute(insert(ScheduledMessageDeletion)
+                              .values(new_deletions))
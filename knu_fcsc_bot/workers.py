@@ -0,0 +1,449 @@
+"""Multi-worker webhook mode.
+
+A thin ingress process accepts webhook requests from Telegram and
+forwards every update to one of N worker processes, which is chosen by
+the chat of the update. All updates of a chat are handled by the same
+worker in the order they were received, so state of a chat, e.g.
+caches, the leaderboard and pending message deletions, lives in one
+process only. Changes of process-wide state, e.g. reloaded filters, are
+broadcast to the other workers through the ingress.
+
+Workers are connected to the ingress with Unix sockets. Both sides
+write JSON lines: the ingress sends `{"update": ...}` and
+`{"control": command}`, and workers send `{"broadcast": command}`."""
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Awaitable
+
+from loguru import logger
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from knu_fcsc_bot.capture import UpdateCapture
+from knu_fcsc_bot.metrics import REGISTRY, Counter, start_metrics_server
+
+INGRESS_UPDATES = REGISTRY.register(Counter(
+    'bot_ingress_updates_total',
+    'Updates forwarded by the webhook ingress',
+    labelnames=('worker',),
+))
+
+# Updates are forwarded as single lines, which must fit in the buffer
+_MAX_LINE_LENGTH = 16 * 1024 * 1024
+# Updates are far smaller, so larger webhook requests are rejected
+# without reading them
+_MAX_BODY_SIZE = 1024 * 1024
+# Seconds to wait for workers to start listening and to stop
+_WORKER_START_TIMEOUT = 120
+_WORKER_STOP_TIMEOUT = 60
+
+_OK_RESPONSE = (b'HTTP/1.1 200 OK\r\n'
+                b'Content-Length: 0\r\n\r\n')
+_BAD_REQUEST_RESPONSE = (b'HTTP/1.1 400 Bad Request\r\n'
+                         b'Content-Length: 0\r\n\r\n')
+_FORBIDDEN_RESPONSE = (b'HTTP/1.1 403 Forbidden\r\n'
+                       b'Content-Length: 0\r\n\r\n')
+_NOT_FOUND_RESPONSE = (b'HTTP/1.1 404 Not Found\r\n'
+                       b'Content-Length: 0\r\n\r\n')
+_PAYLOAD_TOO_LARGE_RESPONSE = (b'HTTP/1.1 413 Payload Too Large\r\n'
+                               b'Connection: close\r\n'
+                               b'Content-Length: 0\r\n\r\n')
+
+# Update fields, which hold an object with the chat
+_CHAT_FIELDS = ('message', 'edited_message', 'channel_post',
+                'edited_channel_post', 'chat_member', 'my_chat_member',
+                'chat_join_request', )
+
+
+@dataclass(frozen=True)
+class WorkerPartition:
+    """A share of chats handled by a worker process"""
+    index: int
+    workers: int
+
+    def owns_chat(self, chat_id: int) -> bool:
+        """Checks whether updates of the chat are sent to this worker"""
+        return chat_id % self.workers == self.index
+
+
+def get_partition_key(data: dict) -> int:
+    """Returns the id of the chat of the update in its JSON form. Updates
+    without a chat are partitioned by the user or the update id"""
+    for field in _CHAT_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        message = callback_query.get('message')
+        if message:
+            return message['chat']['id']
+        return callback_query['from']['id']
+    return data['update_id']
+
+
+class WorkerLink:
+    """The connection of a worker to the ingress. Available in bot_data
+    of workers as 'worker_link'"""
+
+    def __init__(self, partition: WorkerPartition):
+        self.partition = partition
+        self._writer: asyncio.StreamWriter | None = None
+        # command -> a callback, which applies it to bot_data
+        self._control_callbacks: dict[
+            str, Callable[[dict], Awaitable[Any]]] = {}
+
+    def add_control_callback(self, command: str,
+                             callback: Callable[[dict], Awaitable[Any]],
+                             ) -> None:
+        """Registers the callback applying the command broadcast by
+        another worker"""
+        self._control_callbacks[command] = callback
+
+    def broadcast(self, command: str) -> None:
+        """Asks the other workers to apply the command"""
+        if self._writer is None:
+            logger.warning(f'Command {command} is not broadcast, the worker '
+                           f'is not connected to the ingress')
+            return
+        self._writer.write(_encode({'broadcast': command}))
+
+    async def serve(self, app: Application, socket_path: str) -> None:
+        """Feeds updates from the ingress to the application until the
+        ingress disconnects"""
+        disconnected = asyncio.Event()
+
+        async def handle(reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+            self._writer = writer
+            try:
+                while line := await reader.readline():
+                    # A bad message must not stop the worker, which
+                    # would stop every other one as well
+                    try:
+                        await self._handle_message(json.loads(line), app)
+                    except Exception:
+                        logger.exception('Failed to handle a message from '
+                                         'the ingress')
+            except ConnectionError:
+                pass
+            finally:
+                self._writer = None
+                writer.close()
+                disconnected.set()
+
+        server = await asyncio.start_unix_server(handle, path=socket_path,
+                                                 limit=_MAX_LINE_LENGTH)
+        async with server:
+            await disconnected.wait()
+
+    async def _handle_message(self, message: dict,
+                              app: Application) -> None:
+        if 'update' in message:
+            await app.update_queue.put(
+                Update.de_json(message['update'], app.bot))
+        else:
+            await self._apply_control(message['control'], app.bot_data)
+
+    async def _apply_control(self, command: str, bot_data: dict) -> None:
+        callback = self._control_callbacks.get(command)
+        if callback is None:
+            logger.warning(f'Unknown control command {command}')
+            return
+        logger.info(f'Applying {command} broadcast by another worker')
+        try:
+            await callback(bot_data)
+        except Exception:
+            logger.exception(f'Failed to apply {command}')
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode() + b'\n'
+
+
+def _add_signal_handlers(event: asyncio.Event) -> None:
+    """Sets the event on SIGINT and SIGTERM"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, event.set)
+
+
+def run_worker(startup_options: Any,
+               socket_path: str,
+               build_app: Callable[[Any], Application],
+               setup_logging: Callable[[Any], None]) -> None:
+    """The entry point of a worker process. The partition of the worker
+    is taken from `startup_options.partition`"""
+    setup_logging(startup_options)
+    logger.configure(extra={'worker': startup_options.partition.index})
+    asyncio.run(_serve_worker(startup_options, socket_path, build_app))
+
+
+async def _serve_worker(startup_options: Any,
+                        socket_path: str,
+                        build_app: Callable[[Any], Application]) -> None:
+    partition = startup_options.partition
+    app = build_app(startup_options)
+    link = WorkerLink(partition)
+    app.bot_data['worker_link'] = link
+    # Imported here, as callbacks import the whole bot
+    from knu_fcsc_bot.bot.callbacks import (reload_allowed_chats,
+                                            purge_info_menu_cache, )
+    link.add_control_callback('reload_filters', reload_allowed_chats)
+    link.add_control_callback('purge_cache', purge_info_menu_cache)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    logger.info(f'Worker {partition.index} of {partition.workers} started')
+
+    stop = asyncio.Event()
+    _add_signal_handlers(stop)
+    serve_task = asyncio.create_task(link.serve(app, socket_path))
+    stop_task = asyncio.create_task(stop.wait())
+    await asyncio.wait([serve_task, stop_task],
+                       return_when=asyncio.FIRST_COMPLETED)
+    serve_task.cancel()
+    stop_task.cancel()
+
+    # Pending updates are handled before the application stops
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    logger.info(f'Worker {partition.index} stopped')
+
+
+class WebhookIngress:
+    """Accepts webhook requests and forwards updates to workers. If
+    `secret_token` is set, requests without it in the
+    X-Telegram-Bot-Api-Secret-Token header are rejected"""
+
+    def __init__(self, url_path: str, capture: UpdateCapture | None = None,
+                 secret_token: str | None = None):
+        self.url_path = url_path.strip('/')
+        self.capture = capture
+        self.secret_token = secret_token
+        self._writers: list[asyncio.StreamWriter] = []
+        self._readers: list[asyncio.Task] = []
+
+    async def connect(self, socket_paths: list[str]) -> None:
+        """Connects to workers, waiting for them to start listening"""
+        for socket_path in socket_paths:
+            async with asyncio.timeout(_WORKER_START_TIMEOUT):
+                while True:
+                    try:
+                        reader, writer = await asyncio.open_unix_connection(
+                            socket_path, limit=_MAX_LINE_LENGTH)
+                        break
+                    except (FileNotFoundError, ConnectionRefusedError):
+                        await asyncio.sleep(0.1)
+            self._readers.append(asyncio.create_task(
+                self._relay_broadcasts(len(self._writers), reader)))
+            self._writers.append(writer)
+
+    async def disconnect(self) -> None:
+        """Disconnects from workers, which makes them stop"""
+        for writer in self._writers:
+            writer.close()
+        for reader_task in self._readers:
+            reader_task.cancel()
+        await asyncio.gather(*self._readers, return_exceptions=True)
+
+    async def forward(self, data: dict) -> None:
+        """Sends the update to the worker of its chat"""
+        if self.capture:
+            self.capture.capture_data(data)
+        worker = get_partition_key(data) % len(self._writers)
+        writer = self._writers[worker]
+        writer.write(_encode({'update': data}))
+        await writer.drain()
+        INGRESS_UPDATES.inc(str(worker))
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """Answers keep-alive HTTP/1.1 webhook requests"""
+        try:
+            while request_line := await reader.readline():
+                headers = {}
+                while header := (await reader.readline()).strip():
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if not 0 <= content_length <= _MAX_BODY_SIZE:
+                    logger.warning(f'Rejected a webhook request of '
+                                   f'{content_length} bytes')
+                    writer.write(_PAYLOAD_TOO_LARGE_RESPONSE)
+                    await writer.drain()
+                    return
+                body = await reader.readexactly(content_length)
+
+                method, path, *_ = request_line.decode('latin-1').split()
+                if (method != 'POST'
+                        or path.split('?')[0].strip('/') != self.url_path):
+                    writer.write(_NOT_FOUND_RESPONSE)
+                elif not self._is_authorized(headers):
+                    logger.warning('Rejected a webhook request with a wrong '
+                                   'secret token')
+                    writer.write(_FORBIDDEN_RESPONSE)
+                else:
+                    try:
+                        data = json.loads(body)
+                        await self.forward(data)
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning('Received a malformed update')
+                        writer.write(_BAD_REQUEST_RESPONSE)
+                    else:
+                        writer.write(_OK_RESPONSE)
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _is_authorized(self, headers: dict[str, str]) -> bool:
+        if self.secret_token is None:
+            return True
+        secret_token = headers.get('x-telegram-bot-api-secret-token', '')
+        return hmac.compare_digest(secret_token.encode(),
+                                   self.secret_token.encode())
+
+    async def _relay_broadcasts(self, worker: int,
+                                reader: asyncio.StreamReader) -> None:
+        """Sends commands broadcast by the worker to the other ones.
+        Workers, which have disconnected, are skipped"""
+        try:
+            while line := await reader.readline():
+                try:
+                    command = json.loads(line)['broadcast']
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f'Received a malformed broadcast from '
+                                   f'worker {worker}')
+                    continue
+                for other_worker, writer in enumerate(self._writers):
+                    if other_worker == worker or writer.is_closing():
+                        continue
+                    try:
+                        writer.write(_encode({'control': command}))
+                        await writer.drain()
+                    except ConnectionError as e:
+                        logger.warning(f'Failed to send {command} to '
+                                       f'worker {other_worker}: {e}')
+                        writer.close()
+        except ConnectionError:
+            logger.warning(f'Worker {worker} has disconnected')
+
+
+def run_multi_worker_webhook(startup_options: Any,
+                             token: str,
+                             allowed_updates: list[str],
+                             build_app: Callable[[Any], Application],
+                             setup_logging: Callable[[Any], None]) -> None:
+    """Runs the webhook ingress and worker processes. Blocks until
+    SIGINT or SIGTERM is received or a worker exits"""
+    webhook_options = startup_options.webhook_options
+    workers = webhook_options.workers
+    socket_dir = tempfile.mkdtemp(prefix='knu-fcsc-bot-')
+    socket_paths = [os.path.join(socket_dir, f'worker-{index}.sock')
+                    for index in range(workers)]
+
+    # Spawned workers do not inherit threads of loguru and the ingress
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index, socket_path in enumerate(socket_paths):
+        metrics_port = startup_options.metrics_port
+        worker_options = replace(
+            startup_options,
+            # Updates are captured by the ingress
+            capture_path=None,
+            # Every worker serves its metrics on the next port
+            metrics_port=(None if metrics_port is None
+                          else metrics_port + index + 1),
+            partition=WorkerPartition(index, workers),
+        )
+        process = context.Process(
+            target=run_worker,
+            args=(worker_options, socket_path, build_app, setup_logging),
+            name=f'worker-{index}',
+        )
+        process.start()
+        processes.append(process)
+
+    try:
+        asyncio.run(_serve_ingress(startup_options, token, allowed_updates,
+                                   socket_paths, processes))
+    finally:
+        for process in processes:
+            process.join(_WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f'Terminating {process.name}')
+                process.terminate()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+async def _serve_ingress(startup_options: Any,
+                         token: str,
+                         allowed_updates: list[str],
+                         socket_paths: list[str],
+                         processes: list[multiprocessing.Process]) -> None:
+    webhook_options = startup_options.webhook_options
+    capture = None
+    if startup_options.capture_path:
+        capture = UpdateCapture(startup_options.capture_path)
+    ingress = WebhookIngress(webhook_options.url_path, capture,
+                             webhook_options.secret_token)
+    await ingress.connect(socket_paths)
+
+    metrics_server = None
+    if startup_options.metrics_port is not None:
+        metrics_server = await start_metrics_server(
+            host=startup_options.metrics_host,
+            port=startup_options.metrics_port,
+        )
+    server = await asyncio.start_server(ingress.handle_connection,
+                                        host=webhook_options.host,
+                                        port=webhook_options.port)
+
+    webhook_url = webhook_options.webhook_url
+    if not webhook_url:
+        # The same guess as Application.run_webhook() makes
+        webhook_url = (f'http://{webhook_options.host}:'
+                       f'{webhook_options.port}/'
+                       f'{webhook_options.url_path.lstrip("/")}')
+    async with Bot(token) as bot:
+        await bot.set_webhook(url=webhook_url,
+                              allowed_updates=allowed_updates,
+                              secret_token=webhook_options.secret_token)
+    logger.info(f'Forwarding updates from {webhook_url} to '
+                f'{len(socket_paths)} workers')
+
+    stop = asyncio.Event()
+    _add_signal_handlers(stop)
+    loop = asyncio.get_running_loop()
+    # Waiting in threads, as multiprocessing has no async API
+    worker_exits = [
+        loop.run_in_executor(None, process.join)
+        for process in processes
+    ]
+    stop_task = asyncio.create_task(stop.wait())
+    done, _ = await asyncio.wait([stop_task, *worker_exits],
+                                 return_when=asyncio.FIRST_COMPLETED)
+    if stop_task not in done:
+        logger.error('A worker exited unexpectedly, stopping')
+    stop_task.cancel()
+
+    server.close()
+    await server.wait_closed()
+    await ingress.disconnect()
+    if capture:
+        capture.close()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    logger.info('Stopped the webhook ingress')
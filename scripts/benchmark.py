@@ -0,0 +1,328 @@
+"""Benchmarks the handler chain of the bot against a fake Bot API server.
+
+Synthesizes a mix of updates, feeds them to the real application through
+getUpdates of the fake server and reports the throughput, latency
+percentiles and database queries per update.
+
+Usage:
+
+    DATABASE_URL=... python -m scripts.benchmark --updates 2000
+
+The database must be disposable: the schema is created if missing, and
+a benchmark chat with its members and penguins is written into it."""
+import asyncio
+import os
+import random
+import statistics
+import time
+from argparse import ArgumentParser
+from datetime import timedelta, date, time as dt_time
+from functools import wraps
+from typing import Any, Callable
+
+from loguru import logger
+from sqlalchemy import event, select
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, CallbackContext
+
+from knu_fcsc_bot.__main__ import (StartupOptions, build_application,
+                                   ALLOWED_UPDATES, )
+from knu_fcsc_bot.fake_bot_api import (FakeBotApi, FAKE_BOT_TOKEN,
+                                       FAKE_BOT_USER, )
+from knu_fcsc_bot.logginig import (redirect_standard_logging_to_loguru,
+                                   disable_low_level_logs, set_logging_level, )
+from knu_fcsc_bot.models import (Base, AbitChatInfo, Program, UsefulLink,
+                                 AdmissionCommitteInfo,
+                                 AdmissionCommitteTimetableRecord, )
+
+BENCHMARK_CHAT_ID = -1009999999999
+PENGUIN_GIF_FILE_UNIQUE_ID = 'AQADfwADr7SkUnI'
+DEFAULT_MIX = 'join=1,click=6,gif=4,command=2,text=10'
+MENU_CALLBACK_DATA = ['programs', 'main_menu', 'useful_links',
+                      'admission_committe', ]
+COMMANDS = ['/info', '/top_penguins', '/top_penguins today',
+            '/top_penguins week', ]
+
+
+class UpdateTracker:
+    """Tracks when the handlers of every update have finished"""
+
+    def __init__(self):
+        self.in_flight = 0
+        # update_id -> time.perf_counter() when its last handler finished
+        self.finished_at: dict[int, float] = {}
+
+    def wrap(self, callback: Callable) -> Callable:
+        @wraps(callback)
+        async def wrapper(update: Update, context: CallbackContext) -> Any:
+            self.in_flight += 1
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                raise
+            except Exception:
+                logger.exception(f'Handler {callback.__name__} failed')
+            finally:
+                self.in_flight -= 1
+                self.finished_at[update.update_id] = time.perf_counter()
+
+        return wrapper
+
+    def instrument(self, app: Application) -> None:
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = self.wrap(handler.callback)
+
+
+class UpdateFactory:
+    """Synthesizes updates from the benchmark chat"""
+
+    def __init__(self, rng: random.Random, users: int,
+                 program_ids: list[int]):
+        self.rng = rng
+        self.user_ids = [1_000_000 + i for i in range(users)]
+        self.program_ids = program_ids
+        self._update_ids = iter(range(1, 10 ** 9))
+        self._message_ids = iter(range(1, 10 ** 9))
+        self._chat = {'id': BENCHMARK_CHAT_ID, 'type': 'supergroup',
+                      'title': 'Benchmark'}
+
+    def make(self, kind: str) -> dict:
+        user_id = self.rng.choice(self.user_ids)
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'User',
+                'last_name': str(user_id), 'username': f'user{user_id}'}
+        update = {'update_id': next(self._update_ids)}
+        now = int(time.time())
+
+        if kind == 'join':
+            update['chat_member'] = {
+                'chat': self._chat,
+                'from': user,
+                'date': now,
+                'old_chat_member': {'status': 'left', 'user': user},
+                'new_chat_member': {'status': 'member', 'user': user},
+            }
+        elif kind == 'click':
+            data = self.rng.choice(MENU_CALLBACK_DATA + ['program_by_id'])
+            if data == 'program_by_id' and self.program_ids:
+                data = f'program_by_id:{self.rng.choice(self.program_ids)}'
+            update['callback_query'] = {
+                'id': str(update['update_id']),
+                'from': user,
+                'chat_instance': 'benchmark',
+                'data': data,
+                'message': {
+                    'message_id': next(self._message_ids),
+                    'date': now,
+                    'chat': self._chat,
+                    'from': FAKE_BOT_USER,
+                    'photo': [{'file_id': 'photo', 'file_unique_id': 'photo',
+                               'width': 1, 'height': 1}],
+                    'caption': 'Menu',
+                },
+            }
+        else:
+            message = {
+                'message_id': next(self._message_ids),
+                'date': now,
+                'chat': self._chat,
+                'from': user,
+            }
+            if kind == 'gif':
+                message['animation'] = {
+                    'file_id': 'penguin',
+                    'file_unique_id': PENGUIN_GIF_FILE_UNIQUE_ID,
+                    'width': 1, 'height': 1, 'duration': 1,
+                }
+            elif kind == 'command':
+                text = self.rng.choice(COMMANDS)
+                command_length = len(text.split()[0])
+                message['text'] = text
+                message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                        'length': command_length}]
+            else:
+                message['text'] = 'Hello'
+            update['message'] = message
+        return update
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    """Parses kind=weight pairs separated by commas"""
+    weights = {}
+    for pair in mix.split(','):
+        kind, _, weight = pair.partition('=')
+        weights[kind.strip()] = int(weight)
+    return weights
+
+
+async def seed_database(app: Application) -> list[int]:
+    """Creates the schema if missing and the benchmark chat. Returns ids
+    of its programs"""
+    engine = app.bot_data['AsyncSession'].kw['bind']
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    async with app.bot_data['AsyncSession']() as session:
+        chat_info = await session.get(AbitChatInfo, BENCHMARK_CHAT_ID)
+        if chat_info is None:
+            today = date.today()
+            session.add(AbitChatInfo(
+                chat_id=BENCHMARK_CHAT_ID,
+                greeting_photo_file_id='photo',
+                flood_chat_link='https://t.me/benchmark',
+                programs=[
+                    Program(title=f'Program {i}',
+                            guide_url=f'https://example.com/{i}')
+                    for i in range(5)
+                ],
+                useful_links=[
+                    UsefulLink(title=f'Link {i}',
+                               url=f'https://example.com/link/{i}')
+                    for i in range(8)
+                ],
+                admission_committe_info=AdmissionCommitteInfo(
+                    queue_url='https://example.com/queue',
+                    timetable=[
+                        AdmissionCommitteTimetableRecord(
+                            date=today + timedelta(days=i),
+                            work_start=dt_time(9),
+                            work_end=dt_time(17),
+                        )
+                        for i in range(-7, 7)
+                    ],
+                ),
+            ))
+            await session.commit()
+        programs = await session.scalars(
+            select(Program.id).where(Program.chat_id == BENCHMARK_CHAT_ID)
+        )
+        return list(programs)
+
+
+def percentile(values: list[float], share: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[
+        int(share * 100) - 1]
+
+
+async def run_benchmark(updates: int, rate: float, api_latency: timedelta,
+                        mix: dict[str, int], users: int, seed: int,
+                        rate_limit: bool = False) -> None:
+    api = FakeBotApi(latency=api_latency)
+    await api.start()
+
+    app = build_application(StartupOptions(), token=FAKE_BOT_TOKEN,
+                            base_url=api.base_url, rate_limit=rate_limit)
+    program_ids = await seed_database(app)
+    tracker = UpdateTracker()
+    tracker.instrument(app)
+
+    queries = 0
+
+    def count_query(*args):
+        nonlocal queries
+        queries += 1
+
+    engine = app.bot_data['AsyncSession'].kw['bind']
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=1,
+                                    allowed_updates=ALLOWED_UPDATES)
+    await app.start()
+    # Warm-up queries of post_init are not counted
+    event.listen(engine.sync_engine, 'before_cursor_execute', count_query)
+
+    factory = UpdateFactory(random.Random(seed), users, program_ids)
+    kinds = factory.rng.choices(list(mix), weights=list(mix.values()),
+                                k=updates)
+    for kind in kinds:
+        api.put_update(factory.make(kind))
+        if rate:
+            await asyncio.sleep(1 / rate)
+
+    # Waiting until every update is handled
+    settled_checks = 0
+    while settled_checks < 3:
+        await asyncio.sleep(0.05)
+        if (api.pending_updates or not app.update_queue.empty()
+                or tracker.in_flight):
+            settled_checks = 0
+        else:
+            settled_checks += 1
+    event.remove(engine.sync_engine, 'before_cursor_execute', count_query)
+
+    await app.updater.stop()
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await engine.dispose()
+    await api.stop()
+
+    latencies = [
+        tracker.finished_at[update_id] - delivered_at
+        for update_id, delivered_at in api.delivered_at.items()
+        if update_id in tracker.finished_at
+    ]
+    print(f'Updates:           {len(latencies)} of {updates}')
+    print(f'Mix:               {dict(sorted(mix.items()))}')
+    if not latencies:
+        print('No updates finished')
+        print(f'Bot API calls:     {dict(api.calls.most_common())}')
+        return
+    duration = (max(tracker.finished_at.values())
+                - min(api.delivered_at.values()))
+    print(f'Throughput:        {len(latencies) / duration:.1f} updates/s')
+    print(f'Latency p50:       {percentile(latencies, 0.5) * 1000:.1f} ms')
+    print(f'Latency p99:       {percentile(latencies, 0.99) * 1000:.1f} ms')
+    print(f'DB queries/update: {queries / len(latencies):.2f}')
+    print(f'Bot API calls:     {dict(api.calls.most_common())}')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--updates', '-n', type=int, default=1000,
+                        help='The number of updates to send')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Updates per second. By default all updates '
+                             'are queued at once')
+    parser.add_argument('--api-latency', type=float, default=50,
+                        help='Latency of the fake Bot API in milliseconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Weights of update kinds: join, click, gif, '
+                             f'command and text. Defaults to {DEFAULT_MIX}')
+    parser.add_argument('--users', type=int, default=500,
+                        help='The number of distinct users')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the update generator')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='If present, requests are throttled to the '
+                             'Telegram flood limits, as in production. All '
+                             'updates come from a single chat, so it '
+                             'limits the bot to 20 messages per minute')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='If present, logs the bot at INFO level')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('Environmental variable "DATABASE_URL" is not set.')
+
+    redirect_standard_logging_to_loguru()
+    disable_low_level_logs()
+    set_logging_level('INFO' if args.verbose else 'WARNING')
+
+    asyncio.run(run_benchmark(
+        updates=args.updates,
+        rate=args.rate,
+        api_latency=timedelta(milliseconds=args.api_latency),
+        mix=parse_mix(args.mix),
+        users=args.users,
+        seed=args.seed,
+        rate_limit=args.rate_limit,
+    ))
+
+
+if __name__ == '__main__':
+    main()
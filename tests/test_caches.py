@@ -0,0 +1,154 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+import pytest
+
+from knu_fcsc_bot import usecases
+from knu_fcsc_bot.bot.caches import TTLCache, InfoMenuCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A fake monotonic clock, which is moved with `clock.advance()`"""
+
+    class Clock:
+        now = 1000.0
+
+        def advance(self, seconds: float) -> None:
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', lambda: clock.now)
+    return clock
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = TTLCache(max_size=10, time_to_live=timedelta(seconds=5))
+    cache.set('a', 1)
+    cache.set('b', 2, time_to_live=timedelta(seconds=30))
+
+    clock.advance(4)
+    assert cache.get('a') == 1
+
+    clock.advance(2)
+    with pytest.raises(KeyError):
+        cache.get('a')
+    assert cache.get('b') == 2
+    assert cache.stats.hits == 2
+    assert cache.stats.misses == 1
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = TTLCache(max_size=2, time_to_live=timedelta(minutes=1))
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+    with pytest.raises(KeyError):
+        cache.get('b')
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl_cache_removes_expired(clock):
+    cache = TTLCache(max_size=10, time_to_live=timedelta(seconds=5))
+    cache.set('a', 1)
+    cache.set('b', 2, time_to_live=timedelta(minutes=1))
+
+    clock.advance(10)
+
+    assert cache.remove_expired() == 1
+    assert len(cache) == 1
+
+
+@asynccontextmanager
+async def fake_sessionmaker():
+    yield None
+
+
+class FakeInfoMenuLoader:
+    """Replaces usecases.get_info_menu_snapshot_usecase with loads, which
+    finish when `release()` is called"""
+
+    def __init__(self):
+        self.loads = 0
+        self.value = 'menu'
+        self._released = asyncio.Event()
+
+    def release(self) -> None:
+        self._released.set()
+
+    async def wait_for_loads(self, loads: int) -> None:
+        while self.loads < loads:
+            await asyncio.sleep(0)
+
+    async def __call__(self, session, chat_id):
+        self.loads += 1
+        value = self.value
+        await self._released.wait()
+        if value is None:
+            raise usecases.DoesNotExist
+        return value
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    loader = FakeInfoMenuLoader()
+    monkeypatch.setattr(usecases, 'get_info_menu_snapshot_usecase', loader)
+    return loader
+
+
+def test_info_menu_cache_shares_concurrent_loads(loader):
+    async def main():
+        cache = InfoMenuCache(fake_sessionmaker)
+        gets = [asyncio.create_task(cache.get_info_menu(1))
+                for _ in range(5)]
+        await loader.wait_for_loads(1)
+        loader.release()
+
+        assert await asyncio.gather(*gets) == ['menu'] * 5
+        assert loader.loads == 1
+        assert await cache.get_info_menu(1) == 'menu'
+        assert loader.loads == 1
+
+    asyncio.run(main())
+
+
+def test_info_menu_cache_drops_loads_started_before_invalidation(loader):
+    async def main():
+        cache = InfoMenuCache(fake_sessionmaker)
+        stale_get = asyncio.create_task(cache.get_info_menu(1))
+        await loader.wait_for_loads(1)
+
+        cache.invalidate_chat(1)
+        loader.value = 'new menu'
+        fresh_get = asyncio.create_task(cache.get_info_menu(1))
+        await loader.wait_for_loads(2)
+        loader.release()
+
+        assert await stale_get == 'menu'
+        assert await fresh_get == 'new menu'
+        assert loader.loads == 2
+        assert await cache.get_info_menu(1) == 'new menu'
+        assert loader.loads == 2
+
+    asyncio.run(main())
+
+
+def test_info_menu_cache_caches_missing_chats(loader):
+    async def main():
+        cache = InfoMenuCache(fake_sessionmaker)
+        loader.value = None
+        loader.release()
+
+        for _ in range(2):
+            with pytest.raises(usecases.DoesNotExist):
+                await cache.get_info_menu(1)
+        assert loader.loads == 1
+
+    asyncio.run(main())
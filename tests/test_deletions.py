@@ -0,0 +1,116 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from telegram import Bot, Chat, Message
+
+from knu_fcsc_bot.bot.deletions import MessageDeletionScheduler
+from knu_fcsc_bot.fake_bot_api import FakeBotApi, FAKE_BOT_TOKEN
+
+CHAT = Chat(id=-100, type=Chat.SUPERGROUP)
+# Deadlines are rounded up to seconds, so these messages are due at once
+OVERDUE = timedelta(seconds=-1)
+
+
+class BulkDeletingBot(Bot):
+    """A bot with do_api_request() of python-telegram-bot 20.8+"""
+
+    async def do_api_request(self, endpoint, api_kwargs=None):
+        return await self._post(endpoint, api_kwargs)
+
+
+@asynccontextmanager
+async def running_bot(api: FakeBotApi, bot_class: type[Bot] = Bot):
+    """Yields a bot talking to the started fake Bot API"""
+    await api.start()
+    try:
+        async with bot_class(FAKE_BOT_TOKEN, base_url=api.base_url) as bot:
+            yield bot
+    finally:
+        await api.stop()
+
+
+def make_message(message_id: int,
+                 reply_to_message: Message | None = None) -> Message:
+    return Message(message_id=message_id, date=datetime.now(timezone.utc),
+                   chat=CHAT, reply_to_message=reply_to_message)
+
+
+def schedule_overdue(scheduler: MessageDeletionScheduler) -> None:
+    scheduler.schedule(make_message(1), after=OVERDUE)
+    scheduler.schedule(make_message(2, reply_to_message=make_message(3)),
+                       after=OVERDUE, with_reply_to=True)
+    scheduler.schedule(make_message(4), after=timedelta(hours=1))
+
+
+def get_deleted_message_ids(api: FakeBotApi, method: str) -> list[int]:
+    return sorted(params['message_id']
+                  for called_method, params in api.requests
+                  if called_method == method)
+
+
+def test_delete_due_deletes_one_by_one_without_do_api_request():
+    async def main():
+        api = FakeBotApi()
+        async with running_bot(api) as bot:
+            scheduler = MessageDeletionScheduler(bot, sessionmaker=None)
+            schedule_overdue(scheduler)
+            await scheduler.delete_due()
+
+        assert api.calls['deleteMessages'] == 0
+        assert get_deleted_message_ids(api, 'deleteMessage') == [1, 2, 3]
+        assert scheduler.deleted_messages == 3
+        assert len(scheduler) == 1
+
+    asyncio.run(main())
+
+
+def test_delete_due_deletes_in_bulk():
+    async def main():
+        api = FakeBotApi()
+        async with running_bot(api, BulkDeletingBot) as bot:
+            scheduler = MessageDeletionScheduler(bot, sessionmaker=None)
+            schedule_overdue(scheduler)
+            await scheduler.delete_due()
+
+        assert api.calls['deleteMessage'] == 0
+        [params] = [params for method, params in api.requests
+                    if method == 'deleteMessages']
+        assert params['chat_id'] == CHAT.id
+        assert sorted(params['message_ids']) == [1, 2, 3]
+        assert scheduler.deleted_messages == 3
+
+    asyncio.run(main())
+
+
+def test_delete_due_falls_back_to_one_by_one():
+    async def main():
+        api = FakeBotApi()
+        api.failing_methods.add('deleteMessages')
+        async with running_bot(api, BulkDeletingBot) as bot:
+            scheduler = MessageDeletionScheduler(bot, sessionmaker=None)
+            schedule_overdue(scheduler)
+            await scheduler.delete_due()
+
+        assert api.calls['deleteMessages'] == 1
+        assert scheduler.failed_bulk_deletions == 1
+        assert get_deleted_message_ids(api, 'deleteMessage') == [1, 2, 3]
+        assert scheduler.deleted_messages == 3
+
+    asyncio.run(main())
+
+
+def test_delete_due_skips_messages_failing_to_delete():
+    async def main():
+        api = FakeBotApi()
+        api.failing_methods.add('deleteMessage')
+        async with running_bot(api) as bot:
+            scheduler = MessageDeletionScheduler(bot, sessionmaker=None)
+            schedule_overdue(scheduler)
+            await scheduler.delete_due()
+
+        assert api.calls['deleteMessage'] == 3
+        assert scheduler.deleted_messages == 0
+        assert len(scheduler) == 1
+
+    asyncio.run(main())
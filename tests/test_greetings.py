@@ -0,0 +1,228 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from telegram import Bot, User
+
+from knu_fcsc_bot.bot import greetings
+from knu_fcsc_bot.bot.deletions import MessageDeletionScheduler
+from knu_fcsc_bot.bot.greetings import GreetingAggregator
+from knu_fcsc_bot.fake_bot_api import FakeBotApi, FAKE_BOT_TOKEN
+from knu_fcsc_bot.usecases import InfoMenuSnapshot
+
+CHAT_ID = -100
+INFO_MENU = InfoMenuSnapshot(chat_id=CHAT_ID,
+                             greeting_photo_file_id='greeting',
+                             flood_chat_link='https://t.me/flood',
+                             programs=(), useful_links=(),
+                             admission_committe=None)
+USERS = [User(id=user_id, first_name=f'User{user_id}', is_bot=False)
+         for user_id in range(1, 21)]
+
+
+class FakeClock:
+    """A fake monotonic clock for GreetingAggregator. Its sleeps finish
+    when the clock is moved past them with `advance()`"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self._sleepers: list[tuple[float, asyncio.Future]] = []
+
+    @property
+    def sleeping(self) -> int:
+        return sum(1 for _, future in self._sleepers if not future.done())
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+        for deadline, future in self._sleepers:
+            if deadline <= self.now and not future.done():
+                future.set_result(None)
+
+    async def sleep(self, duration: timedelta,
+                    stopping: asyncio.Event) -> None:
+        if stopping.is_set() or duration <= timedelta(0):
+            return
+        sleeper = (self.now + duration.total_seconds(),
+                   asyncio.get_running_loop().create_future())
+        self._sleepers.append(sleeper)
+        stopped = asyncio.ensure_future(stopping.wait())
+        try:
+            await asyncio.wait([sleeper[1], stopped],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+            self._sleepers.remove(sleeper)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(greetings, 'time',
+                        SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+@asynccontextmanager
+async def running_aggregator(api: FakeBotApi, clock: FakeClock, **kwargs):
+    """Yields an aggregator sending greetings to the started fake Bot API
+    and sleeping on the fake clock. It is stopped on exit"""
+    await api.start()
+    try:
+        async with Bot(FAKE_BOT_TOKEN, base_url=api.base_url) as bot:
+            aggregator = GreetingAggregator(
+                bot,
+                MessageDeletionScheduler(bot, sessionmaker=None),
+                delete_after=timedelta(minutes=5),
+                **kwargs,
+            )
+
+            async def sleep(duration: timedelta) -> None:
+                await clock.sleep(duration, aggregator._stopping)
+
+            aggregator._sleep = sleep
+            yield aggregator
+            await aggregator.stop()
+    finally:
+        await api.stop()
+
+
+async def advance(clock: FakeClock, aggregator: GreetingAggregator,
+                  seconds: float) -> None:
+    """Moves the clock and waits until every chat of the aggregator is
+    greeted or sleeps again"""
+
+    async def settle():
+        while clock.sleeping != sum(1 for chat in aggregator._chats.values()
+                                    if chat.task is not None):
+            await asyncio.sleep(0.001)
+
+    # New chat tasks start sleeping before the clock is moved
+    await asyncio.wait_for(settle(), timeout=5)
+    clock.advance(seconds)
+    await asyncio.wait_for(settle(), timeout=5)
+
+
+def get_captions(api: FakeBotApi, method: str) -> list[str]:
+    return [params['caption'] for called_method, params in api.requests
+            if called_method == method]
+
+
+def mentions(*users: User) -> str:
+    return ', '.join(user.mention_html() for user in users)
+
+
+def test_joins_within_the_join_window_are_greeted_together(clock):
+    async def main():
+        api = FakeBotApi()
+        async with running_aggregator(api, clock) as aggregator:
+            aggregator.add(CHAT_ID, USERS[0], INFO_MENU)
+            await advance(clock, aggregator, 2)
+            aggregator.add(CHAT_ID, USERS[1], INFO_MENU)
+            await advance(clock, aggregator, 0.5)
+            assert api.calls['sendPhoto'] == 0
+
+            await advance(clock, aggregator, 0.5)
+
+            [caption] = get_captions(api, 'sendPhoto')
+            assert mentions(USERS[0], USERS[1]) in caption
+            assert aggregator.stats.joins == 2
+            assert aggregator.stats.sent_greetings == 1
+            assert aggregator.queue_depth == 0
+
+    asyncio.run(main())
+
+
+def test_joins_within_the_edit_window_edit_the_greeting(clock):
+    async def main():
+        api = FakeBotApi()
+        async with running_aggregator(api, clock) as aggregator:
+            aggregator.add(CHAT_ID, USERS[0], INFO_MENU)
+            await advance(clock, aggregator, 3)
+
+            aggregator.add(CHAT_ID, USERS[1], INFO_MENU)
+            # Rejoining users are not mentioned twice
+            aggregator.add(CHAT_ID, USERS[0], INFO_MENU)
+            await advance(clock, aggregator, 3)
+
+            assert api.calls['sendPhoto'] == 1
+            [caption] = get_captions(api, 'editMessageCaption')
+            assert mentions(USERS[0], USERS[1]) in caption
+            assert aggregator.stats.edited_greetings == 1
+
+            await advance(clock, aggregator, 60)
+            aggregator.add(CHAT_ID, USERS[2], INFO_MENU)
+            await advance(clock, aggregator, 3)
+
+            assert api.calls['sendPhoto'] == 2
+            assert api.calls['editMessageCaption'] == 1
+            assert mentions(USERS[2]) in get_captions(api, 'sendPhoto')[1]
+
+    asyncio.run(main())
+
+
+def test_users_over_max_mentions_are_counted(clock):
+    async def main():
+        api = FakeBotApi()
+        async with running_aggregator(api, clock,
+                                      max_mentions=2) as aggregator:
+            for user in USERS[:3]:
+                aggregator.add(CHAT_ID, user, INFO_MENU)
+            await advance(clock, aggregator, 3)
+
+            [caption] = get_captions(api, 'sendPhoto')
+            assert f'{mentions(USERS[0], USERS[1])} та ще 1' in caption
+
+            # The greeting has no mentions to spare, so a new one is sent
+            aggregator.add(CHAT_ID, USERS[3], INFO_MENU)
+            await advance(clock, aggregator, 3)
+
+            assert api.calls['sendPhoto'] == 2
+            assert api.calls['editMessageCaption'] == 0
+
+    asyncio.run(main())
+
+
+def test_greetings_are_rate_limited(clock):
+    async def main():
+        api = FakeBotApi()
+        async with running_aggregator(
+                api, clock, edit_window=timedelta(0),
+                max_greetings_per_minute=2) as aggregator:
+            for user in USERS[:2]:
+                aggregator.add(CHAT_ID, user, INFO_MENU)
+                await advance(clock, aggregator, 3)
+            assert api.calls['sendPhoto'] == 2
+
+            aggregator.add(CHAT_ID, USERS[2], INFO_MENU)
+            await advance(clock, aggregator, 3)
+            aggregator.add(CHAT_ID, USERS[3], INFO_MENU)
+            await advance(clock, aggregator, 50)
+
+            assert api.calls['sendPhoto'] == 2
+            assert aggregator.stats.rate_limited_greetings == 1
+
+            # A minute has passed since the first greeting
+            await advance(clock, aggregator, 4)
+
+            assert api.calls['sendPhoto'] == 3
+            assert mentions(USERS[2], USERS[3]) in get_captions(
+                api, 'sendPhoto')[2]
+
+    asyncio.run(main())
+
+
+def test_stop_greets_pending_users(clock):
+    async def main():
+        api = FakeBotApi()
+        async with running_aggregator(api, clock) as aggregator:
+            aggregator.add(CHAT_ID, USERS[0], INFO_MENU)
+            await advance(clock, aggregator, 1)
+            await aggregator.stop()
+
+            [caption] = get_captions(api, 'sendPhoto')
+            assert mentions(USERS[0]) in caption
+            assert aggregator.queue_depth == 0
+
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+from knu_fcsc_bot.bot.leaderboard import _ChatLeaderboard, PenguinLeaderboard
+from knu_fcsc_bot.usecases import UserPenguinCount, ChatMemberPenguinCount
+
+
+def test_chat_leaderboard_orders_users_by_count():
+    leaderboard = _ChatLeaderboard()
+    leaderboard.increment(1, full_name='Alice')
+    leaderboard.increment(2, by=3, full_name='Bob')
+    leaderboard.increment(3, by=2)
+    leaderboard.increment(1, by=2)
+
+    assert leaderboard.top(10) == [
+        # Bob has reached 3 penguins before Alice
+        UserPenguinCount(2, 3, 'Bob'),
+        UserPenguinCount(1, 3, 'Alice'),
+        UserPenguinCount(3, 2, None),
+    ]
+    assert leaderboard.top(2) == [UserPenguinCount(2, 3, 'Bob'),
+                                  UserPenguinCount(1, 3, 'Alice')]
+    assert leaderboard.top(0) == []
+    assert leaderboard.get(1) == 3
+    assert leaderboard.get(4) == 0
+    assert len(leaderboard) == 3
+
+
+def test_chat_leaderboard_drops_empty_buckets():
+    leaderboard = _ChatLeaderboard()
+    leaderboard.increment(1)
+    leaderboard.increment(2)
+    leaderboard.increment(1)
+    leaderboard.increment(2)
+
+    assert leaderboard._distinct_counts == [2]
+    assert list(leaderboard._buckets) == [2]
+    assert leaderboard.top(10) == [UserPenguinCount(1, 2),
+                                   UserPenguinCount(2, 2)]
+
+
+def test_penguin_leaderboard_keeps_chats_apart():
+    leaderboard = PenguinLeaderboard()
+    leaderboard.load([ChatMemberPenguinCount(-100, 1, 5, 'Alice'),
+                      ChatMemberPenguinCount(-200, 2, 1, 'Bob')])
+    leaderboard.increment(-200, 1, full_name='Alice')
+
+    assert leaderboard.top(-100) == [UserPenguinCount(1, 5, 'Alice')]
+    assert leaderboard.top(-200) == [UserPenguinCount(2, 1, 'Bob'),
+                                     UserPenguinCount(1, 1, 'Alice')]
+    assert leaderboard.top(-300) == []
+    assert leaderboard.versions == {-200: 1}
+
+
+def test_reconcile_replaces_drifted_counts():
+    leaderboard = PenguinLeaderboard()
+    leaderboard.load([ChatMemberPenguinCount(-100, 1, 5),
+                      ChatMemberPenguinCount(-100, 2, 1),
+                      ChatMemberPenguinCount(-200, 3, 1)])
+
+    drifted = leaderboard.reconcile(
+        [ChatMemberPenguinCount(-100, 1, 5),
+         ChatMemberPenguinCount(-100, 4, 2),
+         ChatMemberPenguinCount(-300, 5, 1)],
+        leaderboard.versions,
+    )
+
+    # User 2 and chat -200 are missing, users 4 and 5 are new
+    assert drifted == 4
+    assert leaderboard.top(-100) == [UserPenguinCount(1, 5),
+                                     UserPenguinCount(4, 2)]
+    assert leaderboard.top(-200) == []
+    assert leaderboard.top(-300) == [UserPenguinCount(5, 1)]
+
+
+def test_reconcile_skips_chats_incremented_during_the_query():
+    leaderboard = PenguinLeaderboard()
+    leaderboard.load([ChatMemberPenguinCount(-100, 1, 5),
+                      ChatMemberPenguinCount(-200, 2, 1)])
+    versions = leaderboard.versions
+    leaderboard.increment(-100, 1)
+
+    drifted = leaderboard.reconcile(
+        [ChatMemberPenguinCount(-100, 1, 5),
+         ChatMemberPenguinCount(-200, 2, 3)],
+        versions,
+    )
+
+    assert drifted == 1
+    assert leaderboard.top(-100) == [UserPenguinCount(1, 6)]
+    assert leaderboard.top(-200) == [UserPenguinCount(2, 3)]
@@ -0,0 +1,134 @@
+import asyncio
+import math
+
+import pytest
+
+from knu_fcsc_bot.capture import format_timing_report
+from knu_fcsc_bot.metrics import (Counter, Histogram, CollectedMetric,
+                                  Registry, start_metrics_server, )
+
+
+def parse_samples(text: str) -> dict[str, float]:
+    """Parses sample lines of the Prometheus text format into
+    {name with labels: value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        samples[name] = float(value)
+    return samples
+
+
+def test_counter_renders_labelled_samples():
+    counter = Counter('requests_total', 'Requests', labelnames=('method',))
+    counter.inc('get')
+    counter.inc('get', amount=2)
+    counter.inc('post')
+
+    lines = counter.render().splitlines()
+
+    assert lines[:2] == ['# HELP requests_total Requests',
+                         '# TYPE requests_total counter']
+    assert parse_samples(counter.render()) == {
+        'requests_total{method="get"}': 3,
+        'requests_total{method="post"}': 1,
+    }
+
+
+def test_label_values_are_escaped():
+    counter = Counter('errors_total', 'Errors', labelnames=('error',))
+    counter.inc('a "quoted"\\path\nline')
+
+    assert ('errors_total{error="a \\"quoted\\"\\\\path\\nline"} 1.0'
+            in counter.render().splitlines())
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('duration_seconds', 'Durations',
+                          labelnames=('handler',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value, 'info')
+
+    assert parse_samples(histogram.render()) == {
+        'duration_seconds_bucket{handler="info",le="0.1"}': 1,
+        'duration_seconds_bucket{handler="info",le="1.0"}': 3,
+        'duration_seconds_bucket{handler="info",le="+Inf"}': 4,
+        'duration_seconds_sum{handler="info"}': pytest.approx(4.25),
+        'duration_seconds_count{handler="info"}': 4,
+    }
+    assert histogram.count_and_sum('info') == (4, pytest.approx(4.25))
+
+
+def test_histogram_quantile_interpolates_within_buckets():
+    histogram = Histogram('duration_seconds', 'Durations',
+                          buckets=(1.0, 2.0))
+    for value in (0.5, 1.5, 1.5, 5.0):
+        histogram.observe(value)
+
+    assert histogram.quantile(0.25) == pytest.approx(1.0)
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    # Observations above the last bucket are estimated by its bound
+    assert histogram.quantile(0.99) == pytest.approx(2.0)
+    assert math.isnan(histogram.quantile(0.5, 'unknown'))
+
+
+def test_collected_metric_renders_collected_samples():
+    gauge = CollectedMetric('queue_depth', 'Queue depth', 'gauge',
+                            collect=lambda: [(('a',), 2), (('b',), 0)],
+                            labelnames=('queue',))
+
+    assert '# TYPE queue_depth gauge' in gauge.render()
+    assert parse_samples(gauge.render()) == {
+        'queue_depth{queue="a"}': 2,
+        'queue_depth{queue="b"}': 0,
+    }
+
+
+def test_registry_skips_failing_metrics():
+    def collect():
+        raise RuntimeError
+
+    registry = Registry()
+    registry.register(CollectedMetric('broken', 'Broken', 'gauge', collect))
+    counter = registry.register(Counter('requests_total', 'Requests'))
+    counter.inc()
+
+    assert parse_samples(registry.render()) == {'requests_total': 1}
+
+
+def test_metrics_are_served():
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests')).inc()
+
+    async def scrape(path: str) -> tuple[bytes, bytes]:
+        server = await start_metrics_server('127.0.0.1', 0, registry)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        server.close()
+        status_line, _, rest = response.partition(b'\r\n')
+        return status_line, rest.partition(b'\r\n\r\n')[2]
+
+    status_line, body = asyncio.run(scrape('/metrics'))
+    assert status_line == b'HTTP/1.1 200 OK'
+    assert parse_samples(body.decode()) == {'requests_total': 1}
+
+    status_line, _ = asyncio.run(scrape('/other'))
+    assert status_line == b'HTTP/1.1 404 Not Found'
+
+
+def test_format_timing_report_lists_the_slowest_handlers_first():
+    histogram = Histogram('handler_duration_seconds', 'Durations',
+                          labelnames=('handler',))
+    histogram.observe(0.01, 'fast')
+    histogram.observe(0.2, 'slow')
+    histogram.observe(0.3, 'slow')
+
+    header, *rows = format_timing_report(histogram).splitlines()
+
+    assert header.split()[0] == 'handler'
+    assert [row.split()[:2] for row in rows] == [['slow', '2'],
+                                                 ['fast', '1']]
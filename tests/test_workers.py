@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+import pytest
+
+from knu_fcsc_bot.workers import (WorkerPartition, WebhookIngress,
+                                  get_partition_key, )
+
+SECRET_TOKEN = 'secret'
+
+
+def test_worker_partitions_split_chats():
+    partitions = [WorkerPartition(index, 3) for index in range(3)]
+
+    for chat_id in (-1001234567890, -100, 0, 1, 2, 5, 123456789):
+        owners = [partition.index for partition in partitions
+                  if partition.owns_chat(chat_id)]
+        assert owners == [chat_id % 3]
+
+
+@pytest.mark.parametrize('data, key', [
+    ({'update_id': 1, 'message': {'chat': {'id': -100}}}, -100),
+    ({'update_id': 1, 'chat_member': {'chat': {'id': -200}}}, -200),
+    ({'update_id': 1, 'callback_query': {'from': {'id': 5},
+                                         'message': {'chat': {'id': -300}}}},
+     -300),
+    ({'update_id': 1, 'callback_query': {'from': {'id': 5}}}, 5),
+    ({'update_id': 7, 'poll': {}}, 7),
+])
+def test_get_partition_key(data, key):
+    assert get_partition_key(data) == key
+
+
+async def start_worker(socket_path: str,
+                       ) -> tuple[list[dict], asyncio.Event]:
+    """Starts a fake worker, which collects messages from the ingress.
+    The event is set when the ingress disconnects"""
+    messages = []
+    disconnected = asyncio.Event()
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            messages.append(json.loads(line))
+        disconnected.set()
+
+    await asyncio.start_unix_server(handle, path=socket_path)
+    return messages, disconnected
+
+
+async def post(port: int, body: bytes, headers: dict[str, str]) -> bytes:
+    """Sends a webhook request and returns the status line"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request_headers = {'Content-Length': str(len(body)), **headers}
+    writer.write(
+        b'POST /hook HTTP/1.1\r\n'
+        + ''.join(f'{name}: {value}\r\n'
+                  for name, value in request_headers.items()).encode()
+        + b'\r\n'
+        + body
+    )
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return status_line.strip()
+
+
+def run_ingress(tmp_path, requests):
+    """Sends (body, headers) requests to an ingress with one worker.
+    Returns status lines and messages received by the worker"""
+
+    async def main():
+        socket_path = str(tmp_path / 'worker.sock')
+        messages, disconnected = await start_worker(socket_path)
+        ingress = WebhookIngress('hook', secret_token=SECRET_TOKEN)
+        await ingress.connect([socket_path])
+        server = await asyncio.start_server(ingress.handle_connection,
+                                            host='127.0.0.1', port=0)
+        port = server.sockets[0].getsockname()[1]
+
+        statuses = [await post(port, body, headers)
+                    for body, headers in requests]
+        await ingress.disconnect()
+        await disconnected.wait()
+        server.close()
+        return statuses, messages
+
+    return asyncio.run(main())
+
+
+UPDATE = json.dumps({'update_id': 1,
+                     'message': {'chat': {'id': -100}}}).encode()
+
+
+def test_ingress_forwards_updates_with_the_secret_token(tmp_path):
+    statuses, messages = run_ingress(tmp_path, [
+        (UPDATE, {'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}),
+    ])
+
+    assert statuses == [b'HTTP/1.1 200 OK']
+    assert messages == [{'update': json.loads(UPDATE)}]
+
+
+def test_ingress_rejects_wrong_secret_tokens(tmp_path):
+    statuses, messages = run_ingress(tmp_path, [
+        (UPDATE, {}),
+        (UPDATE, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}),
+    ])
+
+    assert statuses == [b'HTTP/1.1 403 Forbidden'] * 2
+    assert messages == []
+
+
+def test_ingress_rejects_large_bodies(tmp_path):
+    body = b'x' * (2 * 1024 * 1024)
+    statuses, messages = run_ingress(tmp_path, [
+        (body, {'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}),
+    ])
+
+    assert statuses == [b'HTTP/1.1 413 Payload Too Large']
+    assert messages == []